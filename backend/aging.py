@@ -0,0 +1,283 @@
+"""Month-end statements and debt aging for every customer at once.
+
+``GET /users/{id}/statement`` answers one customer at a time. For month end,
+a report job reads the whole fiado history once instead: completed ``fiado``
+sales are the charges and approved ``debt_payment`` transactions the
+payments, each streamed into numpy columns (customer code, time, amount),
+including the months moved to archive collections (see ``archive.py``).
+Everything after that is array arithmetic over all customers together:
+
+- payments settle the oldest charges first (FIFO), so what is still owed on
+  a charge is the part of it that lies beyond the customer's total payments
+  on the running sum of their charges;
+- those unpaid amounts are binned by age at the end of the month into 0-30,
+  31-60, 61-90 and over 90 days and summed per customer with ``bincount``;
+- opening, charges, payments and closing are masked ``bincount``s over the
+  same arrays.
+
+A row is written for every customer whose recorded ``debt`` or computed
+closing balance is above zero. Jobs run in the background of the worker that
+accepted them, are listed in ``report_jobs`` and keep their file in the blob
+store. Without the API:
+
+    python aging.py 2025-01 [csv|parquet]
+"""
+import asyncio
+import io
+import logging
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+
+from archive import Archive
+
+try:
+    import pyarrow
+except ImportError:  # only Parquet output needs it
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+FETCH_BATCH = 10000
+DAY = 86_400_000_000  # microseconds
+# Upper bound (in days) of every aging bucket but the last
+AGE_LIMITS = np.array([30, 60, 90])
+AGE_COLUMNS = ("aged_0_30", "aged_31_60", "aged_61_90", "aged_over_90")
+MEDIA_TYPES = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+
+class Movements(NamedTuple):
+    customers: np.ndarray  # int64 codes
+    times: np.ndarray  # int64 microseconds since the epoch
+    amounts: np.ndarray  # float64
+
+
+def month_range(month: Optional[str] = None, now: Optional[datetime] = None) -> Tuple[datetime, datetime]:
+    """[start, end) of a "YYYY-MM" month, or of the month so far; raises ValueError."""
+    if month is None:
+        end = now or datetime.now(timezone.utc)
+        return end.replace(day=1, hour=0, minute=0, second=0, microsecond=0), end
+    start = datetime.strptime(month, "%Y-%m").replace(tzinfo=timezone.utc)
+    return start, (start + timedelta(days=32)).replace(day=1)
+
+
+def _micros(value: datetime) -> int:
+    return int(value.timestamp()) * 1_000_000 + value.microsecond
+
+
+async def _columns(cursors: list, fields: Tuple[str, str, str]) -> Tuple[list, list, list]:
+    customers, times, amounts, ids = [], [], [], []
+    customer_field, time_field, amount_field = fields
+    for cursor in cursors:
+        while True:
+            batch = await cursor.to_list(FETCH_BATCH)
+            if not batch:
+                break
+            customers.extend(doc[customer_field] for doc in batch)
+            times.extend(doc[time_field] for doc in batch)
+            amounts.extend(doc[amount_field] for doc in batch)
+            ids.extend(doc["id"] for doc in batch)
+    if len(cursors) > 1:
+        # A month being archived is briefly in both the live and the archive collection
+        keep = ~pd.Index(ids).duplicated()
+        if not keep.all():
+            customers, times, amounts = (list(np.asarray(column, dtype=object)[keep])
+                                         for column in (customers, times, amounts))
+    return customers, times, amounts
+
+
+def _times(values: list) -> np.ndarray:
+    if not values:
+        return np.empty(0, dtype=np.int64)
+    return pd.to_datetime(values, utc=True, format="ISO8601").as_unit("us").asi8
+
+
+def age_debts(charges: Movements, payments: Movements, customers: int, start: int, end: int) -> Dict[str, np.ndarray]:
+    """Statement and aging columns, one entry per customer code, for the period [start, end)."""
+    def per_customer(codes: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        return np.bincount(codes, weights=weights, minlength=customers)
+
+    charges = Movements(*(column[charges.times < end] for column in charges))
+    payments = Movements(*(column[payments.times < end] for column in payments))
+    charged_before = charges.times < start
+    paid_before = payments.times < start
+    opening = (per_customer(charges.customers[charged_before], charges.amounts[charged_before])
+               - per_customer(payments.customers[paid_before], payments.amounts[paid_before]))
+    charged = per_customer(charges.customers[~charged_before], charges.amounts[~charged_before])
+    paid = per_customer(payments.customers[~paid_before], payments.amounts[~paid_before])
+
+    # FIFO: order each customer's charges by time and take the running sum
+    # within the customer by subtracting what the customers before them owe
+    order = np.lexsort((charges.times, charges.customers))
+    codes, times, amounts = charges.customers[order], charges.times[order], charges.amounts[order]
+    total_charged = per_customer(codes, amounts)
+    running = np.cumsum(amounts) - (np.cumsum(total_charged) - total_charged)[codes]
+    total_paid = per_customer(payments.customers, payments.amounts)
+    unpaid = np.clip(running - total_paid[codes], 0.0, amounts)
+
+    buckets = np.searchsorted(AGE_LIMITS, (end - times) // DAY, side="left")
+    aged = np.bincount(codes * len(AGE_COLUMNS) + buckets, weights=unpaid,
+                       minlength=customers * len(AGE_COLUMNS)).reshape(customers, len(AGE_COLUMNS))
+    owing = unpaid >= 0.005
+    oldest = np.full(customers, -1, dtype=np.int64)
+    # Sorted by (customer, time), so a customer's first unpaid charge is the oldest
+    owing_codes, first = np.unique(codes[owing], return_index=True)
+    oldest[owing_codes] = times[owing][first]
+
+    columns = {
+        "opening": opening,
+        "charges": charged,
+        "payments": paid,
+        "closing": opening + charged - paid,
+        **{name: aged[:, i] for i, name in enumerate(AGE_COLUMNS)},
+    }
+    columns = {name: np.round(values, 2) for name, values in columns.items()}
+    columns["oldest_unpaid"] = oldest
+    return columns
+
+
+async def load_movements(db, end: datetime, archive=None) -> Tuple[Movements, Movements, pd.Index]:
+    """Fiado charges and debt payments before ``end``, coded against one customer index."""
+    end_iso = end.isoformat()
+
+    async def sources(collection: str) -> List[str]:
+        return await archive.collections(collection, before=end_iso) if archive else [collection]
+
+    sales = await _columns([db[name].find(
+        {"payment_method": "fiado", "status": "completed", "timestamp": {"$lt": end_iso}},
+        {"_id": 0, "id": 1, "customer_id": 1, "timestamp": 1, "total": 1}
+    ).batch_size(FETCH_BATCH) for name in await sources("sales")], ("customer_id", "timestamp", "total"))
+    transactions = await _columns([db[name].find(
+        {"type": "debt_payment", "status": "approved", "timestamp": {"$lt": end_iso}},
+        {"_id": 0, "id": 1, "user_id": 1, "timestamp": 1, "amount": 1}
+    ).batch_size(FETCH_BATCH) for name in await sources("transactions")], ("user_id", "timestamp", "amount"))
+
+    codes, ids = pd.factorize(np.array(sales[0] + transactions[0], dtype=object))
+    codes = codes.astype(np.int64)
+    charges = Movements(codes[:len(sales[0])], _times(sales[1]), np.asarray(sales[2], dtype=np.float64))
+    payments = Movements(codes[len(sales[0]):], _times(transactions[1]), np.asarray(transactions[2], dtype=np.float64))
+    return charges, payments, pd.Index(ids)
+
+
+async def build_report(db, start: datetime, end: datetime, archive=None) -> pd.DataFrame:
+    charges, payments, ids = await load_movements(db, end, archive)
+    debtors = await db.users.find({"debt": {"$gt": 0}}, {"_id": 0, "id": 1}).to_list(None)
+    ids = ids.append(pd.Index([u["id"] for u in debtors]).difference(ids))
+    columns = await asyncio.to_thread(age_debts, charges, payments, len(ids), _micros(start), _micros(end))
+
+    frame = pd.DataFrame({"customer_id": ids, **columns})
+    users = await db.users.find(
+        {"id": {"$in": frame["customer_id"].tolist()}}, {"_id": 0, "id": 1, "username": 1, "debt": 1}
+    ).to_list(None)
+    users = pd.DataFrame(users, columns=["id", "username", "debt"]).rename(columns={"id": "customer_id"})
+    frame = frame.merge(users, on="customer_id", how="left")
+    frame["debt"] = frame["debt"].fillna(0.0)
+    frame = frame[(frame["debt"] > 0) | (frame["closing"] > 0)]
+
+    oldest = frame.pop("oldest_unpaid")
+    frame["oldest_unpaid"] = pd.to_datetime(oldest.where(oldest >= 0), unit="us", utc=True).dt.strftime("%Y-%m-%d")
+    order = ["customer_id", "username", "debt", "opening", "charges", "payments", "closing", *AGE_COLUMNS,
+             "oldest_unpaid"]
+    return frame[order].sort_values(["closing", "username"], ascending=[False, True], ignore_index=True)
+
+
+def encode(frame: pd.DataFrame, fmt: str) -> bytes:
+    if fmt == "parquet":
+        out = io.BytesIO()
+        frame.to_parquet(out, index=False)
+        return out.getvalue()
+    return frame.to_csv(index=False).encode()
+
+
+class DebtAgingReports:
+    """Runs report jobs in the background; ``report_jobs`` holds their status and blob."""
+
+    def __init__(self, db, store, archive=None):
+        self.db = db
+        self.store = store
+        self.archive = archive
+        self._tasks: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def available(fmt: str) -> bool:
+        return fmt != "parquet" or pyarrow is not None
+
+    async def start(self, month: Optional[str], fmt: str, created_by: str) -> dict:
+        start, end = month_range(month)
+        job = {
+            "id": str(uuid.uuid4()),
+            "type": "debt_aging",
+            "month": start.strftime("%Y-%m"),
+            "from": start.isoformat(),
+            "to": end.isoformat(),
+            "format": fmt,
+            "status": "running",
+            "created_by": created_by,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        }
+        await self.db.report_jobs.insert_one(dict(job))
+        task = asyncio.create_task(self._run(job, start, end))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    async def _run(self, job: dict, start: datetime, end: datetime) -> None:
+        began = time.perf_counter()
+        try:
+            frame = await build_report(self.db, start, end, self.archive)
+            data = await asyncio.to_thread(encode, frame, job["format"])
+            meta = await self.store.put(data, MEDIA_TYPES[job["format"]])
+            update = {"status": "done", "rows": len(frame), "blob": meta["_id"], "size": len(data)}
+        except asyncio.CancelledError:
+            update = {"status": "failed", "error": "Interrupted"}
+            raise
+        except Exception as e:
+            logger.exception(f"Debt aging report {job['id']} failed")
+            update = {"status": "failed", "error": f"{type(e).__name__}: {e}"}
+        finally:
+            update.update(finished_at=datetime.now(timezone.utc).isoformat(),
+                          seconds=round(time.perf_counter() - began, 3))
+            await self.db.report_jobs.update_one({"id": job["id"]}, {"$set": update})
+
+    async def stop(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+async def _main(argv) -> int:
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    fmt = argv[1] if len(argv) > 1 else "csv"
+    if len(argv) not in (1, 2) or fmt not in MEDIA_TYPES:
+        print("usage: python aging.py YYYY-MM [csv|parquet]")
+        return 2
+    try:
+        start, end = month_range(argv[0])
+    except ValueError:
+        print(f"Invalid month: {argv[0]}")
+        return 2
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        began = time.perf_counter()
+        frame = await build_report(db, start, end, Archive(db))
+        path = Path(f"debt-aging-{argv[0]}.{fmt}")
+        path.write_bytes(encode(frame, fmt))
+        print(f"{len(frame)} customers written to {path} in {time.perf_counter() - began:.1f}s")
+        return 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
@@ -0,0 +1,323 @@
+"""Monthly archive collections for the append-mostly history.
+
+``sales``, ``transactions`` and ``notifications`` only grow, and the admin
+lists page through all of it. ``Archive`` moves finished documents (sales
+that are completed or cancelled, reviewed transactions, every notification)
+older than ``after_days`` into one collection per calendar month, such as
+``sales_archive_2024_01``, with the same indexes as the live collection. The
+live collections and their indexes then only hold recent activity.
+
+A month is moved in two passes, so that no reader ever misses a document:
+
+1. its finished documents are copied into the archive and the month is
+   recorded in ``archive_months``;
+2. on a run at least ``grace`` seconds later, they are copied again (picking
+   up late changes) and deleted from the live collection. A document that
+   changed in between is left for the next run.
+
+Readers cache the archived months for ``state_ttl`` (kept below ``grace``),
+and read an archived month from both the archive and the live collection,
+dropping duplicates, because unfinished or late documents of that month
+(a pending transaction, a sale uploaded offline) stay live.
+
+``find`` serves ``paginate`` and the reports: it walks the requested range
+newest first, one month at a time, and only touches an archive when the
+range reaches that month and the newer months did not fill the page.
+Without archived months it is a plain query on the live collection.
+
+    python archive.py run 365
+    python archive.py status
+"""
+import asyncio
+import logging
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, NamedTuple, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING, ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from indexes import INDEXES
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+
+class ArchiveSpec(NamedTuple):
+    time_field: str
+    finished: Dict[str, Any]
+    # A document whose value here changed since it was copied is not deleted yet
+    mutable: Tuple[str, ...]
+
+
+ARCHIVED: Dict[str, ArchiveSpec] = {
+    "sales": ArchiveSpec("timestamp", {"status": {"$in": ["completed", "cancelled"]}}, ("status",)),
+    "transactions": ArchiveSpec("timestamp", {"status": {"$in": ["approved", "rejected"]}}, ("status",)),
+    "notifications": ArchiveSpec("timestamp", {}, ()),
+}
+
+
+def month_start(value: datetime) -> datetime:
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(value: datetime) -> datetime:
+    return month_start(value + timedelta(days=32))
+
+
+def archive_name(collection: str, month: str) -> str:
+    return f"{collection}_archive_{month.replace('-', '_')}"
+
+
+def _month_bounds(month: str) -> Tuple[str, str]:
+    start = datetime.strptime(month, "%Y-%m").replace(tzinfo=timezone.utc)
+    return start.isoformat(), next_month(start).isoformat()
+
+
+async def merge_sorted(cursors: List[Any], keys: List[str]) -> AsyncIterator[dict]:
+    """Merge cursors sorted by ``keys`` descending; documents with equal keys are yielded once."""
+    iterators = [cursor.__aiter__() for cursor in cursors]
+    heads: List[Optional[dict]] = []
+    for iterator in iterators:
+        heads.append(await anext(iterator, None))
+    last = None
+    while True:
+        # Ties go to the first cursor, so list the live collection first to prefer its copy
+        best = None
+        for i, head in enumerate(heads):
+            if head is not None and (best is None or [head.get(k) for k in keys] > [heads[best].get(k) for k in keys]):
+                best = i
+        if best is None:
+            return
+        doc = heads[best]
+        heads[best] = await anext(iterators[best], None)
+        values = [doc.get(k) for k in keys]
+        if values != last:
+            last = values
+            yield doc
+
+
+class Archive:
+    def __init__(self, db, after_days: float = 0, grace: float = 600, state_ttl: float = 30,
+                 batch_size: int = 1000, interval: float = 3600):
+        self.db = db
+        self.after_days = after_days
+        self.grace = max(grace, 2 * state_ttl)
+        self.state_ttl = state_ttl
+        self.batch_size = batch_size
+        self.interval = interval
+        # collection -> archived months, newest first
+        self._months: Dict[str, List[str]] = {}
+        self._loaded_at = float("-inf")
+        self._indexed: set = set()
+        self._task: Optional[asyncio.Task] = None
+        self.last_run: Optional[str] = None
+        self.last_result: Dict[str, Dict[str, int]] = {}
+
+    async def months(self, collection: str) -> List[str]:
+        if time.monotonic() - self._loaded_at > self.state_ttl:
+            months: Dict[str, List[str]] = {}
+            async for doc in self.db.archive_months.find({}, {"_id": 0, "collection": 1, "month": 1}):
+                months.setdefault(doc["collection"], []).append(doc["month"])
+            self._months = {name: sorted(values, reverse=True) for name, values in months.items()}
+            self._loaded_at = time.monotonic()
+        return self._months.get(collection, [])
+
+    async def collections(self, collection: str, before: Optional[str] = None) -> List[str]:
+        """The live collection and every archive holding documents older than ``before``."""
+        months = await self.months(collection)
+        return [collection] + [archive_name(collection, month) for month in months
+                               if before is None or _month_bounds(month)[0] < before]
+
+    async def intervals(self, collection: str, since: Optional[str], until: Optional[str],
+                        latest: Optional[str] = None) -> List[Tuple[Optional[str], Optional[str], List[str]]]:
+        """(start, end, collections) slices of [since, until), newest first; ``latest`` is an inclusive upper bound."""
+        months = await self.months(collection)
+        slices: List[Tuple[Optional[str], Optional[str], List[str]]] = []
+        end: Optional[str] = None
+        for month in months:
+            start, month_end = _month_bounds(month)
+            if end is None or month_end < end:
+                slices.append((month_end, end, [collection]))
+            slices.append((start, month_end, [collection, archive_name(collection, month)]))
+            end = start
+        slices.append((None, end, [collection]))
+        return [
+            (start, end, sources) for start, end, sources in slices
+            if not (until and start and start >= until) and not (latest and start and start > latest)
+            and not (since and end and end <= since)
+        ]
+
+    async def find(self, collection: str, query: dict, projection: dict, keys: List[str],
+                   since: Optional[str] = None, until: Optional[str] = None, latest: Optional[str] = None,
+                   limit: Optional[int] = None) -> AsyncIterator[dict]:
+        """Documents matching ``query`` across live and archived months, sorted by ``keys`` descending."""
+        time_field = ARCHIVED[collection].time_field
+        sort = [(k, DESCENDING) for k in keys]
+        found = 0
+        for start, end, sources in await self.intervals(collection, since, until, latest):
+            bounds = {}
+            if start:
+                bounds["$gte"] = start
+            if end:
+                bounds["$lt"] = end
+            bounded = {"$and": [query, {time_field: bounds}]} if bounds else query
+            cursors = []
+            for source in sources:
+                cursor = self.db[source].find(bounded, projection).sort(sort)
+                cursors.append(cursor.limit(limit - found) if limit else cursor)
+            async for doc in (cursors[0] if len(cursors) == 1 else merge_sorted(cursors, keys)):
+                yield doc
+                found += 1
+                if limit and found >= limit:
+                    return
+
+    async def find_one(self, collection: str, query: dict, projection: Optional[dict] = None) -> Optional[dict]:
+        """The first match in the live collection or, failing that, an archive (newest month first)."""
+        for name in await self.collections(collection):
+            doc = await self.db[name].find_one(query, projection)
+            if doc:
+                return doc
+        return None
+
+    async def _ensure_indexes(self, name: str, collection: str) -> None:
+        if name in self._indexed:
+            return
+        # Partial indexes (offline upload keys) guard writes, which archives do not take
+        models = [m for m in INDEXES.get(collection, []) if "partialFilterExpression" not in m.document]
+        if models:
+            await self.db[name].create_indexes(models)
+        self._indexed.add(name)
+
+    async def _copy(self, collection: str, month: str, delete: bool) -> int:
+        """Copy (and with ``delete``, then remove) the month's finished live documents; returns how many."""
+        spec = ARCHIVED[collection]
+        start, end = _month_bounds(month)
+        name = archive_name(collection, month)
+        await self._ensure_indexes(name, collection)
+        query = {**spec.finished, spec.time_field: {"$gte": start, "$lt": end}}
+        last_id, count = None, 0
+        while True:
+            batch_query = {**query, "_id": {"$gt": last_id}} if last_id is not None else query
+            docs = await self.db[collection].find(batch_query).sort("_id", ASCENDING).to_list(self.batch_size)
+            if not docs:
+                return count
+            last_id = docs[-1]["_id"]
+            try:
+                await self.db[name].bulk_write([ReplaceOne({"_id": d["_id"]}, d, upsert=True) for d in docs],
+                                               ordered=False)
+            except BulkWriteError as e:
+                # Another worker upserted the same document first
+                if any(error.get("code") != DUPLICATE_KEY for error in e.details.get("writeErrors", [])):
+                    raise
+            if delete:
+                unchanged = ({"$or": [{"_id": d["_id"], **{field: d.get(field) for field in spec.mutable}} for d in docs]}
+                             if spec.mutable else {"_id": {"$in": [d["_id"] for d in docs]}})
+                result = await self.db[collection].delete_many(unchanged)
+                count += result.deleted_count
+            else:
+                count += len(docs)
+
+    async def _eligible_months(self, collection: str, cutoff: datetime) -> List[str]:
+        spec = ARCHIVED[collection]
+        oldest = await self.db[collection].find_one(
+            {**spec.finished, spec.time_field: {"$lt": cutoff.isoformat()}},
+            {"_id": 0, spec.time_field: 1}, sort=[(spec.time_field, ASCENDING)]
+        )
+        if not oldest:
+            return []
+        months = []
+        month = month_start(datetime.fromisoformat(oldest[spec.time_field]).astimezone(timezone.utc))
+        while month < cutoff:
+            months.append(month.strftime("%Y-%m"))
+            month = next_month(month)
+        return months
+
+    async def run_once(self, after_days: Optional[float] = None) -> Dict[str, Dict[str, int]]:
+        """Archive whole months that ended more than ``after_days`` ago; returns copied/moved counts."""
+        after_days = self.after_days if after_days is None else after_days
+        now = datetime.now(timezone.utc)
+        cutoff = month_start(now - timedelta(days=after_days))
+        result: Dict[str, Dict[str, int]] = {}
+        for collection in ARCHIVED:
+            marked = {
+                doc["month"]: datetime.fromisoformat(doc["marked_at"])
+                async for doc in self.db.archive_months.find({"collection": collection}, {"_id": 0})
+            }
+            counts = result[collection] = {"copied": 0, "moved": 0}
+            for month in await self._eligible_months(collection, cutoff):
+                if month not in marked:
+                    counts["copied"] += await self._copy(collection, month, delete=False)
+                    await self.db.archive_months.update_one(
+                        {"_id": f"{collection}:{month}"},
+                        {"$setOnInsert": {"collection": collection, "month": month, "marked_at": now.isoformat()}},
+                        upsert=True
+                    )
+                elif (now - marked[month]).total_seconds() >= self.grace:
+                    counts["moved"] += await self._copy(collection, month, delete=True)
+        self._loaded_at = float("-inf")
+        self.last_run = now.isoformat()
+        self.last_result = result
+        return result
+
+    def start(self) -> None:
+        if self.after_days > 0 and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Archiving failed")
+            await asyncio.sleep(self.interval)
+
+    async def stats(self) -> dict:
+        return {
+            "after_days": self.after_days,
+            "interval": self.interval,
+            "grace": self.grace,
+            "months": {collection: await self.months(collection) for collection in ARCHIVED},
+            "last_run": self.last_run,
+            "last_result": self.last_result,
+        }
+
+
+async def _main(argv) -> int:
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    if argv[:1] not in (["run"], ["status"]) or (argv[0] == "run" and len(argv) != 2):
+        print("usage: python archive.py run DAYS|status")
+        return 2
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        archive = Archive(db, grace=float(os.environ.get('ARCHIVE_GRACE_SECONDS', '600')))
+        if argv[0] == "run":
+            for collection, counts in (await archive.run_once(float(argv[1]))).items():
+                print(f"{collection}: {counts['copied']} copied, {counts['moved']} moved")
+        else:
+            for collection in ARCHIVED:
+                months = await archive.months(collection)
+                print(f"{collection}: {', '.join(reversed(months)) or 'nothing archived'}")
+        return 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
@@ -0,0 +1,293 @@
+"""Content-addressed storage for product images and payment receipts.
+
+Blobs are keyed by the SHA-256 of their bytes, so uploading the same picture
+twice stores it once. Documents only keep a short reference
+(``/api/blobs/<hash>``); the bytes live on the local filesystem or in GridFS,
+and a ``blobs`` collection holds the metadata (size, content type, thumbnail)
+for both backends. Catalog images are marked ``public``; other blobs, such as
+receipts, are only served to readers the API authorizes.
+
+Inline base64 images written before this module existed can be moved out with
+
+    python blobs.py migrate
+"""
+import asyncio
+import base64
+import binascii
+import hashlib
+import io
+import logging
+import os
+import re
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import AsyncIterator, Optional, Tuple
+
+from pymongo import UpdateOne
+
+from catalog import COUNTER_ID
+
+try:
+    from PIL import Image
+except ImportError:  # thumbnails are skipped without Pillow
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+THUMBNAIL_SIZE = (256, 256)
+DATA_URL_RE = re.compile(r"^data:(?P<type>[\w.+-]+/[\w.+-]+)?(?P<params>(;[^;,]*)*?);base64,", re.IGNORECASE)
+HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class InvalidBlob(Exception):
+    pass
+
+
+def parse_byte_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parse a Range header into an inclusive (start, end); None if unsatisfiable.
+
+    Only the first range of a multi-range request is honoured.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec:
+        return None
+    first, _, last = spec.split(",")[0].strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            start = max(size - int(last), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    end = min(end, size - 1)
+    if start > end or start >= size:
+        return None
+    return start, end
+
+
+def decode_data_url(value: str) -> Optional[Tuple[bytes, str]]:
+    """Return (bytes, content type) for a base64 data URL, None for anything else."""
+    match = DATA_URL_RE.match(value or "")
+    if not match:
+        return None
+    try:
+        data = base64.b64decode(value[match.end():], validate=False)
+    except (binascii.Error, ValueError):
+        raise InvalidBlob("Invalid base64 data")
+    return data, (match.group("type") or "application/octet-stream").lower()
+
+
+def make_thumbnail(data: bytes) -> Optional[Tuple[bytes, str]]:
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.thumbnail(THUMBNAIL_SIZE)
+            out = io.BytesIO()
+            if image.mode in ("RGBA", "LA", "P"):
+                image.save(out, format="PNG", optimize=True)
+                return out.getvalue(), "image/png"
+            image.convert("RGB").save(out, format="JPEG", quality=80, optimize=True)
+            return out.getvalue(), "image/jpeg"
+    except Exception as e:
+        logger.warning(f"Could not create thumbnail: {e}")
+        return None
+
+
+class LocalBackend:
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def _path(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest[2:4] / digest
+
+    async def write(self, digest: str, data: bytes, content_type: str) -> None:
+        def _write():
+            path = self._path(digest)
+            if path.exists():
+                return
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(f".{os.getpid()}.tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+        await asyncio.to_thread(_write)
+
+    async def read(self, digest: str, start: int, end: int) -> AsyncIterator[bytes]:
+        # [start, end] inclusive, like an HTTP byte range
+        f = await asyncio.to_thread(open, self._path(digest), "rb")
+        try:
+            await asyncio.to_thread(f.seek, start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = await asyncio.to_thread(f.read, min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            await asyncio.to_thread(f.close)
+
+
+class GridFSBackend:
+    def __init__(self, db, bucket_name: str = "blobs"):
+        from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+        self.bucket = AsyncIOMotorGridFSBucket(db, bucket_name=bucket_name)
+        self.files = db[f"{bucket_name}.files"]
+
+    async def write(self, digest: str, data: bytes, content_type: str) -> None:
+        if await self.files.find_one({"_id": digest}, {"_id": 1}):
+            return
+        await self.bucket.upload_from_stream_with_id(digest, digest, data, metadata={"content_type": content_type})
+
+    async def read(self, digest: str, start: int, end: int) -> AsyncIterator[bytes]:
+        grid_out = await self.bucket.open_download_stream(digest)
+        grid_out.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await grid_out.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+class BlobStore:
+    def __init__(self, db, backend, public_url: str = "/api/blobs"):
+        self.db = db
+        self.backend = backend
+        self.public_url = public_url.rstrip("/")
+
+    def url(self, digest: str) -> str:
+        return f"{self.public_url}/{digest}"
+
+    def digest_from_url(self, value: str) -> Optional[str]:
+        prefix = f"{self.public_url}/"
+        if value and value.startswith(prefix) and HASH_RE.match(value[len(prefix):]):
+            return value[len(prefix):]
+        return None
+
+    async def put(self, data: bytes, content_type: str, thumbnail: bool = False, public: bool = False) -> dict:
+        digest = hashlib.sha256(data).hexdigest()
+        meta = await self.db.blobs.find_one({"_id": digest})
+        if meta is None:
+            await self.backend.write(digest, data, content_type)
+            meta = {
+                "_id": digest,
+                "size": len(data),
+                "content_type": content_type,
+                "created_at": datetime.now(timezone.utc).isoformat(),
+            }
+            await self.db.blobs.update_one({"_id": digest}, {"$setOnInsert": meta}, upsert=True)
+        if public:
+            await self.publish(meta)
+        if thumbnail and "thumbnail" not in meta and content_type.startswith("image/"):
+            thumb = await asyncio.to_thread(make_thumbnail, data)
+            thumb_meta = await self.put(*thumb, public=public) if thumb else None
+            meta["thumbnail"] = thumb_meta["_id"] if thumb_meta else None
+            await self.db.blobs.update_one({"_id": digest}, {"$set": {"thumbnail": meta["thumbnail"]}})
+        return meta
+
+    async def put_data_url(self, value: str, thumbnail: bool = False, public: bool = False) -> Optional[dict]:
+        decoded = decode_data_url(value)
+        if decoded is None:
+            return None
+        return await self.put(*decoded, thumbnail=thumbnail, public=public)
+
+    async def publish(self, meta: dict) -> None:
+        # Once a catalog image, always served to anyone, thumbnail included
+        if meta.get("public"):
+            return
+        meta["public"] = True
+        ids = [meta["_id"]] + ([meta["thumbnail"]] if meta.get("thumbnail") else [])
+        await self.db.blobs.update_many({"_id": {"$in": ids}}, {"$set": {"public": True}})
+
+    async def stat(self, digest: str) -> Optional[dict]:
+        if not HASH_RE.match(digest):
+            return None
+        return await self.db.blobs.find_one({"_id": digest})
+
+    def read(self, digest: str, start: int, end: int) -> AsyncIterator[bytes]:
+        return self.backend.read(digest, start, end)
+
+
+def create_blob_store(db, root_dir: Path) -> BlobStore:
+    public_url = os.environ.get('BLOB_PUBLIC_URL', '/api/blobs')
+    if os.environ.get('BLOB_BACKEND', 'local') == 'gridfs':
+        return BlobStore(db, GridFSBackend(db), public_url)
+    return BlobStore(db, LocalBackend(Path(os.environ.get('BLOB_DIR', root_dir / 'blobs'))), public_url)
+
+
+async def migrate_inline_images(db, store: BlobStore, batch_size: int = 100) -> dict:
+    """Move base64 data URLs out of products.image_url and transactions.receipt_url.
+
+    Product images, moved now or stored before blobs had a ``public`` flag, are
+    marked public; receipts stay private.
+    """
+    counts = {}
+    targets = [("products", "image_url", True), ("transactions", "receipt_url", False)]
+    for collection, field, thumbnail in targets:
+        moved = 0
+        ops = []
+        cursor = db[collection].find({field: {"$regex": "^data:"}}, {"_id": 0, "id": 1, field: 1})
+        async for doc in cursor:
+            try:
+                meta = await store.put_data_url(doc[field], thumbnail=thumbnail, public=thumbnail)
+            except InvalidBlob:
+                logger.warning(f"Skipping {collection} {doc.get('id')}: invalid data URL")
+                continue
+            if meta is None:
+                continue
+            update = {field: store.url(meta["_id"])}
+            if thumbnail and meta.get("thumbnail"):
+                update["thumbnail_url"] = store.url(meta["thumbnail"])
+            # Only replace the value we read, in case it changed meanwhile
+            ops.append(UpdateOne({"id": doc["id"], field: doc[field]}, {"$set": update}))
+            if len(ops) >= batch_size:
+                moved += (await db[collection].bulk_write(ops, ordered=False)).modified_count
+                ops = []
+        if ops:
+            moved += (await db[collection].bulk_write(ops, ordered=False)).modified_count
+        counts[collection] = moved
+    published = 0
+    prefix = re.escape(f"{store.public_url}/")
+    async for doc in db.products.find({"image_url": {"$regex": f"^{prefix}"}}, {"_id": 0, "image_url": 1}):
+        digest = store.digest_from_url(doc["image_url"])
+        meta = await store.stat(digest) if digest else None
+        if meta and not meta.get("public"):
+            await store.publish(meta)
+            published += 1
+    counts["public"] = published
+    return counts
+
+
+async def _main(argv) -> int:
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    if argv[:1] != ["migrate"]:
+        print("usage: python blobs.py migrate")
+        return 2
+    root_dir = Path(__file__).parent
+    load_dotenv(root_dir / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        counts = await migrate_inline_images(db, create_blob_store(db, root_dir))
+        published = counts.pop("public")
+        for collection, moved in counts.items():
+            print(f"{collection}: {moved} inline images moved to the blob store")
+        print(f"blobs: {published} product images marked public")
+        if counts.get("products"):
+            # Let running workers rebuild their catalog snapshot
+            await db.counters.update_one({"_id": COUNTER_ID}, {"$inc": {"seq": 1}}, upsert=True)
+        return 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
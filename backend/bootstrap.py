@@ -0,0 +1,100 @@
+"""First-run setup that every worker can run at the same time.
+
+Each uvicorn worker runs ``startup_db``, so with several workers the default
+admin and the sample catalog used to be created by whoever got there first,
+and a race could produce two admins or a doubled catalog. Here every write is
+an upsert or an insert that a unique index makes safe to repeat:
+
+- the admin is upserted with ``$setOnInsert`` on ``username`` (unique), so the
+  loser of a race changes nothing;
+- sample products get ids derived from their names and go in with one
+  unordered ``insert_many``; duplicates from a concurrent worker are ignored
+  by the ``id`` unique index.
+
+``Bootstrap`` records how the run went for the readiness endpoint.
+"""
+import logging
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_PRODUCT_NAMESPACE = uuid.UUID("0d6c7a36-8d0e-4f53-9a52-8f3b0b1c5e21")
+DUPLICATE_KEY = 11000
+
+
+def sample_product_id(name: str) -> str:
+    return str(uuid.uuid5(SAMPLE_PRODUCT_NAMESPACE, name))
+
+
+async def ensure_user(db, username: str, make_doc: Callable[[], Awaitable[dict]]) -> bool:
+    """Create the user unless it exists; True if this call created it."""
+    # Checked first so restarts do not pay for a password hash
+    if await db.users.find_one({"username": username}, {"_id": 1}):
+        return False
+    doc = await make_doc()
+    try:
+        result = await db.users.update_one({"username": username}, {"$setOnInsert": doc}, upsert=True)
+    except DuplicateKeyError:
+        return False
+    return result.upserted_id is not None
+
+
+async def seed_products(db, docs: List[dict]) -> List[dict]:
+    """Insert the sample catalog into an empty products collection; returns what this call inserted."""
+    if await db.products.count_documents({}, limit=1):
+        return []
+    try:
+        await db.products.insert_many(docs, ordered=False)
+        return docs
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != DUPLICATE_KEY for error in errors):
+            raise
+        failed = {error["index"] for error in errors}
+        return [doc for i, doc in enumerate(docs) if i not in failed]
+
+
+class Bootstrap:
+    def __init__(self):
+        self.state = "pending"  # pending, running, done, failed
+        self.started_at: Optional[str] = None
+        self.finished_at: Optional[str] = None
+        self.seconds: Optional[float] = None
+        self.steps: Dict[str, Any] = {}
+        self.error: Optional[str] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "done"
+
+    async def run(self, steps: Dict[str, Callable[[], Awaitable[Any]]]) -> None:
+        """Run the steps in order; a failure is logged and reported instead of stopping the worker."""
+        self.state = "running"
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        start = time.perf_counter()
+        try:
+            for name, step in steps.items():
+                self.steps[name] = await step()
+            self.state = "done"
+        except Exception as e:
+            self.state = "failed"
+            self.error = f"{type(e).__name__}: {e}"
+            logger.exception("Bootstrap failed")
+        finally:
+            self.finished_at = datetime.now(timezone.utc).isoformat()
+            self.seconds = round(time.perf_counter() - start, 3)
+
+    def status(self) -> dict:
+        return {
+            "state": self.state,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "seconds": self.seconds,
+            "steps": self.steps,
+            "error": self.error,
+        }
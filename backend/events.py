@@ -0,0 +1,215 @@
+"""Change feed: typed events from the write paths, pushed to screens over SSE.
+
+Write endpoints call ``EventBus.publish(type, data, topics)`` once their
+writes are done; it never blocks the request. Each event is serialized once
+into a server-sent-events frame, and every connected screen is an in-memory
+queue fed from the same frames, so a few hundred screens per worker cost no
+Mongo queries. A screen only receives events with a topic it subscribed to.
+
+Sequence numbers are the SSE event ids. The last ``buffer_size`` events are
+kept per worker, so a client that reconnects with ``Last-Event-ID`` gets what
+it missed; one that fell further behind (or whose id comes from before a
+restart) gets a ``reset`` event and should reload through the REST endpoints.
+
+With several workers, ``broadcast=True`` routes events through the capped
+``events`` collection: a background task writes queued events in batches,
+reserving their sequence numbers with one ``$inc`` on ``counters``, and each
+worker tails the collection with a single cursor. Batches from different
+workers can land slightly out of order, so the tailer holds a later number
+back until the gap fills or ``gap_timeout`` passes.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, List, NamedTuple, Optional, Set
+
+import orjson
+from pymongo import CursorType, ReturnDocument
+from pymongo.errors import CollectionInvalid, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+COUNTER_ID = "events"
+
+
+class Event(NamedTuple):
+    seq: int
+    type: str
+    topics: frozenset
+    frame: bytes
+
+
+def _frame(seq: int, type_: str, data: dict) -> bytes:
+    return b"id: %d\nevent: %s\ndata: %s\n\n" % (seq, type_.encode(), orjson.dumps(data))
+
+
+class Subscription:
+    def __init__(self, topics: Optional[Set[str]], maxsize: int):
+        # None receives every topic
+        self.topics = topics
+        self.queue: "asyncio.Queue[bytes]" = asyncio.Queue(maxsize)
+        self.overflowed = False
+
+    def wants(self, event: Event) -> bool:
+        return self.topics is None or not self.topics.isdisjoint(event.topics)
+
+    def push(self, frame: bytes) -> None:
+        try:
+            self.queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            # Too slow to keep up: end the stream, the client resumes from its last id
+            self.overflowed = True
+
+    async def frames(self, heartbeat: float):
+        while not self.overflowed:
+            try:
+                yield await asyncio.wait_for(self.queue.get(), heartbeat)
+            except asyncio.TimeoutError:
+                yield b": ping\n\n"
+
+
+class EventBus:
+    def __init__(self, db, broadcast: bool = False, buffer_size: int = 1000, client_queue: int = 256,
+                 collection: str = "events", size_bytes: int = 16 * 1024 * 1024, gap_timeout: float = 2.0):
+        self.db = db
+        self.broadcast = broadcast
+        self.client_queue = client_queue
+        self.collection_name = collection
+        self.size_bytes = size_bytes
+        self.gap_timeout = gap_timeout
+        self._buffer: Deque[Event] = deque(maxlen=buffer_size)
+        self._subscribers: Set[Subscription] = set()
+        self.last_seq = 0
+        # broadcast mode: events waiting to be written, and ones read out of order
+        self._outbox: List[dict] = []
+        self._wake = asyncio.Event()
+        self._held: Dict[int, dict] = {}
+        self._gap_since: Optional[float] = None
+        self._tasks: List[asyncio.Task] = []
+        self.published = 0
+        self.dropped = 0
+
+    @property
+    def collection(self):
+        return self.db[self.collection_name]
+
+    def publish(self, type_: str, data: dict, topics: Iterable[str]) -> None:
+        self.published += 1
+        if not self.broadcast:
+            self._deliver(self.last_seq + 1, type_, list(topics), data)
+            return
+        self._outbox.append({"type": type_, "topics": list(topics), "data": data})
+        self._wake.set()
+
+    def _deliver(self, seq: int, type_: str, topics: List[str], data: dict) -> None:
+        event = Event(seq, type_, frozenset(topics), _frame(seq, type_, data))
+        self.last_seq = seq
+        self._buffer.append(event)
+        for subscriber in self._subscribers:
+            if subscriber.wants(event):
+                subscriber.push(event.frame)
+
+    def subscribe(self, topics: Optional[Set[str]], since: Optional[int] = None) -> Subscription:
+        subscription = Subscription(topics, self.client_queue)
+        if since is not None:
+            first = self._buffer[0].seq if self._buffer else self.last_seq + 1
+            if first - 1 <= since <= self.last_seq:
+                for event in self._buffer:
+                    if event.seq > since and subscription.wants(event):
+                        subscription.push(event.frame)
+            else:
+                subscription.push(_frame(self.last_seq, "reset", {"last_seq": self.last_seq}))
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self._subscribers.discard(subscription)
+
+    async def start(self) -> None:
+        if not self.broadcast:
+            return
+        try:
+            await self.db.create_collection(self.collection_name, capped=True, size=self.size_bytes)
+        except CollectionInvalid:
+            pass
+        # A tailable cursor on an empty capped collection dies immediately
+        if await self.collection.find_one() is None:
+            await self.collection.insert_one({"seq": 0, "type": None})
+        counter = await self.db.counters.find_one({"_id": COUNTER_ID})
+        self.last_seq = counter["seq"] if counter else 0
+        self._tasks = [asyncio.create_task(self._write()), asyncio.create_task(self._tail())]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _write(self) -> None:
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            batch, self._outbox = self._outbox, []
+            if not batch:
+                continue
+            try:
+                counter = await self.db.counters.find_one_and_update(
+                    {"_id": COUNTER_ID}, {"$inc": {"seq": len(batch)}}, upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
+                first = counter["seq"] - len(batch) + 1
+                for i, doc in enumerate(batch):
+                    doc["seq"] = first + i
+                await self.collection.insert_many(batch)
+            except asyncio.CancelledError:
+                raise
+            except PyMongoError as e:
+                # Other workers skip the gap after gap_timeout
+                self.dropped += len(batch)
+                logger.warning(f"Could not publish {len(batch)} events: {e}")
+
+    def _receive(self, doc: dict) -> None:
+        if doc.get("type") is None or doc["seq"] <= self.last_seq:
+            return
+        self._held[doc["seq"]] = doc
+        self._flush()
+
+    def _flush(self, skip_gap: bool = False) -> None:
+        if skip_gap and self._held:
+            self.last_seq = min(self._held) - 1
+        delivered = False
+        while self.last_seq + 1 in self._held:
+            doc = self._held.pop(self.last_seq + 1)
+            self._deliver(doc["seq"], doc["type"], doc["topics"], doc["data"])
+            delivered = True
+        if not self._held:
+            self._gap_since = None
+        elif delivered or self._gap_since is None:
+            self._gap_since = time.monotonic()
+
+    async def _tail(self) -> None:
+        while True:
+            try:
+                cursor = self.collection.find({"seq": {"$gt": self.last_seq}}, cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    async for doc in cursor:
+                        self._receive(doc)
+                    if self._gap_since is not None and time.monotonic() - self._gap_since > self.gap_timeout:
+                        self._flush(skip_gap=True)
+                    await asyncio.sleep(0.05)
+            except asyncio.CancelledError:
+                raise
+            except PyMongoError as e:
+                logger.warning(f"Event feed interrupted: {e}")
+            await asyncio.sleep(1)
+
+    def stats(self) -> dict:
+        return {
+            "broadcast": self.broadcast,
+            "subscribers": len(self._subscribers),
+            "last_seq": self.last_seq,
+            "buffered": len(self._buffer),
+            "published": self.published,
+            "dropped": self.dropped,
+        }
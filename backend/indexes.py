@@ -0,0 +1,192 @@
+"""Index registry for the cantina database.
+
+Every collection's indexes are declared here and applied idempotently by
+``startup_db``. The same module doubles as a query-plan checker:
+
+    python indexes.py --check
+
+runs ``explain()`` on each route's canonical query and exits non-zero if any
+of them resolves to a collection scan.
+"""
+import asyncio
+import logging
+import os
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# collection -> indexes
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="timeline"),
+    ],
+    "products": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("stock", ASCENDING)], name="stock"),
+        IndexModel([("name", ASCENDING)], name="name"),
+        IndexModel([("low_stock_threshold", DESCENDING)], name="low_stock_threshold"),
+    ],
+    "sales_rollups": [
+        IndexModel([("dimension", ASCENDING), ("granularity", ASCENDING), ("bucket", ASCENDING)],
+                   name="dimension_bucket"),
+    ],
+    "sales": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("timestamp", DESCENDING), ("id", DESCENDING)], name="timeline"),
+        IndexModel([("customer_id", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)],
+                   name="customer_timeline"),
+        IndexModel([("drawer_id", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)],
+                   name="drawer_timeline", sparse=True),
+        # Keys are claimed in sale_keys; this only finds sales uploaded before it
+        IndexModel([("idempotency_key", ASCENDING)], name="idempotency_key", sparse=True),
+        IndexModel([("payment_method", ASCENDING), ("status", ASCENDING), ("timestamp", ASCENDING)],
+                   name="payment_method_timeline"),
+        IndexModel([("rollups_pending", ASCENDING)], name="rollups_pending", sparse=True),
+    ],
+    "balance_ledger": [
+        IndexModel([("reason", ASCENDING), ("source_id", ASCENDING)], name="source_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("timestamp", ASCENDING)], name="user_timeline"),
+        IndexModel([("timestamp", ASCENDING)], name="timestamp"),
+    ],
+    "balance_snapshots": [
+        IndexModel([("user_id", ASCENDING), ("as_of", DESCENDING)], name="user_as_of"),
+        IndexModel([("as_of", ASCENDING)], name="as_of"),
+    ],
+    "transactions": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("timestamp", DESCENDING), ("id", DESCENDING)], name="timeline"),
+        IndexModel([("user_id", ASCENDING), ("timestamp", DESCENDING), ("id", DESCENDING)], name="user_timeline"),
+        IndexModel([("status", ASCENDING)], name="status"),
+        IndexModel([("review_batch", ASCENDING)], name="review_batch", sparse=True),
+        IndexModel([("type", ASCENDING), ("status", ASCENDING), ("timestamp", ASCENDING)], name="type_timeline"),
+    ],
+    "cash_drawers": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("seller_id", ASCENDING), ("timestamp_closed", ASCENDING)], name="seller_open"),
+        IndexModel([("timestamp_opened", DESCENDING), ("id", DESCENDING)], name="timeline"),
+    ],
+    "push_subscriptions": [
+        IndexModel([("user_id", ASCENDING)], name="user_id"),
+        IndexModel([("id", ASCENDING)], name="id"),
+    ],
+    "push_jobs": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("status", ASCENDING), ("created_at", ASCENDING)], name="status_created"),
+        IndexModel([("created_at", DESCENDING)], name="created_at"),
+    ],
+    "notifications": [
+        IndexModel([("timestamp", DESCENDING)], name="timestamp"),
+    ],
+    "sale_keys": [
+        IndexModel([("sale_id", ASCENDING)], name="sale_id"),
+    ],
+    "report_jobs": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("created_at", DESCENDING)], name="created_at"),
+    ],
+}
+
+# (route, collection, filter, sort) - the query each hot route issues
+CANONICAL_QUERIES: List[Tuple[str, str, Dict[str, Any], Optional[List[Tuple[str, int]]]]] = [
+    ("get_current_user", "users", {"id": ""}, None),
+    ("login", "users", {"username": ""}, None),
+    ("create_sale", "products", {"id": ""}, None),
+    ("get_users", "users", {}, [("created_at", DESCENDING), ("id", DESCENDING)]),
+    ("get_products", "products", {}, [("id", DESCENDING)]),
+    ("get_sales", "sales", {}, [("timestamp", DESCENDING), ("id", DESCENDING)]),
+    ("get_sales", "sales", {"customer_id": ""}, [("timestamp", DESCENDING), ("id", DESCENDING)]),
+    ("cancel_sale", "sales", {"id": ""}, None),
+    ("upload_sales", "sale_keys", {"_id": {"$in": [""]}}, None),
+    ("upload_sales", "sales", {"idempotency_key": {"$in": [""], "$type": "string"}}, None),
+    ("get_drawer_sales", "sales", {"drawer_id": ""}, [("timestamp", DESCENDING), ("id", DESCENDING)]),
+    ("rollup_catch_up", "sales", {"rollups_pending": {"$in": ["sale", "cancel"]}}, None),
+    ("get_transactions", "transactions", {}, [("timestamp", DESCENDING), ("id", DESCENDING)]),
+    ("get_transactions", "transactions", {"user_id": ""}, [("timestamp", DESCENDING), ("id", DESCENDING)]),
+    ("review_transaction", "transactions", {"id": ""}, None),
+    ("get_pending_transactions", "transactions", {"status": "pending"}, None),
+    ("get_current_drawer", "cash_drawers", {"seller_id": "", "timestamp_closed": None}, None),
+    ("close_cash_drawer", "cash_drawers", {"id": ""}, None),
+    ("get_drawer_history", "cash_drawers", {}, [("timestamp_opened", DESCENDING), ("id", DESCENDING)]),
+    ("subscribe_push", "push_subscriptions", {"user_id": ""}, None),
+    ("import_product_file", "products", {"name": {"$in": [""]}}, None),
+    ("review_transactions", "transactions", {"review_batch": ""}, None),
+    ("get_user_balance", "balance_snapshots", {"user_id": "", "as_of": {"$lte": ""}}, [("as_of", DESCENDING)]),
+    ("get_user_statement", "balance_ledger", {"user_id": "", "timestamp": {"$gte": "", "$lt": ""}}, [("timestamp", ASCENDING)]),
+    ("ledger_verify_tail", "balance_ledger", {"timestamp": {"$gte": ""}}, None),
+    ("get_low_stock", "products", {"stock": {"$lte": 10}, "$expr": {"$lte": ["$stock", "$low_stock_threshold"]}}, None),
+    ("get_stock_out_projection", "sales_rollups", {"dimension": "product", "granularity": "day", "bucket": {"$gte": ""}}, None),
+    ("debt_aging_charges", "sales", {"payment_method": "fiado", "status": "completed", "timestamp": {"$lt": ""}}, None),
+    ("debt_aging_payments", "transactions", {"type": "debt_payment", "status": "approved", "timestamp": {"$lt": ""}}, None),
+    ("get_sales_summary", "sales_rollups", {"dimension": "seller", "granularity": "hour", "bucket": {"$gte": "", "$lt": ""}}, None),
+]
+
+
+async def ensure_indexes(db) -> None:
+    for collection, models in INDEXES.items():
+        try:
+            await db[collection].create_indexes(models)
+        except OperationFailure as e:
+            # An index with the same name but different options, or duplicate
+            # keys under a unique index. Leave the rest of the registry applied.
+            logger.error(f"Could not create indexes on {collection}: {e}")
+
+
+def _stages(plan: Any) -> List[str]:
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(_stages(value))
+    return stages
+
+
+async def check_query_plans(db) -> List[str]:
+    """Return the routes whose canonical query plans to a COLLSCAN."""
+    failures = []
+    for route, collection, query, sort in CANONICAL_QUERIES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explanation = await cursor.explain()
+        stages = _stages(explanation.get("queryPlanner", {}).get("winningPlan", {}))
+        if "COLLSCAN" in stages:
+            failures.append(f"{route}: {collection}.find({query}) -> {' <- '.join(stages)}")
+    return failures
+
+
+async def _main(argv: List[str]) -> int:
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        if "--apply" in argv or "--check" not in argv:
+            await ensure_indexes(db)
+            print("Indexes applied")
+        if "--check" in argv:
+            failures = await check_query_plans(db)
+            for failure in failures:
+                print(f"COLLSCAN {failure}")
+            if failures:
+                return 1
+            print(f"{len(CANONICAL_QUERIES)} canonical queries use an index")
+        return 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
@@ -0,0 +1,333 @@
+"""Append-only ledger of customer balance movements.
+
+Every change to a customer's ``credit`` or ``debt`` is written to
+``balance_ledger`` next to the ``$inc`` on the user document, with the reason
+(``sale``, ``sale_cancelled``, ``credit_add``, ``debt_payment``,
+``opening_balance``) and the id of the document that caused it. A unique index
+on (reason, source_id) stops the same movement from being posted twice.
+
+Once a day has passed, the balances of every customer who moved that day are
+written to ``balance_snapshots`` as of midnight UTC. A balance at any instant
+is then the latest snapshot before it plus the entries after it, and a monthly
+statement is one such balance plus that month's entries.
+
+``LedgerMaintenance`` takes the snapshots in the background and compares the
+ledger with the cached balances on ``users``. Balances that existed before the
+ledger need an opening entry first; the server posts them once at startup,
+or by hand:
+
+    python ledger.py init
+    python ledger.py snapshot
+    python ledger.py verify
+"""
+import asyncio
+import logging
+import os
+import sys
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from pymongo import DESCENDING, UpdateOne
+
+logger = logging.getLogger(__name__)
+
+BALANCE_FIELDS = ("credit", "debt")
+SNAPSHOT_COUNTER_ID = "ledger_snapshot"
+OPENING_COUNTER_ID = "ledger_opening"
+# Entries committed this long after their timestamp may still be in flight
+SNAPSHOT_GRACE = timedelta(minutes=10)
+DRIFT_TOLERANCE = 0.005
+
+
+def ledger_entry(user_id: str, change: Dict[str, float], reason: str, source_id: str,
+                 timestamp: Optional[str] = None) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        **{field: change.get(field, 0.0) for field in BALANCE_FIELDS},
+        "reason": reason,
+        "source_id": source_id,
+        "timestamp": timestamp or datetime.now(timezone.utc).isoformat(),
+    }
+
+
+async def record_movement(db, user_id: str, change: Dict[str, float], reason: str, source_id: str,
+                          session=None) -> dict:
+    # Raises DuplicateKeyError if this (reason, source_id) was already posted
+    entry = ledger_entry(user_id, change, reason, source_id)
+    await db.balance_ledger.insert_one(entry, session=session)
+    return entry
+
+
+async def record_movements(db, movements: List[dict], session=None) -> None:
+    """Insert many ledger_entry() dicts at once; the whole batch fails on a duplicate."""
+    if movements:
+        await db.balance_ledger.insert_many(movements, session=session)
+
+
+async def remove_movements(db, movements: List[dict]) -> None:
+    """Delete entries whose balance change was taken back; only for servers without transactions."""
+    if movements:
+        await db.balance_ledger.delete_many({"id": {"$in": [entry["id"] for entry in movements]}})
+
+
+def _day(value: datetime) -> datetime:
+    return value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _sums(group_id) -> dict:
+    return {"_id": group_id, **{field: {"$sum": f"${field}"} for field in BALANCE_FIELDS}, "entries": {"$sum": 1}}
+
+
+async def _latest_snapshots(db, user_ids: Optional[List[str]], before: str) -> Dict[str, dict]:
+    match = {"as_of": {"$lte": before}}
+    if user_ids is not None:
+        match["user_id"] = {"$in": user_ids}
+    rows = await db.balance_snapshots.aggregate([
+        {"$match": match},
+        {"$sort": {"user_id": 1, "as_of": -1}},
+        {"$group": {"_id": "$user_id", "as_of": {"$first": "$as_of"},
+                    **{field: {"$first": f"${field}"} for field in BALANCE_FIELDS}}},
+    ]).to_list(None)
+    return {row["_id"]: row for row in rows}
+
+
+async def snapshot_boundary(db) -> Optional[str]:
+    """Instant up to which every customer's balance is covered by a snapshot."""
+    doc = await db.counters.find_one({"_id": SNAPSHOT_COUNTER_ID})
+    return doc["as_of"] if doc else None
+
+
+async def take_snapshots(db, until: Optional[datetime] = None) -> int:
+    """Snapshot every whole UTC day that ended before ``until`` and is not covered yet."""
+    until = _day(until or datetime.now(timezone.utc) - SNAPSHOT_GRACE)
+    boundary = await snapshot_boundary(db)
+    if boundary:
+        day = datetime.fromisoformat(boundary)
+    else:
+        first = await db.balance_ledger.find_one({}, {"_id": 0, "timestamp": 1}, sort=[("timestamp", 1)])
+        if not first:
+            return 0
+        day = _day(datetime.fromisoformat(first["timestamp"]))
+
+    written = 0
+    while day < until:
+        start, end = day.isoformat(), (day + timedelta(days=1)).isoformat()
+        moved = await db.balance_ledger.aggregate([
+            {"$match": {"timestamp": {"$gte": start, "$lt": end}}},
+            {"$group": _sums("$user_id")},
+        ]).to_list(None)
+        previous = await _latest_snapshots(db, [row["_id"] for row in moved], start)
+        ops = []
+        for row in moved:
+            base = previous.get(row["_id"], {})
+            snapshot = {field: round(base.get(field, 0.0) + row[field], 2) for field in BALANCE_FIELDS}
+            ops.append(UpdateOne(
+                {"_id": f"{row['_id']}:{end}"},
+                {"$set": {"user_id": row["_id"], "as_of": end, **snapshot}},
+                upsert=True,
+            ))
+        if ops:
+            await db.balance_snapshots.bulk_write(ops, ordered=False)
+            written += len(ops)
+        # $max keeps a slower worker from moving the boundary backwards
+        await db.counters.update_one({"_id": SNAPSHOT_COUNTER_ID}, {"$max": {"as_of": end}}, upsert=True)
+        day += timedelta(days=1)
+    return written
+
+
+async def balance_as_of(db, user_id: str, at: datetime) -> Dict[str, float]:
+    at_iso = at.isoformat()
+    snapshot = await db.balance_snapshots.find_one(
+        {"user_id": user_id, "as_of": {"$lte": at_iso}}, {"_id": 0}, sort=[("as_of", DESCENDING)]
+    )
+    since = {"$gte": snapshot["as_of"]} if snapshot else {}
+    tail = await db.balance_ledger.aggregate([
+        {"$match": {"user_id": user_id, "timestamp": {**since, "$lt": at_iso}}},
+        {"$group": _sums(None)},
+    ]).to_list(None)
+    tail = tail[0] if tail else {}
+    return {field: round((snapshot or {}).get(field, 0.0) + tail.get(field, 0.0), 2) for field in BALANCE_FIELDS}
+
+
+async def statement(db, user_id: str, start: datetime, end: datetime) -> dict:
+    opening = await balance_as_of(db, user_id, start)
+    entries = await db.balance_ledger.find(
+        {"user_id": user_id, "timestamp": {"$gte": start.isoformat(), "$lt": end.isoformat()}},
+        {"_id": 0, "user_id": 0}
+    ).sort("timestamp", 1).to_list(None)
+    closing = dict(opening)
+    for entry in entries:
+        for field in BALANCE_FIELDS:
+            closing[field] += entry[field]
+    return {
+        "user_id": user_id,
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "opening": opening,
+        "entries": entries,
+        "closing": {field: round(value, 2) for field, value in closing.items()},
+    }
+
+
+async def find_drift(db) -> List[dict]:
+    """Users whose cached balances differ from the ledger (snapshot + tail)."""
+    boundary = await snapshot_boundary(db)
+    snapshots = await _latest_snapshots(db, None, boundary) if boundary else {}
+    tail_match = {"timestamp": {"$gte": boundary}} if boundary else {}
+    tails = {row["_id"]: row for row in await db.balance_ledger.aggregate([
+        {"$match": tail_match},
+        {"$group": _sums("$user_id")},
+    ]).to_list(None)}
+
+    suspects = []
+    async for user in db.users.find({}, {"_id": 0, "id": 1, "username": 1, **{f: 1 for f in BALANCE_FIELDS}}):
+        base, tail = snapshots.get(user["id"], {}), tails.get(user["id"], {})
+        ledger = {field: base.get(field, 0.0) + tail.get(field, 0.0) for field in BALANCE_FIELDS}
+        if any(abs(user.get(field, 0.0) - ledger[field]) > DRIFT_TOLERANCE for field in BALANCE_FIELDS):
+            suspects.append(user)
+
+    # The bulk reads above are not one snapshot in time; re-check each suspect
+    # on its own so a sale that landed in between is not reported.
+    drifted = []
+    now = datetime.now(timezone.utc) + timedelta(seconds=1)
+    for user in suspects:
+        ledger = await balance_as_of(db, user["id"], now)
+        cached = await db.users.find_one({"id": user["id"]}, {"_id": 0, **{f: 1 for f in BALANCE_FIELDS}}) or {}
+        if any(abs(cached.get(field, 0.0) - ledger[field]) > DRIFT_TOLERANCE for field in BALANCE_FIELDS):
+            drifted.append({
+                "user_id": user["id"],
+                "username": user.get("username"),
+                "cached": {field: cached.get(field, 0.0) for field in BALANCE_FIELDS},
+                "ledger": ledger,
+            })
+    return drifted
+
+
+async def _ledger_totals(db, user_id: str) -> dict:
+    rows = await db.balance_ledger.aggregate([
+        {"$match": {"user_id": user_id}},
+        {"$group": {**_sums(None), "first": {"$min": "$timestamp"}}},
+    ]).to_list(None)
+    return rows[0] if rows else {}
+
+
+async def post_opening_balances(db) -> int:
+    """Record what each user's balance held before the ledger, as an opening entry (once per user).
+
+    Movements posted since the ledger went live are already in the cached
+    balance, so only the difference is opening balance. It is dated just
+    before the user's first entry, and snapshots taken since then are
+    raised by it.
+    """
+    posted = 0
+    async for user in db.users.find({}, {"_id": 0, "id": 1}):
+        # Re-read until no movement lands between the ledger and balance reads
+        while True:
+            before = await _ledger_totals(db, user["id"])
+            cached = await db.users.find_one({"id": user["id"]}, {"_id": 0, **{f: 1 for f in BALANCE_FIELDS}}) or {}
+            if await _ledger_totals(db, user["id"]) == before:
+                break
+        change = {field: round(cached.get(field, 0.0) - before.get(field, 0.0), 2) for field in BALANCE_FIELDS}
+        if not any(change.values()):
+            continue
+        first = before.get("first")
+        timestamp = (datetime.fromisoformat(first) - timedelta(microseconds=1)).isoformat() if first else None
+        entry = ledger_entry(user["id"], change, "opening_balance", user["id"], timestamp)
+        result = await db.balance_ledger.update_one({"reason": "opening_balance", "source_id": user["id"]},
+                                                    {"$setOnInsert": entry}, upsert=True)
+        if result.upserted_id is None:
+            continue
+        await db.balance_snapshots.update_many({"user_id": user["id"], "as_of": {"$gt": entry["timestamp"]}},
+                                               {"$inc": change})
+        posted += 1
+    return posted
+
+
+async def ensure_opening_balances(db) -> Optional[int]:
+    """Run post_opening_balances once per database; None if it already ran."""
+    if await db.counters.find_one({"_id": OPENING_COUNTER_ID}):
+        return None
+    posted = await post_opening_balances(db)
+    await db.counters.update_one({"_id": OPENING_COUNTER_ID},
+                                 {"$set": {"at": datetime.now(timezone.utc).isoformat()}}, upsert=True)
+    return posted
+
+
+class LedgerMaintenance:
+    """Background snapshots plus a periodic drift check; the last report is kept for /stats/ledger."""
+
+    def __init__(self, db, interval: float = 3600):
+        self.db = db
+        self.interval = interval
+        self.last_run: Optional[str] = None
+        self.snapshots_written = 0
+        self.drift: List[dict] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def run_once(self) -> None:
+        self.snapshots_written += await take_snapshots(self.db)
+        self.drift = await find_drift(self.db)
+        self.last_run = datetime.now(timezone.utc).isoformat()
+        for row in self.drift:
+            logger.warning(f"Balance drift for user {row['user_id']}: cached {row['cached']}, ledger {row['ledger']}")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Ledger maintenance failed")
+            await asyncio.sleep(self.interval)
+
+    def stats(self) -> dict:
+        return {
+            "interval": self.interval,
+            "last_run": self.last_run,
+            "snapshots_written": self.snapshots_written,
+            "drift": self.drift,
+        }
+
+
+async def _main(argv) -> int:
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    if argv[:1] not in (["init"], ["snapshot"], ["verify"]):
+        print("usage: python ledger.py init|snapshot|verify")
+        return 2
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        if argv[0] == "init":
+            print(f"{await post_opening_balances(db)} opening balances recorded")
+        elif argv[0] == "snapshot":
+            print(f"{await take_snapshots(db)} snapshots written")
+        else:
+            drift = await find_drift(db)
+            for row in drift:
+                print(f"{row['user_id']} ({row['username']}): cached {row['cached']}, ledger {row['ledger']}")
+            print(f"{len(drift)} users drifted")
+            return 1 if drift else 0
+        return 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
@@ -0,0 +1,98 @@
+"""Low-stock tracking and stock-out projection.
+
+``LowStockTracker`` keeps the set of products at or below their
+``low_stock_threshold`` up to date from the write paths that touch stock, so
+``/stats/low-stock`` never scans the catalog. It follows the catalog version
+(see ``catalog.py``): as long as every bump it sees is one it applied itself
+the set is current; any gap means another worker changed products and the set
+is reloaded with a single server-side ``$expr`` query bounded by the
+``stock`` index. ``catalog_changed`` reads the written products and applies
+them under one lock, so two concurrent sales of a product cannot apply its
+stock out of order.
+
+Sales velocity for the stock-out projection comes from the daily product
+rollups (see ``rollups.py``), which are incremented right after the sale that
+changed the stock commits.
+"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional
+
+from pymongo import DESCENDING
+
+LOW_STOCK_QUERY = {"$expr": {"$lte": ["$stock", "$low_stock_threshold"]}}
+TRACKED_FIELDS = {"_id": 0, "id": 1, "name": 1, "category": 1, "price": 1, "stock": 1, "low_stock_threshold": 1}
+
+
+class LowStockTracker:
+    def __init__(self, db):
+        self.db = db
+        self._low: Dict[str, dict] = {}
+        # Catalog version the set reflects; None until loaded or after a gap
+        self.synced_version: Optional[int] = None
+        self._lock = asyncio.Lock()
+        self._changes = 0
+        self.reloads = 0
+
+    def apply(self, products: Iterable[dict]) -> None:
+        self._changes += 1
+        for product in products:
+            if product["stock"] <= product.get("low_stock_threshold", 10):
+                self._low[product["id"]] = {k: product.get(k) for k in TRACKED_FIELDS if k != "_id"}
+            else:
+                self._low.pop(product["id"], None)
+
+    def remove(self, product_id: str) -> None:
+        self._changes += 1
+        self._low.pop(product_id, None)
+
+    def advance(self, version: int) -> None:
+        self._changes += 1
+        if self.synced_version is not None and version == self.synced_version + 1:
+            self.synced_version = version
+        else:
+            self.synced_version = None
+
+    async def reload(self, version: int) -> None:
+        # No product can be low on stock above the highest threshold, which
+        # lets the `stock` index bound the scan before $expr is evaluated.
+        top = await self.db.products.find_one({}, {"_id": 0, "low_stock_threshold": 1},
+                                              sort=[("low_stock_threshold", DESCENDING)])
+        query = {"stock": {"$lte": top.get("low_stock_threshold", 10) if top else 0}, **LOW_STOCK_QUERY}
+        changes = self._changes
+        docs = await self.db.products.find(query, TRACKED_FIELDS).to_list(None)
+        self._low = {d["id"]: d for d in docs}
+        # A local write that landed mid-query may be missing from `docs`
+        self.synced_version = version if changes == self._changes else None
+        self.reloads += 1
+
+    async def get(self, version: int) -> List[dict]:
+        if self.synced_version is None or version > self.synced_version:
+            async with self._lock:
+                if self.synced_version is None or version > self.synced_version:
+                    await self.reload(version)
+        return sorted(self._low.values(), key=lambda p: (p["stock"] - p.get("low_stock_threshold", 10), p["name"]))
+
+
+async def projected_stockouts(db, window_days: int = 7) -> List[dict]:
+    today = datetime.now(timezone.utc).date()
+    since = (today - timedelta(days=window_days - 1)).isoformat()
+    sold = await db.sales_rollups.aggregate([
+        {"$match": {"dimension": "product", "granularity": "day", "bucket": {"$gte": since}}},
+        {"$group": {"_id": "$key", "quantity": {"$sum": "$quantity"}}},
+        {"$match": {"quantity": {"$gt": 0}}},
+    ]).to_list(None)
+    velocity = {row["_id"]: row["quantity"] / window_days for row in sold}
+    products = await db.products.find({"id": {"$in": list(velocity)}}, TRACKED_FIELDS).to_list(None)
+
+    projections = []
+    for product in products:
+        per_day = velocity[product["id"]]
+        days_left = max(product["stock"], 0) / per_day
+        projections.append({
+            **product,
+            "daily_velocity": round(per_day, 3),
+            "days_left": round(days_left, 1),
+            "projected_stockout": (today + timedelta(days=int(days_left))).isoformat(),
+        })
+    return sorted(projections, key=lambda p: p["days_left"])
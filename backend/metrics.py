@@ -0,0 +1,320 @@
+"""Per-route request metrics and Mongo command attribution, in Prometheus text format.
+
+``MetricsMiddleware`` resolves each request's route template up front, counts
+it as in flight, and records its latency and status when the response is
+done. While the request runs, a ``RequestStats`` object sits in a contextvar.
+Motor copies the context into the executor threads that run pymongo, so
+``MongoCommandListener`` can attribute every command, with its duration and
+the documents it returned, to the route that caused it. Commands issued
+outside a request (background workers) are filed under ``background``.
+
+``PoolListener`` keeps connection pool gauges per server for ``/metrics``
+and the readiness endpoint.
+
+Requests slower than ``slow_ms`` are logged with their command breakdown.
+Metrics are per process; with several workers, scrape each one.
+"""
+import contextvars
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from pymongo import monitoring
+from starlette.routing import Match
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COMMANDS_PER_REQUEST_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+BACKGROUND = "background"
+UNMATCHED = "unmatched"
+
+
+class RequestStats:
+    __slots__ = ("method", "route", "commands")
+
+    def __init__(self, method: str, route: str):
+        self.method = method
+        self.route = route
+        # (command, collection, seconds, documents, ok)
+        self.commands: List[Tuple[str, str, float, int, bool]] = []
+
+
+_current: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar("request_stats", default=None)
+
+
+def current_route() -> Optional[str]:
+    """Route template of the request being handled, once ``MetricsMiddleware`` has resolved it."""
+    stats = _current.get()
+    return stats.route if stats else None
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+def _labels(**labels) -> str:
+    def escape(value) -> str:
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def _histogram_lines(name: str, histogram: Histogram, labels: dict) -> List[str]:
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f"{name}_bucket{_labels(**labels, le=bound)} {cumulative}")
+    lines.append(f"{name}_bucket{_labels(**labels, le='+Inf')} {histogram.count}")
+    lines.append(f"{name}_sum{_labels(**labels)} {histogram.sum:.6f}")
+    lines.append(f"{name}_count{_labels(**labels)} {histogram.count}")
+    return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        # Command events arrive on Motor's executor threads
+        self._lock = threading.Lock()
+        self.latency: Dict[Tuple[str, str], Histogram] = {}
+        self.commands_per_request: Dict[Tuple[str, str], Histogram] = {}
+        self.requests: Dict[Tuple[str, str, int], int] = defaultdict(int)
+        self.in_flight: Dict[Tuple[str, str], int] = defaultdict(int)
+        # (route, command, collection) -> [count, seconds, documents, failures]
+        self.mongo: Dict[Tuple[str, str, str], List[float]] = {}
+        # server address -> open/checked_out gauges and lifetime counters
+        self.pools: Dict[str, Dict[str, int]] = {}
+
+    def pool_event(self, address, **changes: int) -> None:
+        key = f"{address[0]}:{address[1]}" if isinstance(address, tuple) else str(address)
+        with self._lock:
+            pool = self.pools.get(key)
+            if pool is None:
+                pool = self.pools[key] = {"open": 0, "checked_out": 0, "created": 0, "closed": 0,
+                                          "checkout_failures": 0, "cleared": 0}
+            for name, delta in changes.items():
+                pool[name] += delta
+
+    def pool_stats(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {address: dict(pool) for address, pool in self.pools.items()}
+
+    def request_started(self, stats: RequestStats) -> None:
+        with self._lock:
+            self.in_flight[(stats.method, stats.route)] += 1
+
+    def request_finished(self, stats: RequestStats, status: int, seconds: float) -> None:
+        key = (stats.method, stats.route)
+        with self._lock:
+            self.in_flight[key] -= 1
+            self.requests[(*key, status)] += 1
+            if key not in self.latency:
+                self.latency[key] = Histogram(LATENCY_BUCKETS)
+                self.commands_per_request[key] = Histogram(COMMANDS_PER_REQUEST_BUCKETS)
+            self.latency[key].observe(seconds)
+            self.commands_per_request[key].observe(len(stats.commands))
+
+    def command(self, route: str, command: str, collection: str, seconds: float, documents: int, ok: bool) -> None:
+        key = (route, command, collection)
+        with self._lock:
+            entry = self.mongo.get(key)
+            if entry is None:
+                entry = self.mongo[key] = [0, 0.0, 0, 0]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] += documents
+            if not ok:
+                entry[3] += 1
+
+    def render(self) -> str:
+        with self._lock:
+            lines = [
+                "# HELP http_requests_in_flight Requests currently being handled.",
+                "# TYPE http_requests_in_flight gauge",
+            ]
+            lines += [f"http_requests_in_flight{_labels(method=m, route=r)} {n}"
+                      for (m, r), n in sorted(self.in_flight.items())]
+            lines += ["# HELP http_requests_total Requests handled, by status code.",
+                      "# TYPE http_requests_total counter"]
+            lines += [f"http_requests_total{_labels(method=m, route=r, status=s)} {n}"
+                      for (m, r, s), n in sorted(self.requests.items())]
+            lines += ["# HELP http_request_duration_seconds Request latency.",
+                      "# TYPE http_request_duration_seconds histogram"]
+            for (m, r), histogram in sorted(self.latency.items()):
+                lines += _histogram_lines("http_request_duration_seconds", histogram, {"method": m, "route": r})
+            lines += ["# HELP http_request_mongo_commands Mongo commands issued per request.",
+                      "# TYPE http_request_mongo_commands histogram"]
+            for (m, r), histogram in sorted(self.commands_per_request.items()):
+                lines += _histogram_lines("http_request_mongo_commands", histogram, {"method": m, "route": r})
+
+            mongo = sorted(self.mongo.items())
+            for name, index, kind, help_text in (
+                ("mongo_commands_total", 0, "counter", "Mongo commands, by originating route."),
+                ("mongo_command_seconds_total", 1, "counter", "Time spent in Mongo commands."),
+                ("mongo_documents_returned_total", 2, "counter", "Documents returned by find/aggregate/getMore."),
+                ("mongo_command_failures_total", 3, "counter", "Mongo commands that failed."),
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                for (route, command, collection), entry in mongo:
+                    value = f"{entry[index]:.6f}" if index == 1 else str(int(entry[index]))
+                    lines.append(f"{name}{_labels(route=route, command=command, collection=collection)} {value}")
+
+            for name, field, kind, help_text in (
+                ("mongo_pool_connections", "open", "gauge", "Open connections in the driver pool."),
+                ("mongo_pool_checked_out", "checked_out", "gauge", "Connections currently checked out."),
+                ("mongo_pool_checkout_failures_total", "checkout_failures", "counter",
+                 "Connection check-outs that failed (e.g. wait queue timeout)."),
+                ("mongo_pool_cleared_total", "cleared", "counter", "Times the pool was cleared after an error."),
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                lines += [f"{name}{_labels(address=address)} {pool[field]}" for address, pool in sorted(self.pools.items())]
+        return "\n".join(lines) + "\n"
+
+
+def _documents(reply) -> int:
+    cursor = reply.get("cursor") if isinstance(reply, dict) else None
+    if isinstance(cursor, dict):
+        return len(cursor.get("firstBatch") or cursor.get("nextBatch") or [])
+    return 0
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    def __init__(self, registry: MetricsRegistry):
+        self.registry = registry
+        self._collections: Dict[Tuple, str] = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            collection = event.command.get("collection")
+        self._collections[(event.connection_id, event.request_id)] = (
+            collection if isinstance(collection, str) else ""
+        )
+
+    def _finish(self, event, reply, ok: bool) -> None:
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        seconds = event.duration_micros / 1e6
+        documents = _documents(reply) if ok else 0
+        stats = _current.get()
+        if stats is not None:
+            stats.commands.append((event.command_name, collection, seconds, documents, ok))
+        self.registry.command(stats.route if stats else BACKGROUND, event.command_name, collection, seconds,
+                              documents, ok)
+
+    def succeeded(self, event):
+        self._finish(event, event.reply, True)
+
+    def failed(self, event):
+        self._finish(event, None, False)
+
+
+class PoolListener(monitoring.ConnectionPoolListener):
+    def __init__(self, registry: MetricsRegistry):
+        self.registry = registry
+
+    def pool_created(self, event):
+        self.registry.pool_event(event.address)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.registry.pool_event(event.address, cleared=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.registry.pool_event(event.address, open=1, created=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.registry.pool_event(event.address, open=-1, closed=1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.registry.pool_event(event.address, checkout_failures=1)
+
+    def connection_checked_out(self, event):
+        self.registry.pool_event(event.address, checked_out=1)
+
+    def connection_checked_in(self, event):
+        self.registry.pool_event(event.address, checked_out=-1)
+
+
+def command_breakdown(commands: List[Tuple[str, str, float, int, bool]]) -> str:
+    grouped: Dict[Tuple[str, str], List[float]] = {}
+    for command, collection, seconds, documents, ok in commands:
+        entry = grouped.setdefault((command, collection), [0, 0.0, 0])
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] += documents
+    return "; ".join(
+        f"{f'{command} {collection}'.strip()} x{int(n)} {secs * 1000:.1f}ms {int(docs)} docs"
+        for (command, collection), (n, secs, docs) in sorted(grouped.items(), key=lambda i: -i[1][1])
+    )
+
+
+class MetricsMiddleware:
+    def __init__(self, app, registry: MetricsRegistry, routes, slow_ms: float = 0):
+        self.app = app
+        self.registry = registry
+        self.routes = routes
+        self.slow_ms = slow_ms
+
+    def _route(self, scope) -> str:
+        # A partial match is a path hit with another method (405, CORS preflight)
+        partial = None
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return getattr(route, "path", UNMATCHED)
+            if match == Match.PARTIAL and partial is None:
+                partial = getattr(route, "path", None)
+        return partial or UNMATCHED
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = RequestStats(scope["method"], self._route(scope))
+        token = _current.set(stats)
+        self.registry.request_started(stats)
+        status = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            seconds = time.perf_counter() - start
+            _current.reset(token)
+            self.registry.request_finished(stats, status, seconds)
+            if self.slow_ms and seconds * 1000 >= self.slow_ms:
+                logger.warning(
+                    f"Slow request {stats.method} {stats.route} -> {status} in {seconds * 1000:.0f}ms, "
+                    f"{len(stats.commands)} Mongo commands: {command_breakdown(stats.commands) or 'none'}"
+                )
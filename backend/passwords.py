@@ -0,0 +1,81 @@
+"""bcrypt hashing on a bounded worker pool.
+
+bcrypt is deliberately slow (~250 ms at cost 12) and the ``bcrypt`` package
+releases the GIL while hashing, so running it on a small thread pool keeps the
+event loop free for every other request. ``max_pending`` bounds how many
+calls may wait for a worker; beyond that ``PasswordHasherBusy`` is raised so
+callers can shed load instead of queueing without limit.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+
+from passlib.context import CryptContext
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, rounds: int = 12, workers: int = 4, max_pending: int = 64):
+        # Any hash with a different cost is reported by verify_and_update as
+        # needing a rehash, so changing `rounds` migrates users on login.
+        self.context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=rounds)
+        self.rounds = rounds
+        self.workers = workers
+        self.max_pending = max_pending
+        # workers == 0 hashes inline on the event loop (the old behaviour);
+        # kept for benchmarking and single-user tooling.
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt") if workers > 0 else None
+        self._slots = asyncio.Semaphore(max(workers, 1))
+        self.pending = 0
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+        self.rehashed = 0
+
+    async def _run(self, fn, *args):
+        if self._executor is None:
+            return fn(*args)
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise PasswordHasherBusy()
+        self.pending += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.pending -= 1
+        self.active += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.active -= 1
+            self.completed += 1
+            self._slots.release()
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self.context.hash, password)
+
+    async def verify(self, password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+        """Return (valid, new_hash); new_hash is set when the stored cost is outdated."""
+        valid, new_hash = await self._run(self.context.verify_and_update, password, hashed)
+        if new_hash:
+            self.rehashed += 1
+        return valid, new_hash
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "rounds": self.rounds,
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "queue_depth": self.pending,
+            "active": self.active,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "rehashed": self.rehashed,
+        }
+
+    def shutdown(self) -> None:
+        if self._executor:
+            self._executor.shutdown(wait=False)
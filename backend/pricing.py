@@ -0,0 +1,164 @@
+"""Server-side cart pricing from each product's ``volume_pricing`` tiers.
+
+A tier ``{"min_qty": 10, "price": 4.0}`` sets the unit price for every unit
+of a product once the cart holds at least 10 of it; below the lowest tier the
+product's own ``price`` applies. Quantities of the same product on several
+cart lines count together.
+
+``PriceBook`` compiles the tiers of every product into sorted ``min_qty`` /
+price tuples searched with ``bisect``. It follows the catalog version like
+``LowStockTracker`` (see ``low_stock.py``): ``catalog_changed`` hands it the
+written products, so a sale only recompiles the products it sold, and a
+version it did not see applied reloads the tables from ``products``.
+"""
+import asyncio
+import logging
+from bisect import bisect_right
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Client totals within this of the server's are accepted
+PRICE_TOLERANCE = 0.005
+
+PRICING_FIELDS = {"_id": 0, "id": 1, "name": 1, "price": 1, "volume_pricing": 1, "stock": 1}
+
+
+def normalize_tiers(tiers: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Validate tiers and return them sorted by min_qty; raises ValueError."""
+    normalized = []
+    for tier in tiers:
+        try:
+            min_qty, price = tier["min_qty"], tier["price"]
+        except (KeyError, TypeError):
+            raise ValueError("each tier needs min_qty and price")
+        if isinstance(min_qty, bool) or not isinstance(min_qty, (int, float)) or min_qty != int(min_qty) or min_qty < 1:
+            raise ValueError(f"min_qty must be a positive integer, got {min_qty!r}")
+        if isinstance(price, bool) or not isinstance(price, (int, float)) or price < 0:
+            raise ValueError(f"price must be a non-negative number, got {price!r}")
+        normalized.append({"min_qty": int(min_qty), "price": float(price)})
+    normalized.sort(key=lambda tier: tier["min_qty"])
+    for previous, tier in zip(normalized, normalized[1:]):
+        if previous["min_qty"] == tier["min_qty"]:
+            raise ValueError(f"two tiers for min_qty {tier['min_qty']}")
+    return normalized
+
+
+class PriceTable(NamedTuple):
+    name: str
+    price: float
+    min_qtys: Tuple[int, ...]
+    prices: Tuple[float, ...]
+    stock: int
+
+    def unit_price(self, quantity: int) -> Tuple[float, Optional[int]]:
+        """Unit price for ``quantity`` units and the min_qty of the tier applied."""
+        i = bisect_right(self.min_qtys, quantity)
+        if i == 0:
+            return self.price, None
+        return self.prices[i - 1], self.min_qtys[i - 1]
+
+
+def compile_product(product: dict) -> PriceTable:
+    try:
+        tiers = normalize_tiers(product.get("volume_pricing") or [])
+    except ValueError as e:
+        logger.warning(f"Ignoring volume pricing of product {product['id']}: {e}")
+        tiers = []
+    return PriceTable(
+        product.get("name", ""),
+        float(product["price"]),
+        tuple(tier["min_qty"] for tier in tiers),
+        tuple(tier["price"] for tier in tiers),
+        product.get("stock", 0),
+    )
+
+
+class UnknownProducts(Exception):
+    def __init__(self, product_ids: List[str]):
+        super().__init__(f"Unknown products: {', '.join(product_ids)}")
+        self.product_ids = product_ids
+
+
+class Quote(NamedTuple):
+    catalog_version: int
+    lines: List[dict]
+    total: float
+
+    def as_dict(self) -> dict:
+        return {"catalog_version": self.catalog_version, "lines": self.lines, "total": self.total}
+
+
+class PriceBook:
+    def __init__(self, db):
+        self.db = db
+        self._tables: Dict[str, PriceTable] = {}
+        self.synced_version: Optional[int] = None
+        self._lock = asyncio.Lock()
+        self._changes = 0
+        self.reloads = 0
+
+    def apply(self, products: Iterable[dict]) -> None:
+        self._changes += 1
+        self._apply(products)
+
+    def _apply(self, products: Iterable[dict]) -> None:
+        for product in products:
+            self._tables[product["id"]] = compile_product(product)
+
+    def remove(self, product_id: str) -> None:
+        self._changes += 1
+        self._tables.pop(product_id, None)
+
+    def advance(self, version: int) -> None:
+        self._changes += 1
+        if self.synced_version is not None and version == self.synced_version + 1:
+            self.synced_version = version
+        else:
+            self.synced_version = None
+
+    async def reload(self, version: int) -> None:
+        changes = self._changes
+        docs = await self.db.products.find({}, PRICING_FIELDS).to_list(None)
+        self._tables = {}
+        self._apply(docs)
+        # A local write that landed mid-query may be missing from `docs`
+        self.synced_version = version if changes == self._changes else None
+        self.reloads += 1
+
+    async def tables(self, version: int) -> Dict[str, PriceTable]:
+        if self.synced_version is None or version > self.synced_version:
+            async with self._lock:
+                if self.synced_version is None or version > self.synced_version:
+                    await self.reload(version)
+        return self._tables
+
+    async def quote(self, version: int, items: Iterable[Tuple[str, int]]) -> Quote:
+        """Price (product_id, quantity) lines at catalog ``version``; raises UnknownProducts."""
+        items = list(items)
+        tables = await self.tables(version)
+        missing = [pid for pid, _ in items if pid not in tables]
+        if missing:
+            raise UnknownProducts(list(dict.fromkeys(missing)))
+
+        quantities: Dict[str, int] = {}
+        for pid, quantity in items:
+            quantities[pid] = quantities.get(pid, 0) + quantity
+        lines = []
+        for pid, quantity in items:
+            table = tables[pid]
+            unit_price, tier = table.unit_price(quantities[pid])
+            lines.append({
+                "product_id": pid,
+                "name": table.name,
+                "quantity": quantity,
+                "base_price": table.price,
+                "unit_price": unit_price,
+                "tier_min_qty": tier,
+                "line_total": round(unit_price * quantity, 2),
+                "in_stock": table.stock >= quantities[pid],
+            })
+        return Quote(version, lines, round(sum(line["line_total"] for line in lines), 2))
+
+    def stats(self) -> dict:
+        return {"catalog_version": self.synced_version, "products": len(self._tables), "reloads": self.reloads}
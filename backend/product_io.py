@@ -0,0 +1,184 @@
+"""Streaming product import and export.
+
+Imports read the request body chunk by chunk, as CSV (header row required) or
+NDJSON, and validate each row with ``ProductCreate``. Rows are upserted with
+one ``bulk_write`` per batch. Only the columns a row actually has are
+``$set``, so a price list with ``name,price,stock`` leaves categories and
+images alone; defaults are applied only when the row creates a product.
+Exports write one row per document as the cursor yields it.
+
+``volume_pricing`` is a JSON array in CSV files.
+"""
+import codecs
+import csv
+import io
+import json
+import uuid
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Type
+
+from pydantic import BaseModel, ValidationError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+EXPORT_FIELDS = ["id", "name", "price", "stock", "low_stock_threshold", "category", "image_url", "thumbnail_url",
+                 "volume_pricing"]
+MAX_REPORTED_ERRORS = 1000
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line + "\n"
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+async def _csv_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[dict]:
+    # A record may span lines inside quotes; it is complete once its quotes balance
+    header = None
+    record = ""
+    async for line in _lines(chunks):
+        record += line
+        if record.count('"') % 2:
+            continue
+        values = next(csv.reader([record]), [])
+        record = ""
+        if not any(v.strip() for v in values):
+            continue
+        if header is None:
+            header = [v.strip() for v in values]
+            continue
+        yield {k: v for k, v in zip(header, values) if k and v.strip() != ""}
+    if record.strip():
+        raise ValueError("Unterminated quoted field at end of file")
+
+
+def _from_csv(row: dict) -> dict:
+    if "volume_pricing" in row:
+        row["volume_pricing"] = json.loads(row["volume_pricing"])
+    return row
+
+
+async def _ndjson_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    async for line in _lines(chunks):
+        if line.strip():
+            yield line
+
+
+async def import_products(
+    db,
+    chunks: AsyncIterator[bytes],
+    fmt: str,
+    model: Type[BaseModel],
+    key: str = "id",
+    batch_size: int = 500,
+    prepare: Optional[Callable[[dict], Awaitable[dict]]] = None,
+    on_batch: Optional[Callable[[dict], Awaitable[None]]] = None,
+) -> dict:
+    """Upsert products matched on ``key`` ("id" or "name").
+
+    ``prepare`` may rewrite a validated row (e.g. move an inline image to the
+    blob store); ``on_batch`` receives a filter matching the products a batch
+    wrote, so callers can refresh derived state.
+    """
+    report = {"processed": 0, "inserted": 0, "updated": 0, "unchanged": 0, "error_count": 0, "errors": []}
+
+    def fail(row_number: int, errors: List[str]) -> None:
+        report["error_count"] += 1
+        if len(report["errors"]) < MAX_REPORTED_ERRORS:
+            report["errors"].append({"row": row_number, "errors": errors})
+
+    async def flush(ops: List[UpdateOne], rows: List[int], keys: List[str]) -> None:
+        try:
+            result = await db.products.bulk_write(ops, ordered=False)
+            details = result.bulk_api_result
+        except BulkWriteError as e:
+            details = e.details
+            for error in details.get("writeErrors", []):
+                fail(rows[error["index"]], [error.get("errmsg", "write failed")])
+        report["inserted"] += details.get("nUpserted", 0)
+        report["updated"] += details.get("nModified", 0)
+        report["unchanged"] += details.get("nMatched", 0) - details.get("nModified", 0)
+        if on_batch:
+            await on_batch({key: {"$in": keys}})
+
+    records = _csv_records(chunks) if fmt == "csv" else _ndjson_records(chunks)
+    ops: List[UpdateOne] = []
+    rows: List[int] = []
+    keys: List[str] = []
+    row_number = 0
+    while True:
+        row_number += 1
+        try:
+            record = await records.__anext__()
+        except StopAsyncIteration:
+            break
+        except (ValueError, csv.Error) as e:
+            fail(row_number, [f"Could not parse row: {e}"])
+            break
+        report["processed"] += 1
+        try:
+            raw = _from_csv(record) if fmt == "csv" else json.loads(record)
+        except ValueError as e:
+            fail(row_number, [f"Could not parse row: {e}"])
+            continue
+        if not isinstance(raw, dict):
+            fail(row_number, ["Row must be an object"])
+            continue
+        try:
+            product = model.model_validate(raw)
+        except ValidationError as e:
+            fail(row_number, [f"{'.'.join(str(p) for p in err['loc'])}: {err['msg']}" for err in e.errors()])
+            continue
+        doc = product.model_dump()
+        if prepare:
+            try:
+                doc = await prepare(doc)
+            except ValueError as e:
+                fail(row_number, [str(e)])
+                continue
+
+        match_value = raw.get(key) if key == "id" else doc["name"]
+        given = {field: doc[field] for field in doc if field in raw}
+        if "image_url" in raw and "thumbnail_url" in doc:
+            given["thumbnail_url"] = doc["thumbnail_url"]
+        defaults: Dict[str, object] = {field: value for field, value in doc.items() if field not in given}
+        if key == "id":
+            match_value = match_value or str(uuid.uuid4())
+            defaults["id"] = match_value
+        else:
+            defaults["id"] = str(uuid.uuid4())
+        ops.append(UpdateOne({key: match_value}, {"$set": given, "$setOnInsert": defaults}, upsert=True))
+        rows.append(row_number)
+        keys.append(match_value)
+        if len(ops) >= batch_size:
+            await flush(ops, rows, keys)
+            ops, rows, keys = [], [], []
+    if ops:
+        await flush(ops, rows, keys)
+    return report
+
+
+def _csv_line(values: list) -> str:
+    out = io.StringIO()
+    csv.writer(out, lineterminator="\n").writerow(values)
+    return out.getvalue()
+
+
+async def export_products(db, fmt: str, batch_size: int = 500) -> AsyncIterator[str]:
+    cursor = db.products.find({}, {"_id": 0}).sort("id", 1).batch_size(batch_size)
+    if fmt == "csv":
+        yield _csv_line(EXPORT_FIELDS)
+    async for doc in cursor:
+        if fmt == "csv":
+            yield _csv_line([
+                json.dumps(doc.get(field, [])) if field == "volume_pricing" else doc.get(field, "")
+                for field in EXPORT_FIELDS
+            ])
+        else:
+            yield json.dumps(doc, ensure_ascii=False) + "\n"
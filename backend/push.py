@@ -0,0 +1,377 @@
+"""Web Push delivery engine.
+
+``POST /push/send`` only records a job in ``push_jobs``; a bounded pool of
+asyncio workers claims queued jobs, streams the target users in id order,
+looks up their subscriptions batch by batch and delivers each message over a
+shared HTTP connection pool. Transient failures (429, 5xx, network errors) are
+retried with exponential backoff; subscriptions the push service reports as
+gone (404/410) are deleted. Progress is written back to the job document after
+every batch, together with the last user id processed, so a job whose worker
+died is resumed by another worker once its lease expires. The worker renews
+its lease in the background while it delivers, Retry-After waits included,
+and every write it makes to the job checks it still holds the lease; a worker
+that lost it stops.
+
+Payloads are encrypted per RFC 8291 (aes128gcm) and signed with VAPID (RFC
+8292) when ``VAPID_PRIVATE_KEY`` is set. Subscriptions without keys, such as
+those of a local stand-in endpoint used in testing, receive an empty body.
+"""
+import asyncio
+import base64
+import json
+import logging
+import os
+import random
+import struct
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+import jwt
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from pymongo import ASCENDING, ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+RECORD_SIZE = 4096
+
+
+def b64url_decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+
+def b64url_encode(value: bytes) -> str:
+    return base64.urlsafe_b64encode(value).decode().rstrip("=")
+
+
+def _hkdf(salt: bytes, info: bytes, length: int, ikm: bytes) -> bytes:
+    return HKDF(algorithm=hashes.SHA256(), length=length, salt=salt, info=info).derive(ikm)
+
+
+def encrypt_payload(payload: bytes, p256dh: str, auth: str) -> bytes:
+    """Encrypt a push message body for one subscription (RFC 8291, aes128gcm)."""
+    ua_public = b64url_decode(p256dh)
+    auth_secret = b64url_decode(auth)
+    ua_key = ec.EllipticCurvePublicKey.from_encoded_point(ec.SECP256R1(), ua_public)
+
+    as_private = ec.generate_private_key(ec.SECP256R1())
+    as_public = as_private.public_key().public_bytes(
+        serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+    )
+    shared_secret = as_private.exchange(ec.ECDH(), ua_key)
+    ikm = _hkdf(auth_secret, b"WebPush: info\x00" + ua_public + as_public, 32, shared_secret)
+
+    salt = os.urandom(16)
+    cek = _hkdf(salt, b"Content-Encoding: aes128gcm\x00", 16, ikm)
+    nonce = _hkdf(salt, b"Content-Encoding: nonce\x00", 12, ikm)
+    ciphertext = AESGCM(cek).encrypt(nonce, payload + b"\x02", None)
+    header = salt + struct.pack("!IB", RECORD_SIZE, len(as_public)) + as_public
+    return header + ciphertext
+
+
+class Vapid:
+    def __init__(self, private_key: str, subject: str):
+        if "BEGIN" in private_key:
+            self.key = serialization.load_pem_private_key(private_key.encode(), password=None)
+        else:
+            self.key = ec.derive_private_key(int.from_bytes(b64url_decode(private_key), "big"), ec.SECP256R1())
+        self.subject = subject
+        self.public_key = b64url_encode(self.key.public_key().public_bytes(
+            serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+        ))
+        self._tokens: Dict[str, Tuple[float, str]] = {}
+
+    def authorization(self, endpoint: str) -> str:
+        parts = urlsplit(endpoint)
+        audience = f"{parts.scheme}://{parts.netloc}"
+        expires_at, token = self._tokens.get(audience, (0.0, ""))
+        # Tokens are valid for 12h; reuse them for an hour per push service
+        if expires_at - time.time() < 11 * 3600:
+            expires_at = time.time() + 12 * 3600
+            token = jwt.encode({"aud": audience, "exp": int(expires_at), "sub": self.subject}, self.key, algorithm="ES256")
+            self._tokens[audience] = (expires_at, token)
+        return f"vapid t={token}, k={self.public_key}"
+
+
+class WebPushSender:
+    def __init__(self, http: httpx.AsyncClient, vapid: Optional[Vapid] = None, ttl: int = 86400):
+        self.http = http
+        self.vapid = vapid
+        self.ttl = ttl
+
+    async def send(self, subscription: Dict[str, Any], payload: bytes) -> httpx.Response:
+        endpoint = subscription["endpoint"]
+        headers = {"TTL": str(self.ttl)}
+        keys = subscription.get("keys") or {}
+        body = b""
+        if keys.get("p256dh") and keys.get("auth"):
+            body = encrypt_payload(payload, keys["p256dh"], keys["auth"])
+            headers["Content-Encoding"] = "aes128gcm"
+            headers["Content-Type"] = "application/octet-stream"
+        if self.vapid:
+            headers["Authorization"] = self.vapid.authorization(endpoint)
+        return await self.http.post(endpoint, content=body, headers=headers)
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def target_query(target_type: str, target_role: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    if target_type == "all_users":
+        return {"notifications_enabled": True}
+    if target_type == "role":
+        return {"role": target_role, "notifications_enabled": True}
+    if target_type == "debtors":
+        return {"debt": {"$gt": 0}, "notifications_enabled": True}
+    return None
+
+
+class PushDeliveryEngine:
+    def __init__(self, db, workers: int = 2, batch_size: int = 500, concurrency: int = 50,
+                 max_retries: int = 3, backoff: float = 0.5, lease_seconds: int = 60,
+                 vapid: Optional[Vapid] = None, ttl: int = 86400):
+        self.db = db
+        self.workers = workers
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.lease_seconds = lease_seconds
+        self.vapid = vapid
+        self.ttl = ttl
+        self.sender: Optional[WebPushSender] = None
+        self._http: Optional[httpx.AsyncClient] = None
+        self._tasks: List[asyncio.Task] = []
+        self._wake = asyncio.Event()
+
+    @property
+    def jobs(self):
+        return self.db.push_jobs
+
+    async def start(self) -> None:
+        self._http = httpx.AsyncClient(
+            timeout=10.0,
+            limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+        )
+        self.sender = WebPushSender(self._http, self.vapid, self.ttl)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._http:
+            await self._http.aclose()
+
+    async def enqueue(self, message: str, target_type: str, target_role: Optional[str],
+                      target_user_ids: Optional[List[str]], created_by: str) -> dict:
+        now = datetime.now(timezone.utc).isoformat()
+        job = {
+            "id": str(uuid.uuid4()),
+            "message": message,
+            "target_type": target_type,
+            "target_role": target_role,
+            "target_user_ids": sorted(set(target_user_ids or [])),
+            "status": "queued",
+            "created_by": created_by,
+            "created_at": now,
+            "started_at": None,
+            "finished_at": None,
+            "lease_until": None,
+            "lease_owner": None,
+            "last_user_id": None,
+            "users": 0,
+            "subscriptions": 0,
+            "sent": 0,
+            "failed": 0,
+            "pruned": 0,
+            "retries": 0,
+            "error": None,
+        }
+        await self.jobs.insert_one(dict(job))
+        self._wake.set()
+        return job
+
+    def _lease_until(self) -> str:
+        return (datetime.now(timezone.utc) + timedelta(seconds=self.lease_seconds)).isoformat()
+
+    async def _claim(self) -> Optional[dict]:
+        now = datetime.now(timezone.utc)
+        job = await self.jobs.find_one_and_update(
+            {"$or": [
+                {"status": "queued"},
+                {"status": "running", "lease_until": {"$lt": now.isoformat()}},
+            ]},
+            {"$set": {
+                "status": "running",
+                "lease_until": self._lease_until(),
+                "lease_owner": str(uuid.uuid4()),
+            }},
+            sort=[("created_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+        if job:
+            job.pop("_id", None)
+        return job
+
+    async def _worker(self) -> None:
+        while True:
+            try:
+                job = await self._claim()
+            except Exception as e:
+                logger.warning(f"Could not claim push job: {e}")
+                job = None
+            if job is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=self.lease_seconds / 2)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except LeaseLost:
+                logger.warning(f"Push job {job['id']} was taken over by another worker")
+            except Exception as e:
+                logger.exception(f"Push job {job['id']} failed")
+                await self.jobs.update_one(self._owned(job), {"$set": {
+                    "status": "failed",
+                    "error": str(e),
+                    "finished_at": datetime.now(timezone.utc).isoformat(),
+                }})
+
+    async def _user_batches(self, job: dict) -> AsyncIterator[List[str]]:
+        after = job.get("last_user_id")
+        if job["target_type"] == "manual":
+            ids = [i for i in job["target_user_ids"] if after is None or i > after]
+            for start in range(0, len(ids), self.batch_size):
+                yield ids[start:start + self.batch_size]
+            return
+        query = dict(target_query(job["target_type"], job.get("target_role")) or {"id": None})
+        if after is not None:
+            query["id"] = {"$gt": after}
+        cursor = self.db.users.find(query, {"_id": 0, "id": 1}).sort("id", ASCENDING).batch_size(self.batch_size)
+        batch = []
+        async for user in cursor:
+            batch.append(user["id"])
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    async def _deliver(self, subscription: Dict[str, Any], payload: bytes, slots: asyncio.Semaphore) -> Tuple[str, int]:
+        # Returns (outcome, retries) with outcome one of sent / failed / gone
+        retries = 0
+        async with slots:
+            while True:
+                delay = self.backoff * (2 ** retries) * (0.5 + random.random())
+                try:
+                    response = await self.sender.send(subscription, payload)
+                except (KeyError, TypeError, ValueError):
+                    # Malformed subscription data; retrying will not help
+                    return "failed", retries
+                except httpx.HTTPError:
+                    response = None
+                if response is not None:
+                    status = response.status_code
+                    if status < 300:
+                        return "sent", retries
+                    if status in (404, 410):
+                        return "gone", retries
+                    if status != 429 and status < 500:
+                        return "failed", retries
+                    retry_after = response.headers.get("retry-after", "")
+                    if retry_after.isdigit():
+                        delay = min(float(retry_after), 30.0)
+                if retries >= self.max_retries:
+                    return "failed", retries
+                retries += 1
+                await asyncio.sleep(delay)
+
+    def _owned(self, job: dict) -> dict:
+        return {"id": job["id"], "lease_owner": job["lease_owner"]}
+
+    async def _update(self, job: dict, update: dict) -> None:
+        result = await self.jobs.update_one(self._owned(job), update)
+        if result.matched_count == 0:
+            raise LeaseLost()
+
+    async def _keep_lease(self, job: dict) -> None:
+        # Returns once the lease has gone to another worker
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            result = await self.jobs.update_one(self._owned(job), {"$set": {"lease_until": self._lease_until()}})
+            if result.matched_count == 0:
+                return
+
+    async def _run(self, job: dict) -> None:
+        work = asyncio.create_task(self._deliver_job(job))
+        keeper = asyncio.create_task(self._keep_lease(job))
+        try:
+            await asyncio.wait([work, keeper], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            keeper.cancel()
+            if not work.done():
+                work.cancel()
+            await asyncio.gather(work, keeper, return_exceptions=True)
+        if work.cancelled():
+            raise LeaseLost()
+        work.result()
+
+    async def _deliver_job(self, job: dict) -> None:
+        if not job.get("started_at"):
+            job["started_at"] = datetime.now(timezone.utc).isoformat()
+            await self._update(job, {"$set": {"started_at": job["started_at"]}})
+        payload = json.dumps({"message": job["message"], "job_id": job["id"]}).encode()
+        slots = asyncio.Semaphore(self.concurrency)
+        async for user_ids in self._user_batches(job):
+            subscriptions = await self.db.push_subscriptions.find(
+                {"user_id": {"$in": user_ids}}, {"_id": 0, "id": 1, "subscription_data": 1}
+            ).to_list(None)
+            results = await asyncio.gather(*[
+                self._deliver(s["subscription_data"], payload, slots) for s in subscriptions
+            ])
+            gone = [s["id"] for s, (outcome, _) in zip(subscriptions, results) if outcome == "gone"]
+            if gone:
+                await self.db.push_subscriptions.delete_many({"id": {"$in": gone}})
+            await self._update(job, {
+                "$inc": {
+                    "users": len(user_ids),
+                    "subscriptions": len(subscriptions),
+                    "sent": sum(1 for outcome, _ in results if outcome == "sent"),
+                    "failed": sum(1 for outcome, _ in results if outcome == "failed"),
+                    "pruned": len(gone),
+                    "retries": sum(r for _, r in results),
+                },
+                "$set": {"last_user_id": user_ids[-1], "lease_until": self._lease_until()},
+            })
+        await self._update(job, {"$set": {
+            "status": "done",
+            "lease_until": None,
+            "lease_owner": None,
+            "finished_at": datetime.now(timezone.utc).isoformat(),
+        }})
+
+
+def job_progress(job: dict) -> dict:
+    started = job.get("started_at")
+    if started:
+        end = job.get("finished_at") or datetime.now(timezone.utc).isoformat()
+        elapsed = (datetime.fromisoformat(end) - datetime.fromisoformat(started)).total_seconds()
+        job["elapsed_seconds"] = round(elapsed, 3)
+        job["sent_per_second"] = round(job["sent"] / elapsed, 1) if elapsed > 0 else None
+    job.pop("lease_until", None)
+    job.pop("lease_owner", None)
+    job.pop("target_user_ids", None)
+    return job
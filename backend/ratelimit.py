@@ -0,0 +1,225 @@
+"""Per-client rate limits and a concurrency cap for expensive routes.
+
+``RateLimiter`` gives every (route, client) pair a token bucket: it
+holds up to ``burst`` requests and refills at ``rate`` per second, so a client
+can burst briefly but not sustain more than the rate. A client is the user id
+of a valid bearer token (checked with the JWT signature only, no database
+lookup), otherwise the remote address. A request with no token left gets 429
+and a ``Retry-After`` of the seconds until the next one.
+
+Limits are per route template, written ``METHOD /path=RATE/UNIT[:BURST]``
+(UNIT is s, m or h; ``off`` disables the limit), and routes without an entry
+share the default limit. ``RateLimitMiddleware`` takes the route from
+``MetricsMiddleware``, which already resolved it, so it must sit inside it.
+
+Buckets live in an LRU dict of at most ``max_keys`` entries. A bucket that has
+refilled to ``burst`` is the same as a new one, so buckets are dropped once
+idle that long, oldest first, and the least recently used one goes when the
+dict is full.
+
+``ConcurrencyLimit`` counts requests in flight on a group of routes and sheds
+the ones above ``limit`` instead of letting them queue up on Mongo. A streamed
+body (``SlotStreamingResponse``) keeps its request's slot until it is sent.
+
+State is per process; with several workers each one enforces its own limits.
+"""
+import math
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import orjson
+from starlette.responses import StreamingResponse
+
+from metrics import current_route
+
+UNITS = {"s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+class Limit(NamedTuple):
+    rate: float  # tokens per second
+    burst: float
+
+    def __str__(self) -> str:
+        if self.rate < 1:
+            return f"{self.rate * 60:g}/m:{self.burst:g}"
+        return f"{self.rate:g}/s:{self.burst:g}"
+
+
+def parse_limit(text: str) -> Optional[Limit]:
+    """``10/s``, ``30/m:60`` or ``off``; raises ValueError."""
+    text = text.strip()
+    if text.lower() in ("off", "none"):
+        return None
+    rate, _, burst = text.partition(":")
+    count, _, unit = rate.partition("/")
+    if unit not in UNITS or float(count) <= 0:
+        raise ValueError(f"invalid rate limit {text!r}")
+    limit = Limit(float(count) / UNITS[unit], float(burst) if burst else float(count))
+    if limit.burst < 1:
+        raise ValueError(f"burst must be at least 1 in {text!r}")
+    return limit
+
+
+def parse_limits(text: str) -> Dict[str, Optional[Limit]]:
+    """``POST /api/sales=5/s:20; POST /api/auth/login=20/m`` -> {route: limit}."""
+    limits = {}
+    for entry in filter(None, (e.strip() for e in text.split(";"))):
+        route, _, limit = entry.rpartition("=")
+        method, _, path = route.strip().partition(" ")
+        if not path:
+            raise ValueError(f"expected 'METHOD /path=limit', got {entry!r}")
+        limits[f"{method.upper()} {path.strip()}"] = parse_limit(limit)
+    return limits
+
+
+def client_address(scope, trust_forwarded: bool = False) -> str:
+    if trust_forwarded:
+        for name, value in scope["headers"]:
+            if name == b"x-forwarded-for":
+                return value.decode("latin-1").split(",")[0].strip()
+    client = scope.get("client")
+    return client[0] if client else ""
+
+
+class TokenBuckets:
+    def __init__(self, max_keys: int = 100000, clock: Callable[[], float] = time.monotonic):
+        self.max_keys = max_keys
+        self.clock = clock
+        # key -> [tokens, updated, full_at]
+        self._buckets: "OrderedDict[Tuple[str, str], List[float]]" = OrderedDict()
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def take(self, key: Tuple[str, str], limit: Limit) -> float:
+        """Take a token; 0 if there was one, else the seconds until there is."""
+        now = self.clock()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            tokens = limit.burst
+            bucket = self._buckets[key] = [0.0, 0.0, 0.0]
+        else:
+            tokens = min(limit.burst, bucket[0] + (now - bucket[1]) * limit.rate)
+            self._buckets.move_to_end(key)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / limit.rate
+        bucket[0], bucket[1], bucket[2] = tokens, now, now + (limit.burst - tokens) / limit.rate
+        self._evict(now)
+        return wait
+
+    def _evict(self, now: float) -> None:
+        # Buckets of different limits refill at different speeds, so this only
+        # looks at the front; a bucket behind an unfinished one waits its turn
+        buckets = self._buckets
+        while buckets:
+            bucket = buckets[next(iter(buckets))]
+            if len(buckets) <= self.max_keys and bucket[2] > now:
+                return
+            buckets.popitem(last=False)
+            self.evicted += 1
+
+
+class RateLimiter:
+    def __init__(self, limits: Dict[str, Optional[Limit]], default: Optional[Limit], max_keys: int = 100000):
+        self.limits = limits
+        self.default = default
+        self.buckets = TokenBuckets(max_keys)
+        # route -> requests answered with 429
+        self.limited: Dict[str, int] = {}
+
+    def check(self, route: str, client: Callable[[], str]) -> float:
+        """0 if the request may go ahead, else the seconds the client should wait."""
+        limit = self.limits.get(route, self.default)
+        if limit is None:
+            return 0.0
+        wait = self.buckets.take((route, client()), limit)
+        if wait:
+            self.limited[route] = self.limited.get(route, 0) + 1
+        return wait
+
+    def stats(self) -> dict:
+        return {
+            "default": str(self.default) if self.default else None,
+            "limits": {route: str(limit) if limit else None for route, limit in sorted(self.limits.items())},
+            "buckets": len(self.buckets),
+            "max_buckets": self.buckets.max_keys,
+            "evicted": self.buckets.evicted,
+            "limited": dict(sorted(self.limited.items())),
+        }
+
+
+class RateLimitMiddleware:
+    def __init__(self, app, limiter: RateLimiter, identify: Callable[[dict], str]):
+        self.app = app
+        self.limiter = limiter
+        self.identify = identify
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        route = f"{scope['method']} {current_route() or scope['path']}"
+        wait = self.limiter.check(route, lambda: self.identify(scope))
+        if not wait:
+            return await self.app(scope, receive, send)
+        await send({
+            "type": "http.response.start",
+            "status": 429,
+            "headers": [(b"content-type", b"application/json"),
+                        (b"retry-after", str(math.ceil(wait)).encode())],
+        })
+        await send({"type": "http.response.body", "body": orjson.dumps({"detail": "Too many requests"})})
+
+
+class Slot:
+    """One request's place under a ``ConcurrencyLimit``; ``release`` is idempotent."""
+
+    def __init__(self, limit: "ConcurrencyLimit"):
+        self.limit = limit
+        self.released = False
+        # Set when a streamed body takes over the slot from the request
+        self.kept = False
+
+    def keep(self) -> None:
+        self.kept = True
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.limit.active -= 1
+
+
+class ConcurrencyLimit:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.shed = 0
+
+    def acquire(self) -> Optional[Slot]:
+        if self.active >= self.limit:
+            self.shed += 1
+            return None
+        self.active += 1
+        return Slot(self)
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "active": self.active, "shed": self.shed}
+
+
+class SlotStreamingResponse(StreamingResponse):
+    """A streamed body that holds its slot until it is sent or the client goes away."""
+
+    def __init__(self, content, slot: Slot, **kwargs):
+        super().__init__(content, **kwargs)
+        slot.keep()
+        self.slot = slot
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.slot.release()
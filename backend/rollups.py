@@ -0,0 +1,306 @@
+"""Pre-aggregated sales rollups.
+
+Every sale adds to hourly and daily buckets in ``sales_rollups`` for each of
+its products, its seller and its payment method; a cancellation takes the
+same amounts back out of the sale's original buckets and counts the
+cancellation. Reports then sum a few hundred small documents instead of
+scanning ``sales``.
+
+Busy buckets are hot documents, so they are written after the sale or
+cancellation commits rather than inside its transaction. The sale carries
+the steps still to apply in ``rollups_pending``; ``apply_pending`` pulls a
+step before adding it, so each one is applied once, and ``RollupCatchUp``
+applies those a worker committed but never got to.
+
+Buckets are UTC and keyed by the ``timestamp`` prefix ("2025-10-12T13" for an
+hour, "2025-10-12" for a day). To rebuild everything from ``sales`` and its
+monthly archives:
+
+    python rollups.py backfill
+"""
+import asyncio
+import logging
+import os
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+GRANULARITIES = {"hour": 13, "day": 10}
+DIMENSIONS = ("product", "seller", "payment_method")
+# sales.rollups_pending holds the steps a sale still owes the rollups
+PENDING_FIELD = "rollups_pending"
+SALE, CANCEL = "sale", "cancel"
+
+
+def _rollup_updates(sale: Dict[str, Any], sign: int) -> List[Tuple[str, dict]]:
+    # sign=1 records a sale, sign=-1 reverses a cancelled one and counts the cancellation
+    cancelled = 1 if sign < 0 else 0
+    contributions = [
+        ("seller", sale["seller_id"], {"revenue": sale["total"]}, {}),
+        ("payment_method", sale["payment_method"], {"revenue": sale["total"]}, {}),
+    ]
+    for item in sale["items"]:
+        contributions.append((
+            "product", item["product_id"],
+            {"revenue": item["quantity"] * item["unit_price"], "quantity": item["quantity"]},
+            {"name": item["name"]},
+        ))
+
+    updates = []
+    for granularity, length in GRANULARITIES.items():
+        bucket = sale["timestamp"][:length]
+        for dimension, key, amounts, labels in contributions:
+            update = {
+                "$inc": {"sales": sign, "cancelled": cancelled, **{k: sign * v for k, v in amounts.items()}},
+                "$setOnInsert": {"granularity": granularity, "bucket": bucket, "dimension": dimension, "key": key},
+            }
+            if labels:
+                update["$set"] = labels
+            updates.append((f"{granularity}:{bucket}:{dimension}:{key}", update))
+    return updates
+
+
+async def record_sales(db, sales: List[Dict[str, Any]], sign: int = 1) -> None:
+    """Add sales to their buckets (sign=-1: cancel them), with one upsert per bucket they touch."""
+    merged: Dict[str, dict] = {}
+    for sale in sales:
+        for _id, update in _rollup_updates(sale, sign):
+            if _id not in merged:
+                merged[_id] = update
+                continue
+            totals = merged[_id]["$inc"]
+            for field, amount in update["$inc"].items():
+                totals[field] = totals.get(field, 0) + amount
+            if "$set" in update:
+                merged[_id]["$set"] = update["$set"]
+    if merged:
+        ops = [UpdateOne({"_id": _id}, update, upsert=True) for _id, update in merged.items()]
+        await db.sales_rollups.bulk_write(ops, ordered=False)
+
+
+async def apply_pending(db, sales: List[Dict[str, Any]], step: str) -> int:
+    """Apply ``step`` (SALE or CANCEL) for committed sales that still owe it; returns how many did."""
+    claimed = []
+    for sale in sales:
+        # Whoever pulls the step applies it, so a sale is never counted twice
+        result = await db.sales.update_one({"id": sale["id"], PENDING_FIELD: step}, {"$pull": {PENDING_FIELD: step}})
+        if result.modified_count:
+            claimed.append(sale)
+    await record_sales(db, claimed, 1 if step == SALE else -1)
+    return len(claimed)
+
+
+class RollupCatchUp:
+    """Applies rollup steps that were committed but not applied, e.g. by a worker that died in between."""
+
+    def __init__(self, db, interval: float = 60, batch_size: int = 1000):
+        self.db = db
+        self.interval = interval
+        self.batch_size = batch_size
+        self.applied = 0
+        # (sale id, step) pending on the previous pass
+        self._seen: Set[Tuple[str, str]] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def run_once(self) -> int:
+        pending: Dict[Tuple[str, str], dict] = {}
+        projection = {"_id": 0, "id": 1, "seller_id": 1, "payment_method": 1, "total": 1, "items": 1,
+                      "timestamp": 1, PENDING_FIELD: 1}
+        async for sale in self.db.sales.find({PENDING_FIELD: {"$in": [SALE, CANCEL]}}, projection).limit(self.batch_size):
+            for step in sale[PENDING_FIELD]:
+                pending[(sale["id"], step)] = sale
+        # The worker that committed a step applies it right away; only take
+        # over the ones that were already pending on the last pass
+        ready = [key for key in pending if key in self._seen]
+        self._seen = set(pending)
+        applied = 0
+        for step in (SALE, CANCEL):
+            applied += await apply_pending(self.db, [pending[key] for key in ready if key[1] == step], step)
+        self.applied += applied
+        return applied
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                applied = await self.run_once()
+                if applied:
+                    logger.warning(f"Applied {applied} rollup steps left pending")
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Rollup catch-up failed")
+            await asyncio.sleep(self.interval)
+
+
+def _hour_bounds(start: datetime, end: datetime):
+    # Rollups have hour precision: widen [start, end) to whole hours
+    start = start.replace(minute=0, second=0, microsecond=0)
+    if end.minute or end.second or end.microsecond:
+        end = end.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    return start, end
+
+
+def _bucket_ranges(start: datetime, end: datetime) -> List[Dict[str, Any]]:
+    """Cover [start, end) with whole days where possible and hours at the edges."""
+    start, end = _hour_bounds(start, end)
+    first_day = start.replace(hour=0)
+    if first_day < start:
+        first_day += timedelta(days=1)
+    last_day = end.replace(hour=0)
+    if first_day >= last_day:
+        return [{"granularity": "hour", "bucket": {"$gte": _hour(start), "$lt": _hour(end)}}]
+    ranges = [{"granularity": "day", "bucket": {"$gte": first_day.date().isoformat(), "$lt": last_day.date().isoformat()}}]
+    if start < first_day:
+        ranges.append({"granularity": "hour", "bucket": {"$gte": _hour(start), "$lt": _hour(first_day)}})
+    if last_day < end:
+        ranges.append({"granularity": "hour", "bucket": {"$gte": _hour(last_day), "$lt": _hour(end)}})
+    return ranges
+
+
+def _hour(value: datetime) -> str:
+    return value.strftime("%Y-%m-%dT%H")
+
+
+async def sales_summary(db, start: datetime, end: datetime, group_by: str, interval: Optional[str] = None) -> List[dict]:
+    if interval == "hour":
+        start, end = _hour_bounds(start, end)
+        ranges = [{"granularity": "hour", "bucket": {"$gte": _hour(start), "$lt": _hour(end)}}]
+    else:
+        ranges = _bucket_ranges(start, end)
+    group_id: Dict[str, Any] = {"key": "$key"}
+    if interval:
+        group_id["period"] = {"$substrCP": ["$bucket", 0, GRANULARITIES[interval]]}
+    rows = await db.sales_rollups.aggregate([
+        {"$match": {"dimension": group_by, "$or": ranges}},
+        {"$group": {
+            "_id": group_id,
+            "name": {"$last": "$name"},
+            "sales": {"$sum": "$sales"},
+            "revenue": {"$sum": "$revenue"},
+            "quantity": {"$sum": "$quantity"},
+            "cancelled": {"$sum": "$cancelled"},
+        }},
+    ]).to_list(None)
+
+    summary = []
+    for row in rows:
+        entry = {"key": row["_id"]["key"]}
+        if interval:
+            entry["period"] = row["_id"]["period"]
+        if group_by == "product":
+            entry["name"] = row.get("name")
+            entry["quantity"] = row["quantity"]
+        entry.update(sales=row["sales"], revenue=round(row["revenue"], 2), cancelled=row["cancelled"])
+        summary.append(entry)
+    if interval:
+        return sorted(summary, key=lambda r: (r["period"], -r["revenue"]))
+    return sorted(summary, key=lambda r: -r["revenue"])
+
+
+def _union_stages(archives: List[str]) -> List[dict]:
+    if not archives:
+        return []
+    # A month being archived is briefly in both the live and an archive
+    # collection; each sale is counted once, from the live copy
+    stages: List[dict] = [{"$set": {"_archived": False}}]
+    stages += [{"$unionWith": {"coll": name, "pipeline": [{"$set": {"_archived": True}}]}} for name in archives]
+    return stages + [
+        {"$sort": {"id": 1, "_archived": 1}},
+        {"$group": {"_id": "$id", "sale": {"$first": "$$ROOT"}}},
+        {"$replaceRoot": {"newRoot": "$sale"}},
+    ]
+
+
+def _backfill_pipeline(granularity: str, dimension: str, target: str, archives: List[str] = ()) -> List[dict]:
+    length = GRANULARITIES[granularity]
+    completed = {"$eq": ["$status", "completed"]}
+    stages = _union_stages(list(archives))
+    if dimension == "product":
+        stages.append({"$unwind": "$items"})
+        key = "$items.product_id"
+        revenue = {"$multiply": ["$items.quantity", "$items.unit_price"]}
+    else:
+        key = "$seller_id" if dimension == "seller" else "$payment_method"
+        revenue = "$total"
+    group = {
+        "_id": {"bucket": {"$substrCP": ["$timestamp", 0, length]}, "key": key},
+        "sales": {"$sum": {"$cond": [completed, 1, 0]}},
+        "revenue": {"$sum": {"$cond": [completed, revenue, 0]}},
+        "cancelled": {"$sum": {"$cond": [completed, 0, 1]}},
+    }
+    project = {
+        "_id": {"$concat": [f"{granularity}:", "$_id.bucket", f":{dimension}:", "$_id.key"]},
+        "granularity": granularity,
+        "bucket": "$_id.bucket",
+        "dimension": dimension,
+        "key": "$_id.key",
+        "sales": 1,
+        "revenue": 1,
+        "cancelled": 1,
+    }
+    if dimension == "product":
+        group["quantity"] = {"$sum": {"$cond": [completed, "$items.quantity", 0]}}
+        group["name"] = {"$last": "$items.name"}
+        project.update(quantity=1, name=1)
+    return stages + [{"$group": group}, {"$project": project}, {"$merge": {"into": target, "whenMatched": "replace"}}]
+
+
+async def backfill(db, archive=None) -> int:
+    """Rebuild sales_rollups from sales and, given an Archive, its archive collections.
+
+    Sales recorded while it runs are lost.
+    """
+    target = "sales_rollups_rebuild"
+    archives = (await archive.collections("sales"))[1:] if archive else []
+    await db[target].drop()
+    for granularity in GRANULARITIES:
+        for dimension in DIMENSIONS:
+            pipeline = _backfill_pipeline(granularity, dimension, target, archives)
+            await db.sales.aggregate(pipeline, allowDiskUse=True).to_list(None)
+    count = await db[target].count_documents({})
+    await db.client.admin.command(
+        "renameCollection", f"{db.name}.{target}", to=f"{db.name}.sales_rollups", dropTarget=True
+    )
+    return count
+
+
+async def _main(argv) -> int:
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    from archive import Archive
+    from indexes import ensure_indexes
+
+    if argv[:1] != ["backfill"]:
+        print("usage: python rollups.py backfill")
+        return 2
+    load_dotenv(Path(__file__).parent / '.env')
+    client = AsyncIOMotorClient(os.environ['MONGO_URL'])
+    db = client[os.environ['DB_NAME']]
+    try:
+        count = await backfill(db, Archive(db))
+        # The rename dropped the old collection's indexes
+        await ensure_indexes(db)
+        print(f"{count} rollup documents rebuilt")
+        return 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
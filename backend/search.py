@@ -0,0 +1,201 @@
+"""In-memory product search over name and category.
+
+Names and categories are folded (accents stripped, case-folded) and split
+into words. The words go into a sorted vocabulary with a posting set of
+product ids each, so a query word finds its prefix matches with ``bisect``;
+words that only match with a typo are found by a bounded prefix edit
+distance. Like the ``prefix_length`` of other fuzzy matchers, the first
+letter has to be right, which keeps that scan to one bisect range of the
+vocabulary.
+
+Every query word must match a word of the product (AND); exact words rank
+above prefixes, prefixes above typos, and name matches above category ones.
+Facet counts are over the matches before the category filter, so a screen
+can show how many hits each category would give.
+
+``ProductSearchIndex`` is kept current by ``catalog_changed`` exactly like
+``LowStockTracker`` (see ``low_stock.py``): written products are re-indexed
+in place, and a catalog version it did not see applied means another worker
+wrote, so the index is reloaded once.
+"""
+import asyncio
+import re
+import unicodedata
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+WORD = re.compile(r"\w+")
+# Typos allowed in a query word, by its length
+TYPO_LIMITS = ((8, 2), (4, 1))
+EXACT, PREFIX, TYPO = 3.0, 2.0, 1.0
+NAME_WEIGHT, CATEGORY_WEIGHT = 1.0, 0.5
+
+
+def fold(text: str) -> str:
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+def words(text: str) -> List[str]:
+    return WORD.findall(fold(text or ""))
+
+
+def _typo_limit(word: str) -> int:
+    for length, limit in TYPO_LIMITS:
+        if len(word) >= length:
+            return limit
+    return 0
+
+
+def prefix_distance(query: str, word: str, limit: int) -> int:
+    """Edit distance from ``query`` to the closest prefix of ``word``; limit + 1 if above ``limit``."""
+    previous = list(range(len(query) + 1))
+    best = previous[-1]
+    for j, char in enumerate(word[:len(query) + limit], 1):
+        current = [j]
+        for i, query_char in enumerate(query, 1):
+            current.append(min(previous[i] + 1, current[i - 1] + 1, previous[i - 1] + (query_char != char)))
+        best = min(best, current[-1])
+        if min(current) > limit:
+            break
+        previous = current
+    return min(best, limit + 1)
+
+
+class ProductSearchIndex:
+    def __init__(self, db, projection: Dict[str, int]):
+        self.db = db
+        self.projection = projection
+        self._products: Dict[str, dict] = {}
+        # product id -> {word: field weight}
+        self._words: Dict[str, Dict[str, float]] = {}
+        self._postings: Dict[str, Set[str]] = {}
+        self._vocabulary: List[str] = []
+        self.synced_version: Optional[int] = None
+        self._lock = asyncio.Lock()
+        self._changes = 0
+        self.reloads = 0
+
+    def _unindex(self, product_id: str) -> None:
+        for word in self._words.pop(product_id, {}):
+            ids = self._postings[word]
+            ids.discard(product_id)
+            if not ids:
+                del self._postings[word]
+                del self._vocabulary[bisect_left(self._vocabulary, word)]
+
+    def _index(self, product: dict) -> None:
+        weights: Dict[str, float] = {}
+        for word in words(product.get("category", "")):
+            weights[word] = CATEGORY_WEIGHT
+        for word in words(product.get("name", "")):
+            weights[word] = NAME_WEIGHT
+        self._words[product["id"]] = weights
+        for word in weights:
+            if word not in self._postings:
+                self._postings[word] = set()
+                self._vocabulary.insert(bisect_left(self._vocabulary, word), word)
+            self._postings[word].add(product["id"])
+
+    def apply(self, products: Iterable[dict]) -> None:
+        self._changes += 1
+        self._apply(products)
+
+    def _apply(self, products: Iterable[dict]) -> None:
+        for product in products:
+            current = self._products.setdefault(product["id"], {})
+            renamed = not current or any(
+                field in product and product[field] != current.get(field) for field in ("name", "category")
+            )
+            current.update((k, v) for k, v in product.items() if k != "_id")
+            if renamed:
+                self._unindex(product["id"])
+                self._index(current)
+
+    def remove(self, product_id: str) -> None:
+        self._changes += 1
+        self._products.pop(product_id, None)
+        self._unindex(product_id)
+
+    def advance(self, version: int) -> None:
+        self._changes += 1
+        if self.synced_version is not None and version == self.synced_version + 1:
+            self.synced_version = version
+        else:
+            self.synced_version = None
+
+    async def reload(self, version: int) -> None:
+        changes = self._changes
+        docs = await self.db.products.find({}, self.projection).to_list(None)
+        self._products, self._words, self._postings, self._vocabulary = {}, {}, {}, []
+        self._apply(docs)
+        # A local write that landed mid-query may be missing from `docs`
+        self.synced_version = version if changes == self._changes else None
+        self.reloads += 1
+
+    async def sync(self, version: int) -> None:
+        if self.synced_version is None or version > self.synced_version:
+            async with self._lock:
+                if self.synced_version is None or version > self.synced_version:
+                    await self.reload(version)
+
+    def _matches(self, query_word: str) -> Dict[str, float]:
+        """product id -> best score for one query word."""
+        scores: Dict[str, float] = {}
+
+        def add(word: str, quality: float) -> None:
+            for product_id in self._postings[word]:
+                score = quality * self._words[product_id][word]
+                if score > scores.get(product_id, 0.0):
+                    scores[product_id] = score
+
+        start, end = self._range(query_word)
+        for word in self._vocabulary[start:end]:
+            add(word, EXACT if word == query_word else PREFIX)
+        limit = _typo_limit(query_word)
+        if limit:
+            first, last = self._range(query_word[0])
+            for word in self._vocabulary[first:start] + self._vocabulary[end:last]:
+                distance = prefix_distance(query_word, word, limit)
+                if distance <= limit:
+                    add(word, TYPO / (1 + distance))
+        return scores
+
+    def _range(self, prefix: str) -> Tuple[int, int]:
+        start = bisect_left(self._vocabulary, prefix)
+        return start, bisect_left(self._vocabulary, prefix + "\U0010ffff", start)
+
+    def search(self, query: str = "", category: Optional[str] = None, in_stock: bool = False,
+               limit: int = 50, offset: int = 0) -> dict:
+        query_words = words(query)
+        if query_words:
+            scores: Optional[Dict[str, float]] = None
+            for query_word in dict.fromkeys(query_words):
+                matches = self._matches(query_word)
+                scores = matches if scores is None else {
+                    pid: score + matches[pid] for pid, score in scores.items() if pid in matches
+                }
+            hits: List[Tuple[float, dict]] = [(score, self._products[pid]) for pid, score in scores.items()]
+        else:
+            hits = [(0.0, product) for product in self._products.values()]
+        if in_stock:
+            hits = [(score, product) for score, product in hits if product.get("stock", 0) > 0]
+
+        facets: Dict[str, int] = {}
+        for _, product in hits:
+            facets[product.get("category", "")] = facets.get(product.get("category", ""), 0) + 1
+        if category is not None:
+            wanted = fold(category)
+            hits = [(score, product) for score, product in hits if fold(product.get("category", "")) == wanted]
+
+        hits.sort(key=lambda hit: (-hit[0], fold(hit[1].get("name", ""))))
+        return {
+            "total": len(hits),
+            "items": [product for _, product in hits[offset:offset + limit]],
+            "facets": {"category": [{"value": value, "count": count}
+                                    for value, count in sorted(facets.items(), key=lambda f: (-f[1], f[0]))]},
+        }
+
+    def stats(self) -> dict:
+        return {"products": len(self._products), "words": len(self._vocabulary),
+                "synced_version": self.synced_version, "reloads": self.reloads}
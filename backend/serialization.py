@@ -0,0 +1,48 @@
+"""Fast response path for documents read back from Mongo.
+
+Documents are validated by the write endpoints before they are stored, so the
+read side does not build a Pydantic model per row and have FastAPI validate
+and serialize it a second time. Queries project exactly the model's fields,
+fields that older documents lack get the model's defaults, and the dicts go
+straight to orjson.
+"""
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Type
+
+import orjson
+from pydantic import BaseModel
+
+
+@lru_cache(maxsize=None)
+def model_projection(model: Type[BaseModel]) -> Dict[str, int]:
+    return {"_id": 0, **{name: 1 for name in model.model_fields}}
+
+
+@lru_cache(maxsize=None)
+def _defaults(model: Type[BaseModel]) -> Dict[str, Any]:
+    # Fields with a plain default; factory fields (ids, timestamps) are always stored
+    return {
+        name: field.default
+        for name, field in model.model_fields.items()
+        if not field.is_required() and field.default_factory is None
+    }
+
+
+def fill_defaults(docs: Iterable[dict], model: Type[BaseModel]) -> List[dict]:
+    defaults = _defaults(model)
+    filled = []
+    for doc in docs:
+        for name, value in defaults.items():
+            if name not in doc:
+                doc[name] = value
+        filled.append(doc)
+    return filled
+
+
+def dumps(content: Any) -> bytes:
+    return orjson.dumps(content)
+
+
+async def ndjson_rows(cursor, model: Type[BaseModel]):
+    async for doc in cursor:
+        yield orjson.dumps(fill_defaults([doc], model)[0]) + b"\n"
@@ -1,34 +1,162 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form, Body
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Form, Body, Query, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, ConfigDict, field_validator, model_serializer
+from typing import AsyncIterator, Awaitable, Callable, List, Literal, Optional, Dict, Any, Tuple
 import uuid
 from datetime import datetime, timezone, timedelta
 import jwt
-from passlib.context import CryptContext
 import base64
 import json
 
+import asyncio
+
+from aging import MEDIA_TYPES, DebtAgingReports
+from archive import ARCHIVED, Archive
+from bootstrap import Bootstrap, ensure_user, sample_product_id, seed_products
+from blobs import InvalidBlob, create_blob_store, parse_byte_range
+from catalog import CatalogSnapshot, etag_matches
+from events import EventBus
+from indexes import ensure_indexes
+from ledger import (LedgerMaintenance, balance_as_of, ensure_opening_balances, ledger_entry, record_movement,
+                    record_movements, remove_movements, statement)
+from metrics import MetricsMiddleware, MetricsRegistry, MongoCommandListener, PoolListener
+from low_stock import LowStockTracker, projected_stockouts
+from product_io import export_products, import_products
+from passwords import PasswordHasher, PasswordHasherBusy
+from pricing import PRICE_TOLERANCE, PriceBook, Quote, UnknownProducts, normalize_tiers
+from push import PushDeliveryEngine, Vapid, job_progress, target_query
+from ratelimit import (ConcurrencyLimit, RateLimiter, RateLimitMiddleware, Slot, SlotStreamingResponse, client_address,
+                       parse_limit, parse_limits)
+from serialization import dumps, fill_defaults, model_projection, ndjson_rows
+from rollups import CANCEL, PENDING_FIELD, SALE, RollupCatchUp, apply_pending, sales_summary
+from search import ProductSearchIndex
+from user_cache import InvalidationChannel, UserCache
+
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+# Connection pool sizing and timeouts; unset variables keep the driver defaults.
+# The pool is per worker process, so the server sees up to workers x maxPoolSize.
+MONGO_POOL_OPTIONS = {
+    option: int(os.environ[variable])
+    for variable, option in (
+        ('MONGO_MAX_POOL_SIZE', 'maxPoolSize'),
+        ('MONGO_MIN_POOL_SIZE', 'minPoolSize'),
+        ('MONGO_MAX_IDLE_TIME_MS', 'maxIdleTimeMS'),
+        ('MONGO_WAIT_QUEUE_TIMEOUT_MS', 'waitQueueTimeoutMS'),
+        ('MONGO_CONNECT_TIMEOUT_MS', 'connectTimeoutMS'),
+        ('MONGO_SOCKET_TIMEOUT_MS', 'socketTimeoutMS'),
+        ('MONGO_SERVER_SELECTION_TIMEOUT_MS', 'serverSelectionTimeoutMS'),
+    )
+    if os.environ.get(variable)
+}
+# Request, Mongo command and connection pool metrics, served at /metrics
+metrics = MetricsRegistry()
+client = AsyncIOMotorClient(
+    mongo_url,
+    event_listeners=[MongoCommandListener(metrics), PoolListener(metrics)],
+    **MONGO_POOL_OPTIONS,
+)
 db = client[os.environ['DB_NAME']]
 
 # Security
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+password_hasher = PasswordHasher(
+    rounds=int(os.environ.get('BCRYPT_ROUNDS', '12')),
+    workers=int(os.environ.get('PASSWORD_HASH_WORKERS', str(min(4, os.cpu_count() or 1)))),
+    max_pending=int(os.environ.get('PASSWORD_HASH_MAX_PENDING', '64')),
+)
 JWT_SECRET = os.environ.get('JWT_SECRET', 'cantina-projeto-deus-secret-key-2025')
 JWT_ALGORITHM = "HS256"
 security = HTTPBearer()
 
+# Authenticated-user cache. USER_CACHE_TTL_SECONDS is the longest a changed
+# role or balance can go unnoticed by get_current_user / require_admin.
+user_cache = UserCache(
+    maxsize=int(os.environ.get('USER_CACHE_SIZE', '10000')),
+    ttl=float(os.environ.get('USER_CACHE_TTL_SECONDS', '5')),
+)
+user_cache_channel = (
+    InvalidationChannel(db, user_cache)
+    if os.environ.get('USER_CACHE_BROADCAST', 'false').lower() == 'true' else None
+)
+
+# Push notification delivery
+push_engine = PushDeliveryEngine(
+    db,
+    workers=int(os.environ.get('PUSH_WORKERS', '2')),
+    batch_size=int(os.environ.get('PUSH_BATCH_SIZE', '500')),
+    concurrency=int(os.environ.get('PUSH_CONCURRENCY', '50')),
+    max_retries=int(os.environ.get('PUSH_MAX_RETRIES', '3')),
+    vapid=Vapid(os.environ['VAPID_PRIVATE_KEY'], os.environ.get('VAPID_SUBJECT', 'mailto:admin@localhost'))
+    if os.environ.get('VAPID_PRIVATE_KEY') else None,
+)
+
+# Change feed for admin and POS screens (GET /events). Set EVENTS_BROADCAST
+# when running several workers so every screen sees every worker's writes.
+event_bus = EventBus(
+    db,
+    broadcast=os.environ.get('EVENTS_BROADCAST', 'false').lower() == 'true',
+    buffer_size=int(os.environ.get('EVENTS_BUFFER_SIZE', '1000')),
+    client_queue=int(os.environ.get('EVENTS_CLIENT_QUEUE', '256')),
+)
+EVENTS_HEARTBEAT_SECONDS = float(os.environ.get('EVENTS_HEARTBEAT_SECONDS', '15'))
+
+# Balance ledger snapshots and drift checks
+ledger_maintenance = LedgerMaintenance(db, interval=float(os.environ.get('LEDGER_MAINTENANCE_SECONDS', '3600')))
+
+# Rollup steps a worker committed but did not get to apply
+rollup_catch_up = RollupCatchUp(db, interval=float(os.environ.get('ROLLUP_CATCH_UP_SECONDS', '60')))
+
+# Image and receipt storage
+blob_store = create_blob_store(db, ROOT_DIR)
+
+# Finished sales, transactions and notifications older than ARCHIVE_AFTER_DAYS
+# move to monthly archive collections; 0 leaves everything in place
+archive = Archive(
+    db,
+    after_days=float(os.environ.get('ARCHIVE_AFTER_DAYS', '0')),
+    grace=float(os.environ.get('ARCHIVE_GRACE_SECONDS', '600')),
+    state_ttl=float(os.environ.get('ARCHIVE_STATE_SECONDS', '30')),
+    interval=float(os.environ.get('ARCHIVE_INTERVAL_SECONDS', '3600')),
+)
+
+# Month-end statement and debt aging jobs, written to the blob store
+debt_aging_reports = DebtAgingReports(db, blob_store, archive)
+
+# Per-client token buckets; RATE_LIMITS entries override these per route
+DEFAULT_RATE_LIMITS = (
+    "POST /api/auth/login=30/m:30; POST /api/auth/register=10/m:10; "
+    "POST /api/sales=2/s:10; POST /api/sales/batch=10/m:10; POST /api/sales/quote=10/s:20; "
+    "GET /api/blobs/{digest}=50/s:200; GET /api/health/ready=off"
+)
+rate_limiter = RateLimiter(
+    {**parse_limits(DEFAULT_RATE_LIMITS), **parse_limits(os.environ.get('RATE_LIMITS', ''))},
+    default=parse_limit(os.environ.get('RATE_LIMIT_DEFAULT', '20/s:40')),
+    max_keys=int(os.environ.get('RATE_LIMIT_MAX_BUCKETS', '100000')),
+)
+RATE_LIMIT_TRUST_FORWARDED = os.environ.get('RATE_LIMIT_TRUST_FORWARDED', 'false').lower() == 'true'
+# Unfiltered admin lists in flight at once; more get 503
+admin_lists = ConcurrencyLimit(int(os.environ.get('ADMIN_LIST_CONCURRENCY', '8')))
+
+# Default admin and sample catalog, reported by /health/ready
+bootstrap = Bootstrap()
+READINESS_TIMEOUT_SECONDS = float(os.environ.get('READINESS_TIMEOUT_SECONDS', '2'))
+
+PRODUCT_IMPORT_BATCH_SIZE = int(os.environ.get('PRODUCT_IMPORT_BATCH_SIZE', '500'))
+# Times /sales/batch re-plans after stock or keys changed under it
+SALE_BATCH_ATTEMPTS = 3
+
 # Create the main app
 app = FastAPI()
 api_router = APIRouter()
@@ -66,6 +194,7 @@ class Product(BaseModel):
     low_stock_threshold: int = 10
     category: str = "general"
     image_url: str = ""
+    thumbnail_url: str = ""
     volume_pricing: List[Dict[str, Any]] = []
 
 class ProductCreate(BaseModel):
@@ -77,6 +206,11 @@ class ProductCreate(BaseModel):
     image_url: str = ""
     volume_pricing: List[Dict[str, Any]] = []
 
+    @field_validator("volume_pricing")
+    @classmethod
+    def check_tiers(cls, tiers: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return normalize_tiers(tiers)
+
 class SaleItem(BaseModel):
     product_id: str
     name: str
@@ -94,12 +228,40 @@ class Sale(BaseModel):
     timestamp: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
     status: str = "completed"  # completed, cancelled
     cancellation_reason: Optional[str] = None
+    drawer_id: Optional[str] = None
+    idempotency_key: Optional[str] = None  # set by offline terminals, see /sales/batch
+
+    @model_serializer(mode="wrap")
+    def _omit_missing_key(self, handler):
+        # Left out rather than stored as null, so keyless sales stay out of
+        # the sparse key index
+        data = handler(self)
+        if data.get("idempotency_key") is None:
+            data.pop("idempotency_key", None)
+        return data
+
+# Also a field name in drawer totals and rollup keys, so only these are accepted
+PaymentMethod = Literal["cash", "card", "credit", "fiado"]
 
 class SaleCreate(BaseModel):
     customer_id: str
     items: List[SaleItem]
     total: float
-    payment_method: str
+    payment_method: PaymentMethod
+
+class QuoteItem(BaseModel):
+    product_id: str
+    quantity: int = Field(..., gt=0)
+
+class CartQuote(BaseModel):
+    items: List[QuoteItem] = Field(..., min_length=1, max_length=500)
+
+class OfflineSale(SaleCreate):
+    idempotency_key: str = Field(..., min_length=1, max_length=128)
+    timestamp: Optional[datetime] = None  # when the terminal recorded the sale
+
+class SaleBatch(BaseModel):
+    sales: List[OfflineSale] = Field(..., min_length=1, max_length=1000)
 
 class SaleCancellation(BaseModel):
     reason: str
@@ -124,13 +286,25 @@ class TransactionReview(BaseModel):
     status: str
     admin_note: Optional[str] = None
 
+class TransactionReviewItem(TransactionReview):
+    transaction_id: str
+
+class TransactionBatchReview(BaseModel):
+    reviews: List[TransactionReviewItem] = Field(..., min_length=1, max_length=1000)
+
 class CashDrawer(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     seller_id: str
     opening_balance: float
     closing_balance: Optional[float] = None
-    sales_ids: List[str] = []
+    # Running totals per payment method, kept up to date by create_sale and cancel_sale
+    sales_count: int = 0
+    totals: Dict[str, float] = {}
+    cancelled_count: int = 0
+    cancelled_totals: Dict[str, float] = {}
+    expected_balance: Optional[float] = None
+    difference: Optional[float] = None
     timestamp_opened: str = Field(default_factory=lambda: datetime.now(timezone.utc).isoformat())
     timestamp_closed: Optional[str] = None
 
@@ -154,11 +328,25 @@ class PushNotificationSend(BaseModel):
     target_user_ids: Optional[List[str]] = None
 
 # Auth helpers
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+PASSWORD_HASHER_BUSY = HTTPException(status_code=503, detail="Server busy, try again", headers={"Retry-After": "1"})
+
+async def hash_password(password: str) -> str:
+    try:
+        return await password_hasher.hash(password)
+    except PasswordHasherBusy:
+        raise PASSWORD_HASHER_BUSY
+
+async def verify_password(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    # Returns (valid, new_hash); new_hash is set when BCRYPT_ROUNDS changed
+    try:
+        return await password_hasher.verify(plain_password, hashed_password)
+    except PasswordHasherBusy:
+        raise PASSWORD_HASHER_BUSY
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+async def invalidate_user(user_id: str) -> None:
+    user_cache.invalidate(user_id)
+    if user_cache_channel:
+        await user_cache_channel.publish(user_id)
 
 def create_access_token(data: dict) -> str:
     to_encode = data.copy()
@@ -174,16 +362,50 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         if not user_id:
             raise HTTPException(status_code=401, detail="Invalid token")
         
+        user = user_cache.get(user_id)
+        if user:
+            return user
+        
+        generation = user_cache.generation
         user_doc = await db.users.find_one({"id": user_id}, {"_id": 0})
         if not user_doc:
             raise HTTPException(status_code=401, detail="User not found")
         
-        return User(**user_doc)
+        user = User(**user_doc)
+        user_cache.put(user_id, user, generation)
+        return user
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except Exception as e:
         raise HTTPException(status_code=401, detail="Invalid token")
 
+def rate_limit_client(scope) -> str:
+    # Signature check only; a bad or expired token is limited by address instead
+    for name, value in scope["headers"]:
+        if name == b"authorization" and value[:7].lower() == b"bearer ":
+            try:
+                return "user:" + jwt.decode(value[7:].decode(), JWT_SECRET, algorithms=[JWT_ALGORITHM])["user_id"]
+            except Exception:
+                break
+    return "ip:" + client_address(scope, RATE_LIMIT_TRUST_FORWARDED)
+
+ADMIN_LISTS_BUSY = HTTPException(status_code=503, detail="Server busy, try again", headers={"Retry-After": "1"})
+
+async def admin_list_slot(current_user: User = Depends(get_current_user)) -> AsyncIterator[Optional[Slot]]:
+    # Admins list everyone's rows; shed those past the cap instead of queueing them on Mongo.
+    # paginate hands the slot to an NDJSON stream, which releases it once the body is sent.
+    if current_user.role != "admin":
+        yield None
+        return
+    slot = admin_lists.acquire()
+    if slot is None:
+        raise ADMIN_LISTS_BUSY
+    try:
+        yield slot
+    finally:
+        if not slot.kept:
+            slot.release()
+
 async def require_admin(current_user: User = Depends(get_current_user)) -> User:
     if current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Admin access required")
@@ -194,6 +416,110 @@ async def require_seller(current_user: User = Depends(get_current_user)) -> User
         raise HTTPException(status_code=403, detail="Seller access required")
     return current_user
 
+# Pagination helpers
+MAX_PAGE_SIZE = 1000
+# Serialize list responses from the raw documents with orjson instead of
+# building and re-validating a model per row
+FAST_SERIALIZATION = os.environ.get('FAST_SERIALIZATION', 'true').lower() == 'true'
+
+class PageParams(BaseModel):
+    cursor: Optional[str] = None
+    limit: Optional[int] = None
+    since: Optional[str] = None
+    until: Optional[str] = None
+    format: str = "json"
+
+def _as_utc(value: datetime) -> datetime:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+def _as_utc_iso(value: Optional[datetime]) -> Optional[str]:
+    return _as_utc(value).isoformat() if value else None
+
+def page_params(
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+) -> PageParams:
+    return PageParams(cursor=cursor, limit=limit, since=_as_utc_iso(since), until=_as_utc_iso(until), format=format)
+
+def encode_cursor(values: List[Any]) -> str:
+    raw = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str, size: int) -> List[Any]:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+async def _ndjson_rows(cursor, model):
+    async for doc in cursor:
+        yield model(**doc).model_dump_json() + "\n"
+
+async def paginate(collection, query: dict, model, keys: List[str], page: PageParams,
+                   response: Response, time_field: Optional[str] = None, slot: Optional[Slot] = None):
+    # Keyset pagination, newest first, over `keys` (the last key must be unique).
+    # The next page's cursor is returned in the X-Next-Cursor header so the
+    # body stays a plain list. Only `model`'s fields are read from Mongo.
+    clauses = [query] if query else []
+    if page.since or page.until:
+        if not time_field:
+            raise HTTPException(status_code=400, detail="since/until not supported here")
+        time_range = {}
+        if page.since:
+            time_range["$gte"] = page.since
+        if page.until:
+            time_range["$lt"] = page.until
+        clauses.append({time_field: time_range})
+    latest = None
+    if page.cursor:
+        values = decode_cursor(page.cursor, len(keys))
+        latest = values[0] if keys[0] == time_field else None
+        clauses.append({"$or": [
+            {**{k: values[j] for j, k in enumerate(keys[:i])}, keys[i]: {"$lt": values[i]}}
+            for i in range(len(keys))
+        ]})
+    if len(clauses) > 1:
+        query = {"$and": clauses}
+    else:
+        query = clauses[0] if clauses else {}
+
+    limit = page.limit or MAX_PAGE_SIZE
+    if time_field and collection.name in ARCHIVED and await archive.months(collection.name):
+        # Older months may live in archive collections; they are read only if the page reaches them
+        def rows_until(n: Optional[int]):
+            return archive.find(collection.name, query, model_projection(model), keys,
+                                page.since, page.until, latest, n)
+    else:
+        def rows_until(n: Optional[int]):
+            cursor = collection.find(query, model_projection(model)).sort([(k, DESCENDING) for k in keys])
+            return cursor.limit(n) if n else cursor
+    
+    if page.format == "ndjson":
+        cursor = rows_until(page.limit)
+        rows = ndjson_rows(cursor, model) if FAST_SERIALIZATION else _ndjson_rows(cursor, model)
+        if slot is not None:
+            return SlotStreamingResponse(rows, slot, media_type="application/x-ndjson")
+        return StreamingResponse(rows, media_type="application/x-ndjson")
+
+    docs = [doc async for doc in rows_until(limit + 1)]
+    headers = {}
+    if len(docs) > limit:
+        docs = docs[:limit]
+        headers["X-Next-Cursor"] = encode_cursor([docs[-1].get(k) for k in keys])
+    if FAST_SERIALIZATION:
+        # Stored documents were validated on write; skip response_model
+        return ORJSONResponse(fill_defaults(docs, model), headers=headers)
+    response.headers.update(headers)
+    return [model(**d) for d in docs]
+
 # Auth endpoints
 @api_router.post("/auth/register", response_model=TokenResponse)
 async def register(user_data: UserCreate):
@@ -205,7 +531,7 @@ async def register(user_data: UserCreate):
     # Create user
     user = User(username=user_data.username)
     user_doc = user.model_dump()
-    user_doc["password_hash"] = hash_password(user_data.password)
+    user_doc["password_hash"] = await hash_password(user_data.password)
     
     await db.users.insert_one(user_doc)
     
@@ -222,8 +548,11 @@ async def login(user_data: UserLogin):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     # Verify password
-    if not verify_password(user_data.password, user_doc["password_hash"]):
+    valid, new_hash = await verify_password(user_data.password, user_doc["password_hash"])
+    if not valid:
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    if new_hash:
+        await db.users.update_one({"id": user_doc["id"]}, {"$set": {"password_hash": new_hash}})
     
     # Create user object
     user = User(**{k: v for k, v in user_doc.items() if k != "password_hash" and k != "_id"})
@@ -239,9 +568,9 @@ async def get_me(current_user: User = Depends(get_current_user)):
 
 # User endpoints
 @api_router.get("/users", response_model=List[User])
-async def get_users(current_user: User = Depends(get_current_user)):
-    users = await db.users.find({}, {"_id": 0, "password_hash": 0}).to_list(1000)
-    return [User(**u) for u in users]
+async def get_users(response: Response, page: PageParams = Depends(page_params), slot: Optional[Slot] = Depends(admin_list_slot), current_user: User = Depends(get_current_user)):
+    return await paginate(db.users, {}, User, ["created_at", "id"], page, response,
+                          time_field="created_at", slot=slot)
 
 @api_router.get("/users/{user_id}", response_model=User)
 async def get_user(user_id: str, current_user: User = Depends(get_current_user)):
@@ -250,6 +579,63 @@ async def get_user(user_id: str, current_user: User = Depends(get_current_user))
         raise HTTPException(status_code=404, detail="User not found")
     return User(**user_doc)
 
+@api_router.get("/users/{user_id}/balance")
+async def get_user_balance(user_id: str, at: Optional[datetime] = None, current_user: User = Depends(get_current_user)):
+    if user_id != current_user.id and current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Unauthorized")
+    at = _as_utc(at) if at else datetime.now(timezone.utc)
+    return {"user_id": user_id, "at": at.isoformat(), **await balance_as_of(db, user_id, at)}
+
+@api_router.get("/users/{user_id}/statement")
+async def get_user_statement(user_id: str, month: str = Query(..., pattern=r"^\d{4}-\d{2}$"), current_user: User = Depends(get_current_user)):
+    if user_id != current_user.id and current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Unauthorized")
+    try:
+        start = datetime.strptime(month, "%Y-%m").replace(tzinfo=timezone.utc)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid month")
+    end = (start + timedelta(days=32)).replace(day=1)
+    return await statement(db, user_id, start, end)
+
+@api_router.post("/reports/debt-aging", status_code=202)
+async def create_debt_aging_report(
+    month: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}$"),
+    format: str = Query("csv", pattern="^(csv|parquet)$"),
+    current_user: User = Depends(require_admin)
+):
+    # Statement and aging for every customer in debt; without a month, the month so far
+    if not debt_aging_reports.available(format):
+        raise HTTPException(status_code=400, detail="Parquet output is not available on this server")
+    try:
+        return await debt_aging_reports.start(month, format, current_user.id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid month")
+
+@api_router.get("/reports/jobs")
+async def get_report_jobs(limit: int = Query(20, ge=1, le=100), current_user: User = Depends(require_admin)):
+    return await db.report_jobs.find({}, {"_id": 0}).sort("created_at", DESCENDING).to_list(limit)
+
+@api_router.get("/reports/jobs/{job_id}")
+async def get_report_job(job_id: str, current_user: User = Depends(require_admin)):
+    job = await db.report_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Report job not found")
+    return job
+
+@api_router.get("/reports/jobs/{job_id}/download")
+async def download_report(job_id: str, current_user: User = Depends(require_admin)):
+    job = await db.report_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Report job not found")
+    if job["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Report is {job['status']}")
+    return StreamingResponse(
+        blob_store.read(job["blob"], 0, job["size"] - 1),
+        media_type=MEDIA_TYPES[job["format"]],
+        headers={"Content-Disposition": f'attachment; filename="debt-aging-{job["month"]}.{job["format"]}"',
+                 "Content-Length": str(job["size"])}
+    )
+
 @api_router.patch("/users/{user_id}/role")
 async def update_user_role(user_id: str, role: str = Body(..., embed=True), current_user: User = Depends(require_admin)):
     if role not in ["customer", "seller"]:
@@ -258,6 +644,7 @@ async def update_user_role(user_id: str, role: str = Body(..., embed=True), curr
     result = await db.users.update_one({"id": user_id}, {"$set": {"role": role}})
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    await invalidate_user(user_id)
     
     return {"success": True}
 
@@ -269,6 +656,7 @@ async def update_theme(user_id: str, theme: str = Body(..., embed=True), current
     result = await db.users.update_one({"id": user_id}, {"$set": {"theme_preference": theme}})
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    await invalidate_user(user_id)
     
     return {"success": True}
 
@@ -280,27 +668,164 @@ async def update_notifications(user_id: str, enabled: bool = Body(..., embed=Tru
     result = await db.users.update_one({"id": user_id}, {"$set": {"notifications_enabled": enabled}})
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="User not found")
+    await invalidate_user(user_id)
     
     return {"success": True}
 
+# Product catalog snapshot
+async def load_catalog() -> bytes:
+    products = await db.products.find({}, model_projection(Product)).sort("id", DESCENDING).to_list(None)
+    return dumps(fill_defaults(products, Product))
+
+catalog = CatalogSnapshot(db, load_catalog, check_interval=float(os.environ.get('CATALOG_VERSION_CHECK_SECONDS', '1')))
+
+low_stock = LowStockTracker(db)
+search_index = ProductSearchIndex(db, model_projection(Product))
+
+# Volume pricing, kept current from the same product writes
+price_book = PriceBook(db)
+
+# Serializes the read-and-apply in catalog_changed; see there
+catalog_apply_lock = asyncio.Lock()
+
+async def catalog_changed(query: Optional[dict] = None, deleted_id: Optional[str] = None) -> None:
+    # Call after every write that changes what GET /products returns, with a
+    # filter matching the written products. Concurrent writers would read
+    # their products in one order and apply them in another, leaving an older
+    # stock behind; reading under the lock applies each product's states in
+    # the order Mongo returned them
+    products = []
+    if query:
+        async with catalog_apply_lock:
+            products = await db.products.find(query, model_projection(Product)).to_list(None)
+            low_stock.apply(products)
+            search_index.apply(products)
+            price_book.apply(products)
+    if deleted_id:
+        low_stock.remove(deleted_id)
+        search_index.remove(deleted_id)
+        price_book.remove(deleted_id)
+    version = await catalog.bump()
+    low_stock.advance(version)
+    search_index.advance(version)
+    price_book.advance(version)
+    event_bus.publish("catalog.changed", {
+        "version": version,
+        # Whole products, so open screens can patch their lists instead of refetching
+        "products": fill_defaults(products, Product),
+        "deleted_id": deleted_id,
+    }, ["catalog"])
+
+def publish_sale(event_type: str, sale_doc: dict) -> None:
+    data = {k: sale_doc.get(k) for k in ("id", "seller_id", "customer_id", "total", "payment_method",
+                                         "status", "cancellation_reason", "drawer_id", "timestamp")}
+    event_bus.publish(event_type, data, ["sales", f"user:{sale_doc['customer_id']}", f"user:{sale_doc['seller_id']}"])
+
+def publish_transaction(event_type: str, transaction_doc: dict) -> None:
+    data = {k: transaction_doc.get(k) for k in ("id", "user_id", "type", "amount", "status", "receipt_url",
+                                                "timestamp")}
+    event_bus.publish(event_type, data, ["transactions", f"user:{transaction_doc['user_id']}"])
+
+async def store_product_image(image_url: str) -> Tuple[str, str]:
+    # Returns (image_url, thumbnail_url); data URLs are moved to the blob store
+    try:
+        meta = await blob_store.put_data_url(image_url, thumbnail=True, public=True)
+    except InvalidBlob as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if meta is None:
+        digest = blob_store.digest_from_url(image_url)
+        meta = await blob_store.stat(digest) if digest else None
+        if meta is None:
+            return image_url, ""
+        await blob_store.publish(meta)
+    thumbnail = meta.get("thumbnail")
+    return blob_store.url(meta["_id"]), blob_store.url(thumbnail) if thumbnail else ""
+
 # Product endpoints
 @api_router.get("/products", response_model=List[Product])
-async def get_products():
-    products = await db.products.find({}, {"_id": 0}).to_list(1000)
-    return [Product(**p) for p in products]
+async def get_products(request: Request, response: Response, page: PageParams = Depends(page_params)):
+    if page.cursor or page.limit or page.since or page.until or page.format != "json":
+        return await paginate(db.products, {}, Product, ["id"], page, response)
+    
+    snapshot = await catalog.get()
+    use_gzip = "gzip" in request.headers.get("accept-encoding", "")
+    etag = snapshot.gzip_etag if use_gzip else snapshot.etag
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+        "X-Catalog-Version": str(snapshot.version),
+    }
+    if etag_matches(request.headers.get("if-none-match"), snapshot.etag, snapshot.gzip_etag):
+        return Response(status_code=304, headers=headers)
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=snapshot.gzip_body, media_type="application/json", headers=headers)
+    return Response(content=snapshot.body, media_type="application/json", headers=headers)
+
+@api_router.get("/products/search")
+async def search_products(
+    q: str = Query("", max_length=100),
+    category: Optional[str] = None,
+    in_stock: bool = False,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+):
+    version = await catalog.version()
+    await search_index.sync(version)
+    result = search_index.search(q, category=category, in_stock=in_stock, limit=limit, offset=offset)
+    result["items"] = fill_defaults(result["items"], Product)
+    return ORJSONResponse({"catalog_version": version, **result})
 
 @api_router.post("/products", response_model=Product)
 async def create_product(product_data: ProductCreate, current_user: User = Depends(require_admin)):
     product = Product(**product_data.model_dump())
+    product.image_url, product.thumbnail_url = await store_product_image(product.image_url)
     await db.products.insert_one(product.model_dump())
+    await catalog_changed({"id": product.id})
     return product
 
+@api_router.post("/products/import")
+async def import_product_file(
+    request: Request,
+    format: Optional[str] = Query(None, pattern="^(csv|ndjson)$"),
+    key: str = Query("id", pattern="^(id|name)$"),
+    batch_size: int = Query(PRODUCT_IMPORT_BATCH_SIZE, ge=1, le=5000),
+    current_user: User = Depends(require_admin)
+):
+    # Body is the raw file (text/csv or application/x-ndjson), read as it arrives
+    fmt = format or ("ndjson" if "ndjson" in request.headers.get("content-type", "") else "csv")
+    
+    async def prepare(doc: dict) -> dict:
+        try:
+            meta = await blob_store.put_data_url(doc["image_url"], thumbnail=True, public=True)
+        except InvalidBlob as e:
+            raise ValueError(f"image_url: {e}")
+        if meta:
+            doc["image_url"] = blob_store.url(meta["_id"])
+        doc["thumbnail_url"] = blob_store.url(meta["thumbnail"]) if meta and meta.get("thumbnail") else ""
+        return doc
+    
+    return await import_products(db, request.stream(), fmt, ProductCreate, key=key, batch_size=batch_size,
+                                 prepare=prepare, on_batch=catalog_changed)
+
+@api_router.get("/products/export")
+async def export_product_file(format: str = Query("csv", pattern="^(csv|ndjson)$"), current_user: User = Depends(require_admin)):
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        export_products(db, format, PRODUCT_IMPORT_BATCH_SIZE),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="products.{format}"'}
+    )
+
 @api_router.put("/products/{product_id}", response_model=Product)
 async def update_product(product_id: str, product_data: ProductCreate, current_user: User = Depends(require_admin)):
     product = Product(id=product_id, **product_data.model_dump())
+    product.image_url, product.thumbnail_url = await store_product_image(product.image_url)
     result = await db.products.replace_one({"id": product_id}, product.model_dump())
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    await catalog_changed({"id": product_id})
     return product
 
 @api_router.delete("/products/{product_id}")
@@ -308,17 +833,157 @@ async def delete_product(product_id: str, current_user: User = Depends(require_a
     result = await db.products.delete_one({"id": product_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    await catalog_changed(deleted_id=product_id)
     return {"success": True}
 
 @api_router.post("/products/{product_id}/upload-image")
 async def upload_product_image(product_id: str, image_data: str = Body(..., embed=True), current_user: User = Depends(require_admin)):
-    # Store image as base64 data URL
-    result = await db.products.update_one({"id": product_id}, {"$set": {"image_url": image_data}})
+    image_url, thumbnail_url = await store_product_image(image_data)
+    result = await db.products.update_one(
+        {"id": product_id},
+        {"$set": {"image_url": image_url, "thumbnail_url": thumbnail_url}}
+    )
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Product not found")
+    await catalog_changed({"id": product_id})
     return {"success": True}
 
+# Checkout helpers
+class OutOfStock(Exception):
+    def __init__(self, product_ids: Optional[List[str]] = None):
+        # None means "unknown": the transaction was aborted and the caller
+        # should re-read stock to find the failing items.
+        self.product_ids = product_ids
+
+_transactions_supported: Optional[bool] = None
+
+async def supports_transactions() -> bool:
+    global _transactions_supported
+    if _transactions_supported is None:
+        try:
+            hello = await client.admin.command("hello")
+            _transactions_supported = bool(hello.get("setName")) or hello.get("msg") == "isdbgrid"
+        except Exception:
+            _transactions_supported = False
+        if not _transactions_supported:
+            logger.warning("MongoDB deployment has no transactions; checkout falls back to compensating writes")
+    return _transactions_supported
+
+async def run_atomically(callback):
+    # callback(session) runs inside a transaction on replica sets / sharded
+    # clusters, and with session=None on a standalone server.
+    if await supports_transactions():
+        async with await client.start_session() as session:
+            return await session.with_transaction(callback)
+    return await callback(None)
+
+class Compensation:
+    """Undoes a run_atomically callback's writes when it fails without a transaction.
+
+    Each write adds the step that takes it back; if the block raises, the
+    steps run newest first. With a session the transaction rolls back
+    instead and nothing is recorded.
+    """
+    def __init__(self, session):
+        self.steps: Optional[List[Callable[[], Awaitable[Any]]]] = [] if session is None else None
+
+    def add(self, step: Callable[[], Awaitable[Any]]) -> None:
+        if self.steps is not None:
+            self.steps.append(step)
+
+    async def __aenter__(self) -> "Compensation":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool:
+        if exc_type is not None and self.steps:
+            for step in reversed(self.steps):
+                try:
+                    await step()
+                except Exception:
+                    logger.exception("Compensating write failed; data may need repair")
+        return False
+
+def negate(change: Dict[str, float]) -> Dict[str, float]:
+    return {field: -amount for field, amount in change.items()}
+
+def stock_deltas(items) -> Dict[str, int]:
+    deltas: Dict[str, int] = {}
+    for item in items:
+        product_id = item["product_id"] if isinstance(item, dict) else item.product_id
+        quantity = item["quantity"] if isinstance(item, dict) else item.quantity
+        deltas[product_id] = deltas.get(product_id, 0) + quantity
+    return deltas
+
+def drawer_change(payment_method: str, total: float, sign: int = 1) -> Dict[str, Any]:
+    # sign=1 records a sale in the drawer, sign=-1 takes a cancelled one back out
+    change = {"sales_count": sign, f"totals.{payment_method}": sign * total}
+    if sign < 0:
+        change.update({"cancelled_count": 1, f"cancelled_totals.{payment_method}": total})
+    return change
+
+def approval_change(transaction_doc: dict) -> Optional[Dict[str, float]]:
+    # Balance change an approved transaction applies to its user
+    if transaction_doc["type"] == "credit_add":
+        return {"credit": transaction_doc["amount"]}
+    if transaction_doc["type"] == "debt_payment":
+        return {"debt": -transaction_doc["amount"]}
+    return None
+
+def balance_change(payment_method: str, total: float) -> Optional[Dict[str, float]]:
+    if payment_method == "fiado":
+        return {"debt": total}
+    if payment_method == "credit":
+        return {"credit": -total}
+    return None
+
+async def take_stock(deltas: Dict[str, int], session=None) -> None:
+    conditions = [({"id": pid, "stock": {"$gte": qty}}, {"$inc": {"stock": -qty}}) for pid, qty in deltas.items()]
+    if session is not None:
+        result = await db.products.bulk_write([UpdateOne(f, u) for f, u in conditions], ordered=False, session=session)
+        if result.matched_count < len(conditions):
+            raise OutOfStock()
+        return
+
+    # No transaction: issue the conditional updates concurrently so we know
+    # exactly which ones applied, and put those back if any item failed.
+    results = await asyncio.gather(*[db.products.update_one(f, u) for f, u in conditions])
+    applied = [pid for pid, r in zip(deltas, results) if r.matched_count]
+    if len(applied) < len(deltas):
+        if applied:
+            await restore_stock({pid: deltas[pid] for pid in applied})
+        raise OutOfStock([pid for pid in deltas if pid not in applied])
+
+async def restore_stock(deltas: Dict[str, int], session=None) -> None:
+    if deltas:
+        await db.products.bulk_write(
+            [UpdateOne({"id": pid}, {"$inc": {"stock": qty}}) for pid, qty in deltas.items()],
+            ordered=False, session=session
+        )
+
+async def out_of_stock_detail(deltas: Dict[str, int], names: Dict[str, str], product_ids: Optional[List[str]]) -> dict:
+    docs = await db.products.find({"id": {"$in": list(deltas)}}, {"_id": 0, "id": 1, "stock": 1}).to_list(None)
+    available = {d["id"]: d.get("stock", 0) for d in docs}
+    if product_ids is None:
+        product_ids = [pid for pid, qty in deltas.items() if available.get(pid, 0) < qty]
+    return {
+        "message": "Insufficient stock",
+        "items": [
+            {"product_id": pid, "name": names.get(pid), "requested": deltas[pid], "available": available.get(pid, 0)}
+            for pid in product_ids
+        ],
+    }
+
+async def price_cart(items) -> Quote:
+    try:
+        return await price_book.quote(await catalog.version(), ((item.product_id, item.quantity) for item in items))
+    except UnknownProducts as e:
+        raise HTTPException(status_code=400, detail={"message": "Unknown products", "product_ids": e.product_ids})
+
 # Sale endpoints
+@api_router.post("/sales/quote")
+async def quote_sale(cart: CartQuote, current_user: User = Depends(get_current_user)):
+    return ORJSONResponse((await price_cart(cart.items)).as_dict())
+
 @api_router.post("/sales", response_model=Sale)
 async def create_sale(sale_data: SaleCreate, current_user: User = Depends(require_seller)):
     sale = Sale(
@@ -328,92 +993,336 @@ async def create_sale(sale_data: SaleCreate, current_user: User = Depends(requir
         total=sale_data.total,
         payment_method=sale_data.payment_method
     )
+    if not sale.items or any(item.quantity <= 0 for item in sale.items):
+        raise HTTPException(status_code=400, detail="Sale items must have a positive quantity")
     
-    # Update product stock
-    for item in sale.items:
-        await db.products.update_one(
-            {"id": item.product_id},
-            {"$inc": {"stock": -item.quantity}}
-        )
+    # The server's prices win; a client that priced the cart differently
+    # (stale catalog, missed tier) gets the current quote back to confirm
+    quote = await price_cart(sale.items)
+    if abs(quote.total - sale.total) > PRICE_TOLERANCE or any(
+        abs(item.unit_price - line["unit_price"]) > PRICE_TOLERANCE for item, line in zip(sale.items, quote.lines)
+    ):
+        raise HTTPException(status_code=409, detail={"message": "Prices changed", "quote": quote.as_dict()})
+    sale.items = [
+        SaleItem(product_id=line["product_id"], name=line["name"], quantity=line["quantity"], unit_price=line["unit_price"])
+        for line in quote.lines
+    ]
+    sale.total = quote.total
     
-    # Update customer balance
-    if sale_data.payment_method == "fiado":
-        await db.users.update_one(
-            {"id": sale_data.customer_id},
-            {"$inc": {"debt": sale_data.total}}
-        )
-    elif sale_data.payment_method == "credit":
-        await db.users.update_one(
-            {"id": sale_data.customer_id},
-            {"$inc": {"credit": -sale_data.total}}
-        )
+    deltas = stock_deltas(sale.items)
+    balance = balance_change(sale.payment_method, sale.total)
+    
+    async def checkout(session):
+        await take_stock(deltas, session)
+        async with Compensation(session) as undo:
+            undo.add(lambda: restore_stock(deltas))
+            if balance:
+                entry = await record_movement(db, sale.customer_id, balance, "sale", sale.id, session)
+                undo.add(lambda: remove_movements(db, [entry]))
+                await db.users.update_one({"id": sale.customer_id}, {"$inc": balance}, session=session)
+                undo.add(lambda: db.users.update_one({"id": sale.customer_id}, {"$inc": negate(balance)}))
+            change = drawer_change(sale.payment_method, sale.total)
+            drawer = await db.cash_drawers.find_one_and_update(
+                {"seller_id": sale.seller_id, "timestamp_closed": None},
+                {"$inc": change},
+                projection={"_id": 0, "id": 1},
+                session=session
+            )
+            if drawer:
+                undo.add(lambda: db.cash_drawers.update_one({"id": drawer["id"]}, {"$inc": negate(change)}))
+            sale.drawer_id = drawer["id"] if drawer else None
+            await db.sales.insert_one({**sale.model_dump(), PENDING_FIELD: [SALE]}, session=session)
     
-    await db.sales.insert_one(sale.model_dump())
+    try:
+        await run_atomically(checkout)
+    except OutOfStock as e:
+        names = {item.product_id: item.name for item in sale.items}
+        raise HTTPException(status_code=409, detail=await out_of_stock_detail(deltas, names, e.product_ids))
+    
+    # Outside the transaction: rollup buckets are shared by every checkout
+    await apply_pending(db, [sale.model_dump()], SALE)
+    await catalog_changed({"id": {"$in": list(deltas)}})
+    if balance:
+        await invalidate_user(sale.customer_id)
+    publish_sale("sale.created", sale.model_dump())
     return sale
 
-@api_router.get("/sales", response_model=List[Sale])
-async def get_sales(current_user: User = Depends(get_current_user)):
-    if current_user.role == "admin":
-        sales = await db.sales.find({}, {"_id": 0}).to_list(1000)
+def only_duplicate_keys(error: BulkWriteError) -> bool:
+    return all(e.get("code") == 11000 for e in error.details.get("writeErrors", [])) and \
+        not error.details.get("writeConcernErrors")
+
+def plan_offline_sales(sales: List[Sale], stock: Dict[str, int]) -> Tuple[List[Sale], Dict[str, dict]]:
+    # Give stock to the sales in the order the terminal queued them
+    accepted, rejected = [], {}
+    for sale in sales:
+        deltas = stock_deltas(sale.items)
+        short = [pid for pid, qty in deltas.items() if stock.get(pid, 0) < qty]
+        if short:
+            rejected[sale.idempotency_key] = {
+                "message": "Insufficient stock",
+                "items": [{"product_id": pid, "requested": deltas[pid], "available": stock.get(pid, 0)} for pid in short],
+            }
+            continue
+        for pid, qty in deltas.items():
+            stock[pid] -= qty
+        accepted.append(sale)
+    return accepted, rejected
+
+async def apply_offline_sales(sales: List[Sale], session) -> Dict[str, Dict[str, float]]:
+    docs = [{**sale.model_dump(), PENDING_FIELD: [SALE]} for sale in sales]
+    ids = [doc["id"] for doc in docs]
+    deltas: Dict[str, int] = {}
+    per_user: Dict[str, Dict[str, float]] = {}
+    movements = []
+    drawer_inc: Dict[str, float] = {}
+    for sale in sales:
+        for pid, qty in stock_deltas(sale.items).items():
+            deltas[pid] = deltas.get(pid, 0) + qty
+        balance = balance_change(sale.payment_method, sale.total)
+        if balance:
+            movements.append(ledger_entry(sale.customer_id, balance, "sale", sale.id))
+            totals = per_user.setdefault(sale.customer_id, {})
+            for field, amount in balance.items():
+                totals[field] = totals.get(field, 0.0) + amount
+        for field, amount in drawer_change(sale.payment_method, sale.total).items():
+            drawer_inc[field] = drawer_inc.get(field, 0) + amount
+
+    # Inserting first claims the idempotency keys; a concurrent upload of the
+    # same key fails here before any stock or balance moves. Keys live in
+    # sale_keys, which is never archived, so a key outlives its sale's month.
+    keys = [{"_id": sale.idempotency_key, "sale_id": sale.id, "seller_id": sale.seller_id,
+             "created_at": sale.timestamp} for sale in sales]
+    async with Compensation(session) as undo:
+        # Deletes only match what this call inserted, so they are safe to
+        # register before a write that may stop partway
+        undo.add(lambda: db.sale_keys.delete_many({"sale_id": {"$in": ids}}))
+        await db.sale_keys.insert_many(keys, session=session)
+        undo.add(lambda: db.sales.delete_many({"id": {"$in": ids}}))
+        await db.sales.insert_many(docs, session=session)
+        await take_stock(deltas, session)
+        undo.add(lambda: restore_stock(deltas))
+        undo.add(lambda: remove_movements(db, movements))
+        await record_movements(db, movements, session)
+        if per_user:
+            await db.users.bulk_write(
+                [UpdateOne({"id": user_id}, {"$inc": inc}) for user_id, inc in per_user.items()],
+                ordered=False, session=session
+            )
+            undo.add(lambda: db.users.bulk_write(
+                [UpdateOne({"id": user_id}, {"$inc": negate(inc)}) for user_id, inc in per_user.items()],
+                ordered=False
+            ))
+        drawer = await db.cash_drawers.find_one_and_update(
+            {"seller_id": sales[0].seller_id, "timestamp_closed": None},
+            {"$inc": drawer_inc},
+            projection={"_id": 0, "id": 1},
+            session=session
+        )
+        if drawer:
+            undo.add(lambda: db.cash_drawers.update_one({"id": drawer["id"]}, {"$inc": negate(drawer_inc)}))
+            await db.sales.update_many({"id": {"$in": ids}}, {"$set": {"drawer_id": drawer["id"]}}, session=session)
+    for sale in sales:
+        sale.drawer_id = drawer["id"] if drawer else None
+    return per_user
+
+async def offline_price_problem(sale: Sale, version: int) -> Optional[Tuple[str, Any]]:
+    # (outcome, detail) when an offline sale's prices cannot be applied as sent
+    if abs(round(sum(item.quantity * item.unit_price for item in sale.items), 2) - sale.total) > PRICE_TOLERANCE:
+        return "invalid", "Sale total does not match its items"
+    try:
+        quote = await price_book.quote(version, ((item.product_id, item.quantity) for item in sale.items))
+    except UnknownProducts as e:
+        return "invalid", {"message": "Unknown products", "product_ids": e.product_ids}
+    if any(abs(item.unit_price - line["unit_price"]) > PRICE_TOLERANCE for item, line in zip(sale.items, quote.lines)):
+        return "prices_changed", {"message": "Prices changed", "quote": quote.as_dict()}
+    return None
+
+@api_router.post("/sales/batch")
+async def upload_sales(batch: SaleBatch, current_user: User = Depends(require_seller)):
+    # Offline terminals flush their queue here. Each sale carries a key the
+    # terminal generated; keys already applied are skipped, so retrying an
+    # upload after a timeout never takes stock or charges fiado twice.
+    now = datetime.now(timezone.utc)
+    results: List[Optional[dict]] = [None] * len(batch.sales)
+    positions: Dict[str, int] = {}
+    pending: Dict[str, Sale] = {}
+    for i, item in enumerate(batch.sales):
+        key = item.idempotency_key
+        if key in positions:
+            results[i] = {"idempotency_key": key, "outcome": "duplicate"}
+            continue
+        positions[key] = i
+        if not item.items or any(line.quantity <= 0 for line in item.items):
+            results[i] = {"idempotency_key": key, "outcome": "invalid",
+                          "detail": "Sale items must have a positive quantity"}
+            continue
+        pending[key] = Sale(
+            seller_id=current_user.id,
+            customer_id=item.customer_id,
+            items=item.items,
+            total=item.total,
+            payment_method=item.payment_method,
+            idempotency_key=key,
+            timestamp=min(_as_utc(item.timestamp), now).isoformat() if item.timestamp else now.isoformat(),
+        )
+
+    # The terminal priced these from its cached catalog; like /sales, the
+    # server's prices decide, so a sale priced differently is sent back
+    version = await catalog.version()
+    for key, sale in list(pending.items()):
+        problem = await offline_price_problem(sale, version)
+        if problem:
+            results[positions[key]] = {"idempotency_key": key, "outcome": problem[0], "detail": problem[1]}
+            del pending[key]
+
+    applied: List[Sale] = []
+    per_user: Dict[str, Dict[str, float]] = {}
+    for _ in range(SALE_BATCH_ATTEMPTS):
+        if pending:
+            async for doc in db.sale_keys.find({"_id": {"$in": list(pending)}}, {"sale_id": 1}):
+                key = doc["_id"]
+                results[positions[key]] = {"idempotency_key": key, "outcome": "already_applied", "sale_id": doc["sale_id"]}
+                del pending[key]
+        if pending:
+            # Sales uploaded before sale_keys existed only carry their key
+            async for doc in db.sales.find({"idempotency_key": {"$in": list(pending), "$type": "string"}},
+                                           {"_id": 0, "id": 1, "idempotency_key": 1}):
+                key = doc["idempotency_key"]
+                results[positions[key]] = {"idempotency_key": key, "outcome": "already_applied", "sale_id": doc["id"]}
+                del pending[key]
+        if not pending:
+            break
+        product_ids = list({line.product_id for sale in pending.values() for line in sale.items})
+        stock = {doc["id"]: doc.get("stock", 0) for doc in await db.products.find(
+            {"id": {"$in": product_ids}}, {"_id": 0, "id": 1, "stock": 1}).to_list(None)}
+        accepted, rejected = plan_offline_sales(list(pending.values()), stock)
+        for key, detail in rejected.items():
+            results[positions[key]] = {"idempotency_key": key, "outcome": "out_of_stock", "detail": detail}
+            del pending[key]
+        if not accepted:
+            break
+        try:
+            per_user = await run_atomically(lambda session: apply_offline_sales(accepted, session))
+        except OutOfStock:
+            continue
+        except BulkWriteError as e:
+            if not only_duplicate_keys(e):
+                raise
+            continue
+        applied = accepted
+        break
     else:
-        sales = await db.sales.find({"customer_id": current_user.id}, {"_id": 0}).to_list(1000)
-    return [Sale(**s) for s in sales]
+        raise HTTPException(status_code=409, detail="Stock changed during the upload; retry the batch")
+
+    for sale in applied:
+        results[positions[sale.idempotency_key]] = {
+            "idempotency_key": sale.idempotency_key, "outcome": "applied", "sale_id": sale.id,
+            "drawer_id": sale.drawer_id,
+        }
+    if applied:
+        await apply_pending(db, [sale.model_dump() for sale in applied], SALE)
+        product_ids = list({line.product_id for sale in applied for line in sale.items})
+        await catalog_changed({"id": {"$in": product_ids}})
+    for user_id in per_user:
+        await invalidate_user(user_id)
+    for sale in applied:
+        publish_sale("sale.created", sale.model_dump())
+    return {"applied": len(applied), "skipped": len(results) - len(applied), "results": results}
+
+@api_router.get("/sales", response_model=List[Sale])
+async def get_sales(response: Response, page: PageParams = Depends(page_params), slot: Optional[Slot] = Depends(admin_list_slot), current_user: User = Depends(get_current_user)):
+    query = {} if current_user.role == "admin" else {"customer_id": current_user.id}
+    return await paginate(db.sales, query, Sale, ["timestamp", "id"], page, response,
+                          time_field="timestamp", slot=slot)
 
 @api_router.post("/sales/{sale_id}/cancel")
 async def cancel_sale(sale_id: str, cancellation: SaleCancellation, current_user: User = Depends(require_seller)):
     sale_doc = await db.sales.find_one({"id": sale_id})
     if not sale_doc:
+        # Archived months are read-only, so their sales are final
+        if await archive.find_one("sales", {"id": sale_id}, {"_id": 1}):
+            raise HTTPException(status_code=409, detail="Sale archived, cannot cancel")
         raise HTTPException(status_code=404, detail="Sale not found")
     
     if sale_doc["status"] == "cancelled":
         raise HTTPException(status_code=400, detail="Sale already cancelled")
     
-    # Restore product stock
-    for item in sale_doc["items"]:
-        await db.products.update_one(
-            {"id": item["product_id"]},
-            {"$inc": {"stock": item["quantity"]}}
-        )
+    balance = balance_change(sale_doc["payment_method"], sale_doc["total"])
+    deltas = stock_deltas(sale_doc["items"])
     
-    # Restore customer balance
-    if sale_doc["payment_method"] == "fiado":
-        await db.users.update_one(
-            {"id": sale_doc["customer_id"]},
-            {"$inc": {"debt": -sale_doc["total"]}}
-        )
-    elif sale_doc["payment_method"] == "credit":
-        await db.users.update_one(
-            {"id": sale_doc["customer_id"]},
-            {"$inc": {"credit": sale_doc["total"]}}
+    async def cancel(session):
+        # Flipping the status first makes a concurrent second cancel a no-op
+        result = await db.sales.update_one(
+            {"id": sale_id, "status": {"$ne": "cancelled"}},
+            {"$set": {"status": "cancelled", "cancellation_reason": cancellation.reason},
+             "$push": {PENDING_FIELD: CANCEL}},
+            session=session
         )
+        if result.modified_count == 0:
+            raise HTTPException(status_code=400, detail="Sale already cancelled")
+        async with Compensation(session) as undo:
+            undo.add(lambda: db.sales.update_one(
+                {"id": sale_id},
+                {"$set": {"status": sale_doc["status"], "cancellation_reason": sale_doc.get("cancellation_reason")},
+                 "$pull": {PENDING_FIELD: CANCEL}}
+            ))
+            await restore_stock(deltas, session)
+            undo.add(lambda: restore_stock(negate(deltas)))
+            if sale_doc.get("drawer_id"):
+                # Closed drawers are final (see close_cash_drawer); once the sale's
+                # drawer is closed, the refund comes out of the seller's open one
+                change = drawer_change(sale_doc["payment_method"], sale_doc["total"], -1)
+                drawer = await db.cash_drawers.find_one_and_update(
+                    {"id": sale_doc["drawer_id"], "timestamp_closed": None}, {"$inc": change},
+                    projection={"_id": 0, "id": 1}, session=session
+                )
+                if drawer is None:
+                    # The sale was counted in the closed drawer, not this one
+                    change.pop("sales_count")
+                    drawer = await db.cash_drawers.find_one_and_update(
+                        {"seller_id": sale_doc["seller_id"], "timestamp_closed": None}, {"$inc": change},
+                        projection={"_id": 0, "id": 1}, session=session
+                    )
+                if drawer:
+                    undo.add(lambda: db.cash_drawers.update_one({"id": drawer["id"]}, {"$inc": negate(change)}))
+            if balance:
+                refund = negate(balance)
+                entry = await record_movement(db, sale_doc["customer_id"], refund, "sale_cancelled", sale_id, session)
+                undo.add(lambda: remove_movements(db, [entry]))
+                await db.users.update_one({"id": sale_doc["customer_id"]}, {"$inc": refund}, session=session)
     
-    # Update sale status
-    await db.sales.update_one(
-        {"id": sale_id},
-        {"$set": {"status": "cancelled", "cancellation_reason": cancellation.reason}}
-    )
+    await run_atomically(cancel)
+    
+    await apply_pending(db, [sale_doc], CANCEL)
+    await catalog_changed({"id": {"$in": list(deltas)}})
+    if balance:
+        await invalidate_user(sale_doc["customer_id"])
+    publish_sale("sale.cancelled", {**sale_doc, "status": "cancelled", "cancellation_reason": cancellation.reason})
     
     return {"success": True}
 
 # Transaction endpoints
 @api_router.post("/transactions", response_model=Transaction)
 async def create_transaction(transaction_data: TransactionCreate, current_user: User = Depends(get_current_user)):
+    try:
+        meta = await blob_store.put_data_url(transaction_data.receipt_data)
+    except InvalidBlob as e:
+        raise HTTPException(status_code=400, detail=str(e))
     transaction = Transaction(
         user_id=current_user.id,
         type=transaction_data.type,
         amount=transaction_data.amount,
-        receipt_url=transaction_data.receipt_data
+        receipt_url=blob_store.url(meta["_id"]) if meta else transaction_data.receipt_data
     )
     await db.transactions.insert_one(transaction.model_dump())
+    publish_transaction("transaction.created", transaction.model_dump())
     return transaction
 
 @api_router.get("/transactions", response_model=List[Transaction])
-async def get_transactions(current_user: User = Depends(get_current_user)):
-    if current_user.role == "admin":
-        transactions = await db.transactions.find({}, {"_id": 0}).to_list(1000)
-    else:
-        transactions = await db.transactions.find({"user_id": current_user.id}, {"_id": 0}).to_list(1000)
-    return [Transaction(**t) for t in transactions]
+async def get_transactions(response: Response, page: PageParams = Depends(page_params), slot: Optional[Slot] = Depends(admin_list_slot), current_user: User = Depends(get_current_user)):
+    query = {} if current_user.role == "admin" else {"user_id": current_user.id}
+    return await paginate(db.transactions, query, Transaction, ["timestamp", "id"], page, response,
+                          time_field="timestamp", slot=slot)
 
 @api_router.patch("/transactions/{transaction_id}/review")
 async def review_transaction(transaction_id: str, review: TransactionReview, current_user: User = Depends(require_admin)):
@@ -421,27 +1330,111 @@ async def review_transaction(transaction_id: str, review: TransactionReview, cur
     if not transaction_doc:
         raise HTTPException(status_code=404, detail="Transaction not found")
     
-    # Update transaction status
-    await db.transactions.update_one(
-        {"id": transaction_id},
-        {"$set": {"status": review.status, "admin_note": review.admin_note}}
-    )
+    change = approval_change(transaction_doc) if review.status == "approved" else None
     
-    # Update user balance if approved
-    if review.status == "approved":
-        if transaction_doc["type"] == "credit_add":
-            await db.users.update_one(
-                {"id": transaction_doc["user_id"]},
-                {"$inc": {"credit": transaction_doc["amount"]}}
-            )
-        elif transaction_doc["type"] == "debt_payment":
-            await db.users.update_one(
-                {"id": transaction_doc["user_id"]},
-                {"$inc": {"debt": -transaction_doc["amount"]}}
+    async def apply(session):
+        async with Compensation(session) as undo:
+            if change:
+                # The ledger's unique (reason, source_id) index rejects a second approval
+                try:
+                    entry = await record_movement(db, transaction_doc["user_id"], change, transaction_doc["type"],
+                                                  transaction_id, session)
+                except DuplicateKeyError:
+                    raise HTTPException(status_code=400, detail="Transaction already applied")
+                undo.add(lambda: remove_movements(db, [entry]))
+                await db.users.update_one({"id": transaction_doc["user_id"]}, {"$inc": change}, session=session)
+                undo.add(lambda: db.users.update_one({"id": transaction_doc["user_id"]}, {"$inc": negate(change)}))
+            await db.transactions.update_one(
+                {"id": transaction_id},
+                {"$set": {"status": review.status, "admin_note": review.admin_note}},
+                session=session
             )
     
+    await run_atomically(apply)
+    if change:
+        await invalidate_user(transaction_doc["user_id"])
+    publish_transaction("transaction.reviewed", {**transaction_doc, "status": review.status})
+    
     return {"success": True}
 
+@api_router.post("/transactions/review-batch")
+async def review_transactions(batch: TransactionBatchReview, current_user: User = Depends(require_admin)):
+    # Only transactions still pending are changed, so replaying a batch is a no-op
+    reviews: Dict[str, TransactionReviewItem] = {}
+    for item in batch.reviews:
+        if item.status not in ("approved", "rejected"):
+            raise HTTPException(status_code=400, detail=f"Invalid status for {item.transaction_id}")
+        reviews.setdefault(item.transaction_id, item)
+    batch_id = str(uuid.uuid4())
+    applied: List[dict] = []
+    
+    async def apply(session):
+        applied.clear()
+        ops = [
+            UpdateOne(
+                {"id": tid, "status": "pending"},
+                {"$set": {"status": item.status, "admin_note": item.admin_note, "review_batch": batch_id}}
+            )
+            for tid, item in reviews.items()
+        ]
+        async with Compensation(session) as undo:
+            # Only pending transactions (with no note yet) carry this batch id
+            undo.add(lambda: db.transactions.update_many(
+                {"review_batch": batch_id},
+                {"$set": {"status": "pending", "admin_note": None}, "$unset": {"review_batch": ""}}
+            ))
+            await db.transactions.bulk_write(ops, ordered=False, session=session)
+            # The batch id marks exactly the documents this call moved out of pending
+            applied.extend(await db.transactions.find(
+                {"review_batch": batch_id}, {"_id": 0, "id": 1, "user_id": 1, "type": 1, "amount": 1, "status": 1},
+                session=session
+            ).to_list(None))
+            
+            movements = []
+            per_user: Dict[str, Dict[str, float]] = {}
+            for doc in applied:
+                change = approval_change(doc) if doc["status"] == "approved" else None
+                if not change:
+                    continue
+                movements.append(ledger_entry(doc["user_id"], change, doc["type"], doc["id"]))
+                totals = per_user.setdefault(doc["user_id"], {})
+                for field, amount in change.items():
+                    totals[field] = totals.get(field, 0.0) + amount
+            undo.add(lambda: remove_movements(db, movements))
+            await record_movements(db, movements, session)
+            if per_user:
+                await db.users.bulk_write(
+                    [UpdateOne({"id": user_id}, {"$inc": inc}) for user_id, inc in per_user.items()],
+                    ordered=False, session=session
+                )
+            return per_user
+    
+    per_user = await run_atomically(apply)
+    for user_id in per_user:
+        await invalidate_user(user_id)
+    for doc in applied:
+        publish_transaction("transaction.reviewed", doc)
+    
+    moved = {doc["id"] for doc in applied}
+    skipped = [tid for tid in reviews if tid not in moved]
+    found = {
+        doc["id"]: doc["status"]
+        for doc in await db.transactions.find({"id": {"$in": skipped}}, {"_id": 0, "id": 1, "status": 1}).to_list(None)
+    } if skipped else {}
+    results = []
+    for item in batch.reviews:
+        tid = item.transaction_id
+        if item is not reviews[tid]:
+            results.append({"transaction_id": tid, "outcome": "duplicate"})
+        elif tid in moved:
+            results.append({"transaction_id": tid, "outcome": item.status})
+        elif tid in found:
+            results.append({"transaction_id": tid, "outcome": "not_pending", "status": found[tid]})
+        else:
+            results.append({"transaction_id": tid, "outcome": "not_found"})
+    
+    return {"applied": len(moved), "skipped": len(results) - len(moved), "results": results}
+
 # Cash drawer endpoints
 @api_router.post("/cash-drawer", response_model=CashDrawer)
 async def open_cash_drawer(drawer_data: CashDrawerCreate, current_user: User = Depends(require_seller)):
@@ -473,28 +1466,78 @@ async def close_cash_drawer(drawer_id: str, closing_balance: float = Body(..., e
     if drawer_doc["seller_id"] != current_user.id and current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Unauthorized")
     
-    await db.cash_drawers.update_one(
-        {"id": drawer_id},
+    # Sales only $inc open drawers, so the totals read here are final
+    drawer_doc = await db.cash_drawers.find_one_and_update(
+        {"id": drawer_id, "timestamp_closed": None},
         {"$set": {
             "closing_balance": closing_balance,
             "timestamp_closed": datetime.now(timezone.utc).isoformat()
-        }}
+        }},
+        projection={"_id": 0}
     )
+    if not drawer_doc:
+        raise HTTPException(status_code=400, detail="Cash drawer already closed")
     
-    return {"success": True}
-
-@api_router.post("/cash-drawer/{drawer_id}/add-sale")
-async def add_sale_to_drawer(drawer_id: str, sale_id: str = Body(..., embed=True), current_user: User = Depends(require_seller)):
+    totals = drawer_doc.get("totals", {})
+    expected = round(drawer_doc["opening_balance"] + totals.get("cash", 0), 2)
+    difference = round(closing_balance - expected, 2)
     await db.cash_drawers.update_one(
         {"id": drawer_id},
-        {"$push": {"sales_ids": sale_id}}
+        {"$set": {"expected_balance": expected, "difference": difference}}
     )
+    
+    return {
+        "success": True,
+        "opening_balance": drawer_doc["opening_balance"],
+        "expected_balance": expected,
+        "closing_balance": closing_balance,
+        "difference": difference,
+        "sales_count": drawer_doc.get("sales_count", 0),
+        "totals": {k: round(v, 2) for k, v in totals.items()},
+        "cancelled_count": drawer_doc.get("cancelled_count", 0),
+    }
+
+@api_router.post("/cash-drawer/{drawer_id}/add-sale")
+async def add_sale_to_drawer(drawer_id: str, sale_id: str = Body(..., embed=True), current_user: User = Depends(require_seller)):
+    # Sales are linked to the seller's open drawer at checkout; this only
+    # attaches sales that were made while no drawer was open.
+    drawer_doc = await db.cash_drawers.find_one({"id": drawer_id, "timestamp_closed": None}, {"_id": 0, "seller_id": 1})
+    if not drawer_doc:
+        raise HTTPException(status_code=404, detail="No open cash drawer")
+    if drawer_doc["seller_id"] != current_user.id and current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Unauthorized")
+    
+    async def attach(session):
+        sale_doc = await db.sales.find_one_and_update(
+            {"id": sale_id, "drawer_id": None, "status": "completed"},
+            {"$set": {"drawer_id": drawer_id}},
+            projection={"_id": 0, "payment_method": 1, "total": 1},
+            session=session
+        )
+        if sale_doc:
+            await db.cash_drawers.update_one(
+                {"id": drawer_id},
+                {"$inc": drawer_change(sale_doc["payment_method"], sale_doc["total"])},
+                session=session
+            )
+    
+    await run_atomically(attach)
     return {"success": True}
 
 @api_router.get("/cash-drawer/history", response_model=List[CashDrawer])
-async def get_drawer_history(current_user: User = Depends(require_admin)):
-    drawers = await db.cash_drawers.find({}, {"_id": 0}).to_list(1000)
-    return [CashDrawer(**d) for d in drawers]
+async def get_drawer_history(response: Response, page: PageParams = Depends(page_params), slot: Optional[Slot] = Depends(admin_list_slot), current_user: User = Depends(require_admin)):
+    return await paginate(db.cash_drawers, {}, CashDrawer, ["timestamp_opened", "id"], page, response,
+                          time_field="timestamp_opened", slot=slot)
+
+@api_router.get("/cash-drawer/{drawer_id}/sales", response_model=List[Sale])
+async def get_drawer_sales(drawer_id: str, response: Response, page: PageParams = Depends(page_params), current_user: User = Depends(require_seller)):
+    drawer_doc = await db.cash_drawers.find_one({"id": drawer_id}, {"_id": 0, "seller_id": 1})
+    if not drawer_doc:
+        raise HTTPException(status_code=404, detail="Cash drawer not found")
+    if drawer_doc["seller_id"] != current_user.id and current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Unauthorized")
+    return await paginate(db.sales, {"drawer_id": drawer_id}, Sale, ["timestamp", "id"], page, response,
+                          time_field="timestamp")
 
 # Push notification endpoints
 @api_router.post("/push/subscribe")
@@ -519,54 +1562,213 @@ async def subscribe_push(subscription_data: PushSubscriptionCreate, current_user
 
 @api_router.post("/push/send")
 async def send_push_notification(notification: PushNotificationSend, current_user: User = Depends(require_admin)):
-    # Get target users based on criteria
-    target_user_ids = []
-    
-    if notification.target_type == "all_users":
-        users = await db.users.find({"notifications_enabled": True}, {"id": 1}).to_list(1000)
-        target_user_ids = [u["id"] for u in users]
-    elif notification.target_type == "role":
-        users = await db.users.find(
-            {"role": notification.target_role, "notifications_enabled": True},
-            {"id": 1}
-        ).to_list(1000)
-        target_user_ids = [u["id"] for u in users]
-    elif notification.target_type == "debtors":
-        users = await db.users.find(
-            {"debt": {"$gt": 0}, "notifications_enabled": True},
-            {"id": 1}
-        ).to_list(1000)
-        target_user_ids = [u["id"] for u in users]
-    elif notification.target_type == "manual":
-        target_user_ids = notification.target_user_ids or []
-    
-    # Get subscriptions for target users
-    subscriptions = await db.push_subscriptions.find(
-        {"user_id": {"$in": target_user_ids}},
-        {"_id": 0}
-    ).to_list(1000)
+    if notification.target_type not in ("all_users", "role", "debtors", "manual"):
+        raise HTTPException(status_code=400, detail="Invalid target type")
+    
+    # Delivery happens in the background; the job id tracks its progress
+    job = await push_engine.enqueue(
+        notification.message,
+        notification.target_type,
+        notification.target_role,
+        notification.target_user_ids,
+        current_user.id
+    )
+    
+    if notification.target_type == "manual":
+        recipients = len(job["target_user_ids"])
+    else:
+        recipients = await db.users.count_documents(target_query(notification.target_type, notification.target_role))
     
-    # In a real implementation, you would use a service like Firebase Cloud Messaging
-    # or Web Push to send notifications. For this MVP, we'll just return success.
     # Store notification history
     notification_record = {
         "id": str(uuid.uuid4()),
+        "job_id": job["id"],
         "message": notification.message,
         "target_type": notification.target_type,
-        "target_count": len(target_user_ids),
+        "target_count": recipients,
         "sent_by": current_user.id,
         "timestamp": datetime.now(timezone.utc).isoformat()
     }
     await db.notifications.insert_one(notification_record)
     
-    return {"success": True, "recipients": len(subscriptions)}
+    return {"success": True, "job_id": job["id"], "status": job["status"], "recipients": recipients}
+
+@api_router.get("/push/jobs")
+async def get_push_jobs(limit: int = Query(20, ge=1, le=100), current_user: User = Depends(require_admin)):
+    jobs = await db.push_jobs.find({}, {"_id": 0}).sort("created_at", DESCENDING).to_list(limit)
+    return [job_progress(j) for j in jobs]
+
+@api_router.get("/push/jobs/{job_id}")
+async def get_push_job(job_id: str, current_user: User = Depends(require_admin)):
+    job = await db.push_jobs.find_one({"id": job_id}, {"_id": 0})
+    if not job:
+        raise HTTPException(status_code=404, detail="Push job not found")
+    return job_progress(job)
+
+# Blob endpoints
+@api_router.get("/blobs/{digest}")
+async def get_blob(
+    digest: str,
+    request: Request,
+    token: Optional[str] = None,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer(auto_error=False)),
+):
+    meta = await blob_store.stat(digest)
+    if not meta:
+        raise HTTPException(status_code=404, detail="Blob not found")
+    
+    if not meta.get("public"):
+        # Receipts: admins and the customer who sent them. <img> cannot set
+        # headers, so the JWT may come as ?token= as for /events.
+        if credentials is None and token:
+            credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+        if credentials is None:
+            raise HTTPException(status_code=401, detail="Not authenticated")
+        user = await get_current_user(credentials)
+        if user.role != "admin" and not await db.transactions.find_one(
+                {"user_id": user.id, "receipt_url": blob_store.url(digest)}, {"_id": 1}):
+            raise HTTPException(status_code=403, detail="Unauthorized")
+    
+    # Content-addressed, so the bytes behind a URL never change
+    etag = f'"{digest}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"{'public' if meta.get('public') else 'private'}, max-age=31536000, immutable",
+        "Accept-Ranges": "bytes",
+    }
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    
+    size = meta["size"]
+    start, end, status_code = 0, size - 1, 200
+    range_header = request.headers.get("range")
+    if range_header and request.headers.get("if-range", etag) == etag:
+        byte_range = parse_byte_range(range_header, size)
+        if byte_range is None:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(blob_store.read(digest, start, end), status_code=status_code,
+                             media_type=meta["content_type"], headers=headers)
 
 # Statistics endpoints
 @api_router.get("/stats/low-stock")
 async def get_low_stock(current_user: User = Depends(require_admin)):
-    products = await db.products.find({}, {"_id": 0}).to_list(1000)
-    low_stock = [p for p in products if p["stock"] <= p["low_stock_threshold"]]
-    return low_stock
+    return await low_stock.get(await catalog.version())
+
+@api_router.get("/stats/stock-out")
+async def get_stock_out_projection(days: int = Query(7, ge=1, le=90), current_user: User = Depends(require_admin)):
+    # Products ordered by how soon they run out at their average daily sales over `days`
+    return await projected_stockouts(db, days)
+
+@api_router.get("/stats/user-cache")
+async def get_user_cache_stats(current_user: User = Depends(require_admin)):
+    stats = user_cache.stats()
+    stats["broadcast"] = user_cache_channel is not None
+    if user_cache_channel:
+        stats["broadcast_received"] = user_cache_channel.received
+    return stats
+
+@api_router.get("/stats/password-hasher")
+async def get_password_hasher_stats(current_user: User = Depends(require_admin)):
+    return password_hasher.stats()
+
+@api_router.get("/stats/sales-summary")
+async def get_sales_summary(
+    from_: datetime = Query(..., alias="from"),
+    to: Optional[datetime] = None,
+    group_by: str = Query("payment_method", pattern="^(product|seller|payment_method)$"),
+    interval: Optional[str] = Query(None, pattern="^(hour|day)$"),
+    current_user: User = Depends(require_admin)
+):
+    # Answered from sales_rollups at hour precision
+    start = _as_utc(from_)
+    end = _as_utc(to) if to else datetime.now(timezone.utc)
+    if end <= start:
+        raise HTTPException(status_code=400, detail="'to' must be after 'from'")
+    rows = await sales_summary(db, start, end, group_by, interval)
+    return {
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "group_by": group_by,
+        "interval": interval,
+        "rows": rows,
+    }
+
+@api_router.get("/stats/archive")
+async def get_archive_stats(current_user: User = Depends(require_admin)):
+    return await archive.stats()
+
+@api_router.get("/stats/ledger")
+async def get_ledger_stats(current_user: User = Depends(require_admin)):
+    return ledger_maintenance.stats()
+
+@api_router.get("/health/ready")
+async def get_readiness():
+    # Unauthenticated, for load balancer and orchestrator probes
+    try:
+        await asyncio.wait_for(client.admin.command("ping"), READINESS_TIMEOUT_SECONDS)
+        mongo = {"ok": True}
+    except Exception as e:
+        mongo = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+    ready = mongo["ok"] and bootstrap.ready
+    body = {
+        "ready": ready,
+        "mongo": {**mongo, "transactions": await supports_transactions() if mongo["ok"] else None},
+        "bootstrap": bootstrap.status(),
+        "pool": {"options": MONGO_POOL_OPTIONS, "servers": metrics.pool_stats()},
+    }
+    return ORJSONResponse(body, status_code=200 if ready else 503)
+
+@api_router.get("/events")
+async def stream_events(
+    request: Request,
+    topics: Optional[str] = None,
+    since: Optional[int] = None,
+    token: Optional[str] = None,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer(auto_error=False)),
+):
+    # Server-sent events. EventSource cannot set headers, so the JWT may come
+    # as ?token=; it resends Last-Event-ID by itself when reconnecting.
+    if credentials is None and token:
+        credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+    if credentials is None:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    user = await get_current_user(credentials)
+    
+    # Admins see every topic; everyone else the catalog and their own events
+    allowed = None if user.role == "admin" else {"catalog", f"user:{user.id}"}
+    if user.role == "seller":
+        allowed.add("sales")
+    wanted = set(topics.split(",")) if topics else None
+    if wanted is not None and allowed is not None:
+        wanted &= allowed
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id and last_event_id.isdigit():
+        since = int(last_event_id)
+    
+    async def stream():
+        # Subscribed once the response starts, so an aborted request leaves nothing behind
+        subscription = event_bus.subscribe(wanted if wanted is not None else allowed, since)
+        try:
+            yield b"retry: 3000\n\n"
+            async for frame in subscription.frames(EVENTS_HEARTBEAT_SECONDS):
+                yield frame
+        finally:
+            event_bus.unsubscribe(subscription)
+    
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@api_router.get("/stats/rate-limits")
+async def get_rate_limit_stats(current_user: User = Depends(require_admin)):
+    return {**rate_limiter.stats(), "admin_lists": admin_lists.stats()}
+
+@api_router.get("/stats/events")
+async def get_event_stats(current_user: User = Depends(require_admin)):
+    return event_bus.stats()
 
 @api_router.get("/stats/pending-transactions")
 async def get_pending_transactions(current_user: User = Depends(require_admin)):
@@ -576,55 +1778,105 @@ async def get_pending_transactions(current_user: User = Depends(require_admin)):
 # Include the router
 app.include_router(api_router, prefix="/api")
 
+# Inside CORS so a 429 still carries CORS headers, and inside metrics, which resolves the route
+if os.environ.get('RATE_LIMITING', 'true').lower() == 'true':
+    app.add_middleware(RateLimitMiddleware, limiter=rate_limiter, identify=rate_limit_client)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
+# Outermost, so CORS preflights and errors are measured too
+app.add_middleware(
+    MetricsMiddleware,
+    registry=metrics,
+    routes=app.router.routes,
+    slow_ms=float(os.environ.get('SLOW_REQUEST_MS', '0')),
+)
+
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics(request: Request):
+    if METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
+async def create_default_admin() -> bool:
+    async def admin_doc():
+        doc = User(username="admin", role="admin").model_dump()
+        doc["password_hash"] = await hash_password("projeto2025")
+        return doc
+    created = await ensure_user(db, "admin", admin_doc)
+    if created:
+        logger.info("Default admin user created")
+    return created
+
+async def create_opening_balances() -> Optional[int]:
+    # Balances from before the ledger; posted once per database
+    return await ensure_opening_balances(db)
+
+async def create_sample_products() -> int:
+    sample_products = [
+        {"name": "Refrigerante Lata", "price": 4.50, "stock": 50, "category": "Bebidas", "image_url": "https://images.unsplash.com/photo-1625865019845-7b2c89b8a8a9?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NDk1Nzl8MHwxfHNlYXJjaHwxfHxiZXZlcmFnZXN8ZW58MHx8fHwxNzYwMjkyMjAwfDA&ixlib=rb-4.1.0&q=85"},
+        {"name": "Água Mineral", "price": 2.50, "stock": 100, "category": "Bebidas", "image_url": "https://images.unsplash.com/photo-1523677011781-c91d1bbe2f9e?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NDk1Nzl8MHwxfHNlYXJjaHwyfHxiZXZlcmFnZXN8ZW58MHx8fHwxNzYwMjkyMjAwfDA&ixlib=rb-4.1.0&q=85"},
+        {"name": "Café", "price": 3.00, "stock": 30, "category": "Bebidas", "image_url": "https://images.pexels.com/photos/3020919/pexels-photo-3020919.jpeg"},
+        {"name": "Suco Natural", "price": 5.50, "stock": 25, "category": "Bebidas", "image_url": "https://images.pexels.com/photos/3028500/pexels-photo-3028500.jpeg"},
+        {"name": "Salgadinho", "price": 3.50, "stock": 60, "category": "Salgados", "image_url": "https://images.unsplash.com/photo-1688217170693-e821c6e18d72?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NTY2NzB8MHwxfHNlYXJjaHwzfHxzbmFja3N8ZW58MHx8fHwxNzYwMjkyMTk1fDA&ixlib=rb-4.1.0&q=85"},
+        {"name": "Chocolate", "price": 4.00, "stock": 40, "category": "Doces", "image_url": "https://images.unsplash.com/photo-1621939514649-280e2ee25f60?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NTY2NzB8MHwxfHNlYXJjaHwxfHxzbmFja3N8ZW58MHx8fHwxNzYwMjkyMTk1fDA&ixlib=rb-4.1.0&q=85"},
+        {"name": "Biscoitos", "price": 2.00, "stock": 70, "category": "Doces", "image_url": "https://images.unsplash.com/photo-1614735241165-6756e1df61ab?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NTY2NzB8MHwxfHNlYXJjaHwyfHxzbmFja3N8ZW58MHx8fHwxNzYwMjkyMTk1fDA&ixlib=rb-4.1.0&q=85"},
+        {"name": "Bolo Fatia", "price": 6.00, "stock": 20, "category": "Doces", "image_url": "https://images.pexels.com/photos/1640777/pexels-photo-1640777.jpeg"},
+        {"name": "Sanduíche", "price": 8.00, "stock": 15, "category": "Refeições", "image_url": "https://images.unsplash.com/photo-1482049016688-2d3e1b311543?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NTY2NzV8MHwxfHNlYXJjaHwxfHxmb29kfGVufDB8fHx8MTc2MDI5MjIwNXww&ixlib=rb-4.1.0&q=85"},
+        {"name": "Salada", "price": 10.00, "stock": 12, "category": "Refeições", "image_url": "https://images.unsplash.com/photo-1546069901-ba9599a7e63c?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NTY2NzV8MHwxfHNlYXJjaHwyfHxmb29kfGVufDB8fHx8MTc2MDI5MjIwNXww&ixlib=rb-4.1.0&q=85"},
+        {"name": "Pizza Fatia", "price": 7.50, "stock": 18, "category": "Refeições", "image_url": "https://images.unsplash.com/photo-1565299624946-b28f40a0ae38?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NTY2NzV8MHwxfHNlYXJjaHwzfHxmb29kfGVufDB8fHx8MTc2MDI5MjIwNXww&ixlib=rb-4.1.0&q=85"},
+        {"name": "Pacote de Chips", "price": 5.00, "stock": 35, "category": "Salgados", "image_url": "https://images.pexels.com/photos/2122278/pexels-photo-2122278.jpeg"},
+    ]
+    docs = [Product(id=sample_product_id(p["name"]), **p).model_dump() for p in sample_products]
+    inserted = await seed_products(db, docs)
+    if inserted:
+        await catalog_changed({"id": {"$in": [p["id"] for p in inserted]}})
+        logger.info(f"{len(inserted)} sample products created")
+    return len(inserted)
+
 @app.on_event("startup")
 async def startup_db():
-    # Create default admin user
-    admin_exists = await db.users.find_one({"username": "admin"})
-    if not admin_exists:
-        admin = User(username="admin", role="admin")
-        admin_doc = admin.model_dump()
-        admin_doc["password_hash"] = hash_password("projeto2025")
-        await db.users.insert_one(admin_doc)
-        logger.info("Default admin user created")
+    await ensure_indexes(db)
+
+    if user_cache_channel:
+        await user_cache_channel.setup()
+        app.state.user_cache_listener = asyncio.create_task(user_cache_channel.run())
     
-    # Create sample products
-    product_count = await db.products.count_documents({})
-    if product_count == 0:
-        sample_products = [
-            {"name": "Refrigerante Lata", "price": 4.50, "stock": 50, "category": "Bebidas", "image_url": "https://images.unsplash.com/photo-1625865019845-7b2c89b8a8a9?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NDk1Nzl8MHwxfHNlYXJjaHwxfHxiZXZlcmFnZXN8ZW58MHx8fHwxNzYwMjkyMjAwfDA&ixlib=rb-4.1.0&q=85"},
-            {"name": "Água Mineral", "price": 2.50, "stock": 100, "category": "Bebidas", "image_url": "https://images.unsplash.com/photo-1523677011781-c91d1bbe2f9e?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NDk1Nzl8MHwxfHNlYXJjaHwyfHxiZXZlcmFnZXN8ZW58MHx8fHwxNzYwMjkyMjAwfDA&ixlib=rb-4.1.0&q=85"},
-            {"name": "Café", "price": 3.00, "stock": 30, "category": "Bebidas", "image_url": "https://images.pexels.com/photos/3020919/pexels-photo-3020919.jpeg"},
-            {"name": "Suco Natural", "price": 5.50, "stock": 25, "category": "Bebidas", "image_url": "https://images.pexels.com/photos/3028500/pexels-photo-3028500.jpeg"},
-            {"name": "Salgadinho", "price": 3.50, "stock": 60, "category": "Salgados", "image_url": "https://images.unsplash.com/photo-1688217170693-e821c6e18d72?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NTY2NzB8MHwxfHNlYXJjaHwzfHxzbmFja3N8ZW58MHx8fHwxNzYwMjkyMTk1fDA&ixlib=rb-4.1.0&q=85"},
-            {"name": "Chocolate", "price": 4.00, "stock": 40, "category": "Doces", "image_url": "https://images.unsplash.com/photo-1621939514649-280e2ee25f60?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NTY2NzB8MHwxfHNlYXJjaHwxfHxzbmFja3N8ZW58MHx8fHwxNzYwMjkyMTk1fDA&ixlib=rb-4.1.0&q=85"},
-            {"name": "Biscoitos", "price": 2.00, "stock": 70, "category": "Doces", "image_url": "https://images.unsplash.com/photo-1614735241165-6756e1df61ab?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NTY2NzB8MHwxfHNlYXJjaHwyfHxzbmFja3N8ZW58MHx8fHwxNzYwMjkyMTk1fDA&ixlib=rb-4.1.0&q=85"},
-            {"name": "Bolo Fatia", "price": 6.00, "stock": 20, "category": "Doces", "image_url": "https://images.pexels.com/photos/1640777/pexels-photo-1640777.jpeg"},
-            {"name": "Sanduíche", "price": 8.00, "stock": 15, "category": "Refeições", "image_url": "https://images.unsplash.com/photo-1482049016688-2d3e1b311543?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NTY2NzV8MHwxfHNlYXJjaHwxfHxmb29kfGVufDB8fHx8MTc2MDI5MjIwNXww&ixlib=rb-4.1.0&q=85"},
-            {"name": "Salada", "price": 10.00, "stock": 12, "category": "Refeições", "image_url": "https://images.unsplash.com/photo-1546069901-ba9599a7e63c?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NTY2NzV8MHwxfHNlYXJjaHwyfHxmb29kfGVufDB8fHx8MTc2MDI5MjIwNXww&ixlib=rb-4.1.0&q=85"},
-            {"name": "Pizza Fatia", "price": 7.50, "stock": 18, "category": "Refeições", "image_url": "https://images.unsplash.com/photo-1565299624946-b28f40a0ae38?crop=entropy&cs=srgb&fm=jpg&ixid=M3w3NTY2NzV8MHwxfHNlYXJjaHwzfHxmb29kfGVufDB8fHx8MTc2MDI5MjIwNXww&ixlib=rb-4.1.0&q=85"},
-            {"name": "Pacote de Chips", "price": 5.00, "stock": 35, "category": "Salgados", "image_url": "https://images.pexels.com/photos/2122278/pexels-photo-2122278.jpeg"},
-        ]
-        
-        for p in sample_products:
-            product = Product(**p)
-            await db.products.insert_one(product.model_dump())
-        
-        logger.info("Sample products created")
+    await push_engine.start()
+    rollup_catch_up.start()
+    archive.start()
+    await event_bus.start()
+
+    await bootstrap.run({"admin": create_default_admin, "sample_products": create_sample_products,
+                         "opening_balances": create_opening_balances})
+    # After the opening balances, so the first drift check does not report them
+    ledger_maintenance.start()
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    listener = getattr(app.state, "user_cache_listener", None)
+    if listener:
+        listener.cancel()
+    await push_engine.stop()
+    await ledger_maintenance.stop()
+    await rollup_catch_up.stop()
+    await archive.stop()
+    await event_bus.stop()
+    await debt_aging_reports.stop()
+    password_hasher.shutdown()
     client.close()
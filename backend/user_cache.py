@@ -0,0 +1,133 @@
+"""Bounded TTL/LRU cache of authenticated users.
+
+``get_current_user`` consults the cache before hitting ``db.users``. Every
+write to ``users`` must call ``invalidate``; the TTL is the upper bound on how
+stale a cached user (and therefore a role check) can ever be, even if an
+invalidation is missed.
+
+With several uvicorn workers each process has its own cache, so
+``InvalidationChannel`` broadcasts invalidations through a small capped
+collection that every worker tails.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+
+class UserCache:
+    def __init__(self, maxsize: int = 10000, ttl: float = 5.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        # Bumped on every invalidation so a reader that started before it
+        # does not put a stale document back (see `put`).
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value: Any, generation: int) -> None:
+        if self.ttl <= 0 or self.maxsize <= 0 or generation != self.generation:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: str) -> None:
+        self.generation += 1
+        self.invalidations += 1
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self.generation += 1
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class InvalidationChannel:
+    def __init__(self, db, cache: UserCache, collection: str = "user_cache_invalidations",
+                 size_bytes: int = 1024 * 1024):
+        self.db = db
+        self.cache = cache
+        self.collection_name = collection
+        self.size_bytes = size_bytes
+        self.received = 0
+
+    @property
+    def collection(self):
+        return self.db[self.collection_name]
+
+    async def setup(self) -> None:
+        try:
+            await self.db.create_collection(self.collection_name, capped=True, size=self.size_bytes)
+        except CollectionInvalid:
+            pass
+        # A tailable cursor on an empty capped collection dies immediately.
+        if await self.collection.find_one() is None:
+            await self.collection.insert_one({"user_id": None})
+
+    async def publish(self, user_id: str) -> None:
+        try:
+            await self.collection.insert_one({"user_id": user_id})
+        except PyMongoError as e:
+            # Other workers fall back to the TTL bound.
+            logger.warning(f"Could not broadcast user cache invalidation: {e}")
+
+    async def run(self) -> None:
+        last = await self.collection.find_one(sort=[("$natural", -1)])
+        last_id = last["_id"] if last else None
+        while True:
+            try:
+                query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+                cursor = self.collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    async for message in cursor:
+                        last_id = message["_id"]
+                        if message.get("user_id"):
+                            self.received += 1
+                            self.cache.invalidate(message["user_id"])
+                    await asyncio.sleep(0.1)
+            except asyncio.CancelledError:
+                raise
+            except PyMongoError as e:
+                logger.warning(f"User cache invalidation channel interrupted: {e}")
+            # Anything published while we were disconnected is lost, so start
+            # from a clean cache rather than trust entries up to the TTL.
+            self.cache.clear()
+            await asyncio.sleep(1)
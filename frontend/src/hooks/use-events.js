@@ -0,0 +1,35 @@
+import { useEffect, useRef } from 'react';
+
+const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
+
+const EVENT_TYPES = [
+  'catalog.changed',
+  'sale.created',
+  'sale.cancelled',
+  'transaction.created',
+  'transaction.reviewed',
+  'reset'
+];
+
+// Subscribes to the server's change feed. `handlers` maps an event type to a
+// callback receiving its data; EventSource reconnects on its own and resumes
+// from the last event id it saw. `reset` means events were missed: reload.
+export function useEvents(handlers, topics) {
+  const handlersRef = useRef(handlers);
+  handlersRef.current = handlers;
+
+  useEffect(() => {
+    const token = localStorage.getItem('token');
+    if (!token || typeof EventSource === 'undefined') return;
+    const params = new URLSearchParams({ token });
+    if (topics) params.set('topics', topics);
+    const source = new EventSource(`${BACKEND_URL}/api/events?${params}`);
+    EVENT_TYPES.forEach(type => {
+      source.addEventListener(type, (event) => {
+        const handler = handlersRef.current[type];
+        if (handler) handler(JSON.parse(event.data));
+      });
+    });
+    return () => source.close();
+  }, [topics]);
+}
@@ -4,3 +4,40 @@ import { twMerge } from "tailwind-merge"
 export function cn(...inputs) {
   return twMerge(clsx(inputs));
 }
+
+// Applies rows from a change event to a list: rows already listed are merged
+// in place, new ones are added and `removedId` is dropped. `compare`, when
+// given, sorts the result the way the server lists it.
+export function upsertById(rows, changed = [], removedId = null, compare = null) {
+  const byId = new Map(changed.map(row => [row.id, row]));
+  const merged = rows
+    .filter(row => row.id !== removedId)
+    .map(row => {
+      const update = byId.get(row.id);
+      if (!update) return row;
+      byId.delete(row.id);
+      return { ...row, ...update };
+    });
+  const result = [...byId.values(), ...merged];
+  return compare ? result.sort(compare) : result;
+}
+
+// Patches rows already in the list and ignores the rest
+export function patchById(rows, changed = []) {
+  const byId = new Map(changed.map(row => [row.id, row]));
+  return rows.map(row => (byId.has(row.id) ? { ...row, ...byId.get(row.id) } : row));
+}
+
+// GET /products lists the catalog by id, descending
+export function byIdDescending(a, b) {
+  return a.id < b.id ? 1 : a.id > b.id ? -1 : 0;
+}
+
+// Blob URLs are stored relative to the API (/api/blobs/<hash>); the frontend
+// is served from another origin, so they are resolved against the backend.
+// Receipts are private: pass `token` to send the JWT, as <img> cannot.
+export function blobUrl(url, token = null) {
+  if (!url || !url.startsWith('/') || url.startsWith('//')) return url;
+  const query = token ? `?${new URLSearchParams({ token })}` : '';
+  return `${process.env.REACT_APP_BACKEND_URL}${url}${query}`;
+}
@@ -1,6 +1,8 @@
 import { useState, useEffect } from 'react';
 import { useNavigate } from 'react-router-dom';
 import { useAuth, useTheme } from '@/App';
+import { useEvents } from '@/hooks/use-events';
+import { blobUrl, byIdDescending, patchById, upsertById } from '@/lib/utils';
 import axios from 'axios';
 import { Button } from '@/components/ui/button';
 import { Card, CardHeader, CardTitle, CardContent } from '@/components/ui/card';
@@ -23,6 +25,16 @@ import {
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
+// Rows per page of the users, transactions and sales lists; the rest are
+// loaded on demand by following X-Next-Cursor
+const PAGE_SIZE = 100;
+
+const listPage = (path, cursor) => axios.get(`${API}/${path}`, { params: { limit: PAGE_SIZE, cursor } });
+
+// Same order as GET /stats/low-stock: furthest below the threshold first
+const lowStockOrder = (a, b) =>
+  (a.stock - a.low_stock_threshold) - (b.stock - b.low_stock_threshold) || a.name.localeCompare(b.name);
+
 export default function AdminDashboard() {
   const navigate = useNavigate();
   const { user } = useAuth();
@@ -35,6 +47,8 @@ export default function AdminDashboard() {
   const [sales, setSales] = useState([]);
   const [lowStock, setLowStock] = useState([]);
   const [pendingCount, setPendingCount] = useState(0);
+  // Next-page cursor of each paginated list, undefined on its last page
+  const [cursors, setCursors] = useState({});
   
   // Product form
   const [showProductForm, setShowProductForm] = useState(false);
@@ -61,13 +75,40 @@ export default function AdminDashboard() {
     fetchData();
   }, []);
 
+  // Live updates: events carry the changed rows, which are patched into the
+  // lists instead of refetching them
+  const applyCatalogChange = ({ products: changed, deleted_id }) => {
+    setProducts(current => upsertById(current, changed, deleted_id, byIdDescending));
+    const low = changed.filter(p => p.stock <= p.low_stock_threshold);
+    const restocked = new Set(changed.filter(p => p.stock > p.low_stock_threshold).map(p => p.id));
+    setLowStock(current => upsertById(
+      current.filter(p => !restocked.has(p.id)), low, deleted_id, lowStockOrder
+    ));
+  };
+
+  const applyTransaction = (transaction, created) => {
+    setTransactions(current => (created ? upsertById(current, [transaction]) : patchById(current, [transaction])));
+    // transaction.reviewed is only sent for a pending transaction
+    if (created && transaction.status !== 'pending') return;
+    setPendingCount(count => (created ? count + 1 : Math.max(0, count - 1)));
+  };
+
+  useEvents({
+    'catalog.changed': applyCatalogChange,
+    'sale.created': (sale) => setSales(current => upsertById(current, [sale])),
+    'sale.cancelled': (sale) => setSales(current => patchById(current, [sale])),
+    'transaction.created': (transaction) => applyTransaction(transaction, true),
+    'transaction.reviewed': (transaction) => applyTransaction(transaction, false),
+    reset: () => fetchData()
+  });
+
   const fetchData = async () => {
     try {
       const [usersRes, productsRes, transactionsRes, salesRes, lowStockRes, pendingRes] = await Promise.all([
-        axios.get(`${API}/users`),
+        listPage('users'),
         axios.get(`${API}/products`),
-        axios.get(`${API}/transactions`),
-        axios.get(`${API}/sales`),
+        listPage('transactions'),
+        listPage('sales'),
         axios.get(`${API}/stats/low-stock`),
         axios.get(`${API}/stats/pending-transactions`)
       ]);
@@ -78,11 +119,41 @@ export default function AdminDashboard() {
       setSales(salesRes.data);
       setLowStock(lowStockRes.data);
       setPendingCount(pendingRes.data.count);
+      setCursors({
+        users: usersRes.headers['x-next-cursor'],
+        transactions: transactionsRes.headers['x-next-cursor'],
+        sales: salesRes.headers['x-next-cursor']
+      });
     } catch (error) {
       console.error('Failed to fetch data:', error);
     }
   };
 
+  const loadMore = async (path, setRows) => {
+    try {
+      const response = await listPage(path, cursors[path]);
+      // Rows added by live events may show up again on a later page
+      setRows(current => {
+        const listed = new Set(current.map(row => row.id));
+        return [...current, ...response.data.filter(row => !listed.has(row.id))];
+      });
+      setCursors(current => ({ ...current, [path]: response.headers['x-next-cursor'] }));
+    } catch (error) {
+      toast.error('Erro ao carregar mais');
+    }
+  };
+
+  const loadMoreButton = (path, setRows) => cursors[path] && (
+    <Button
+      variant="outline"
+      className="w-full"
+      onClick={() => loadMore(path, setRows)}
+      data-testid={`load-more-${path}`}
+    >
+      Carregar mais
+    </Button>
+  );
+
   // User management
   const updateUserRole = async (userId, newRole) => {
     try {
@@ -391,6 +462,7 @@ export default function AdminDashboard() {
                       </div>
                     </div>
                   ))}
+                  {loadMoreButton('users', setUsers)}
                 </div>
               </CardContent>
             </Card>
@@ -412,7 +484,7 @@ export default function AdminDashboard() {
                   {product.image_url && (
                     <div className="aspect-video overflow-hidden rounded-t-lg">
                       <img
-                        src={product.image_url}
+                        src={blobUrl(product.thumbnail_url || product.image_url)}
                         alt={product.name}
                         className="w-full h-full object-cover"
                       />
@@ -503,7 +575,7 @@ export default function AdminDashboard() {
                         {transaction.receipt_url && (
                           <div>
                             <img
-                              src={transaction.receipt_url}
+                              src={blobUrl(transaction.receipt_url, localStorage.getItem('token'))}
                               alt="Comprovante"
                               className="max-w-xs rounded border"
                             />
@@ -532,6 +604,7 @@ export default function AdminDashboard() {
                       </div>
                     ))
                   )}
+                  {loadMoreButton('transactions', setTransactions)}
                 </div>
               </CardContent>
             </Card>
@@ -557,6 +630,7 @@ export default function AdminDashboard() {
                     <span>Vendas Canceladas:</span>
                     <span className="font-bold text-red-600">{cancelledSales.length}</span>
                   </div>
+                  {loadMoreButton('sales', setSales)}
                 </CardContent>
               </Card>
 
@@ -751,7 +825,7 @@ export default function AdminDashboard() {
                 onChange={(e) => handleImageUpload(e)}
               />
               {productForm.image_url && (
-                <img src={productForm.image_url} alt="Preview" className="max-w-xs rounded" />
+                <img src={blobUrl(productForm.image_url)} alt="Preview" className="max-w-xs rounded" />
               )}
             </div>
           </div>
@@ -1,6 +1,8 @@
 import { useState, useEffect } from 'react';
 import { useNavigate } from 'react-router-dom';
 import { useAuth, useTheme } from '@/App';
+import { useEvents } from '@/hooks/use-events';
+import { blobUrl, byIdDescending, patchById, upsertById } from '@/lib/utils';
 import axios from 'axios';
 import { Button } from '@/components/ui/button';
 import { Card, CardHeader, CardTitle, CardContent } from '@/components/ui/card';
@@ -36,6 +38,8 @@ export default function SellerTerminal() {
   const [cancelSaleId, setCancelSaleId] = useState(null);
   const [cancelReason, setCancelReason] = useState('');
   const [recentSales, setRecentSales] = useState([]);
+  const [quote, setQuote] = useState(null);
+  const [searchResults, setSearchResults] = useState(null);
 
   useEffect(() => {
     fetchProducts();
@@ -44,6 +48,63 @@ export default function SellerTerminal() {
     fetchRecentSales();
   }, []);
 
+  useEvents({
+    // The event carries the written products; patch them in instead of refetching the catalog
+    'catalog.changed': ({ products: changed, deleted_id }) => {
+      setProducts(current => upsertById(current, changed, deleted_id, byIdDescending));
+      setSearchResults(current => current && patchById(current, changed).filter(p => p.id !== deleted_id));
+    },
+    'sale.created': (sale) => {
+      if (sale.seller_id === user?.id) fetchCashDrawer();
+    },
+    'sale.cancelled': (sale) => {
+      if (sale.seller_id === user?.id) fetchCashDrawer();
+    },
+    reset: () => {
+      fetchProducts();
+      fetchCashDrawer();
+    }
+  }, 'catalog,sales');
+
+  // Search runs on the server (accents and typos are tolerated there)
+  useEffect(() => {
+    if (!searchTerm.trim()) {
+      setSearchResults(null);
+      return;
+    }
+    let stale = false;
+    const timer = setTimeout(() => {
+      axios.get(`${API}/products/search`, { params: { q: searchTerm, limit: 200 } })
+        .then(response => {
+          if (!stale) setSearchResults(response.data.items);
+        })
+        .catch(error => {
+          console.error('Failed to search products:', error);
+        });
+    }, 150);
+    return () => {
+      stale = true;
+      clearTimeout(timer);
+    };
+  }, [searchTerm]);
+
+  // Volume pricing is applied by the server; re-quote whenever the cart changes
+  useEffect(() => {
+    if (cart.length === 0) {
+      setQuote(null);
+      return;
+    }
+    let stale = false;
+    axios.post(`${API}/sales/quote`, {
+      items: cart.map(item => ({ product_id: item.id, quantity: item.quantity }))
+    }).then(response => {
+      if (!stale) setQuote(response.data);
+    }).catch(error => {
+      console.error('Failed to quote cart:', error);
+    });
+    return () => { stale = true; };
+  }, [cart]);
+
   const fetchProducts = async () => {
     try {
       const response = await axios.get(`${API}/products`);
@@ -73,8 +134,8 @@ export default function SellerTerminal() {
 
   const fetchRecentSales = async () => {
     try {
-      const response = await axios.get(`${API}/sales`);
-      setRecentSales(response.data.slice(0, 10));
+      const response = await axios.get(`${API}/sales`, { params: { limit: 10 } });
+      setRecentSales(response.data);
     } catch (error) {
       console.error('Failed to fetch sales:', error);
     }
@@ -124,8 +185,18 @@ export default function SellerTerminal() {
     ));
   };
 
+  const unitPrice = (item) => {
+    const line = quote?.lines.find(line => line.product_id === item.id);
+    return line ? line.unit_price : item.price;
+  };
+
   const calculateTotal = () => {
-    return cart.reduce((total, item) => total + (item.price * item.quantity), 0);
+    // The quote's own total, unless the cart changed since it was requested
+    const current = quote && quote.lines.length === cart.length && cart.every((item, i) =>
+      quote.lines[i].product_id === item.id && quote.lines[i].quantity === item.quantity
+    );
+    if (current) return quote.total;
+    return cart.reduce((total, item) => total + (unitPrice(item) * item.quantity), 0);
   };
 
   const calculateChange = () => {
@@ -163,20 +234,14 @@ export default function SellerTerminal() {
           product_id: item.id,
           name: item.name,
           quantity: item.quantity,
-          unit_price: item.price
+          unit_price: unitPrice(item)
         })),
         total: calculateTotal(),
         payment_method: paymentMethod
       };
 
-      const response = await axios.post(`${API}/sales`, saleData);
-
-      // Add sale to cash drawer if payment is cash
-      if (cashDrawer && paymentMethod === 'cash') {
-        await axios.post(`${API}/cash-drawer/${cashDrawer.id}/add-sale`, {
-          sale_id: response.data.id
-        });
-      }
+      // The backend records the sale against the open cash drawer
+      await axios.post(`${API}/sales`, saleData);
 
       toast.success('Venda realizada com sucesso!');
       setCart([]);
@@ -186,7 +251,12 @@ export default function SellerTerminal() {
       fetchCustomers();
       fetchRecentSales();
     } catch (error) {
-      toast.error('Erro ao processar venda');
+      if (error.response?.status === 409 && error.response.data.detail?.quote) {
+        setQuote(error.response.data.detail.quote);
+        toast.error('Preços atualizados, confira o total e confirme novamente');
+      } else {
+        toast.error('Erro ao processar venda');
+      }
     }
   };
 
@@ -211,9 +281,9 @@ export default function SellerTerminal() {
     }
   };
 
-  const filteredProducts = products.filter(p =>
+  const filteredProducts = !searchTerm.trim() ? products : (searchResults ?? products.filter(p =>
     p.name.toLowerCase().includes(searchTerm.toLowerCase())
-  );
+  ));
 
   if (!cashDrawer) {
     return (
@@ -332,7 +402,7 @@ export default function SellerTerminal() {
                   {product.image_url && (
                     <div className="aspect-square overflow-hidden rounded-t-lg">
                       <img
-                        src={product.image_url}
+                        src={blobUrl(product.thumbnail_url || product.image_url)}
                         alt={product.name}
                         className="w-full h-full object-cover"
                       />
@@ -373,7 +443,7 @@ export default function SellerTerminal() {
                         <div className="flex-1">
                           <p className="font-medium text-sm">{item.name}</p>
                           <p className="text-sm text-muted-foreground">
-                            R$ {item.price.toFixed(2)} x {item.quantity}
+                            R$ {unitPrice(item).toFixed(2)} x {item.quantity}
                           </p>
                         </div>
                         <div className="flex items-center gap-2">
@@ -0,0 +1,108 @@
+"""Debt aging: the vectorized pass against a per-customer FIFO loop.
+
+Generates a synthetic fiado history (charges and payments spread over two
+years), checks that ``age_debts`` agrees with a straightforward loop that
+settles each customer's charges oldest first, and times both:
+
+    python -m tests.benchmarks.debt_aging --customers 20000 --charges 2000000
+
+With ``--db`` it instead times ``build_report`` for the last month against
+the database named by MONGO_URL / DB_NAME, including the reads.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "backend"))
+
+from aging import AGE_COLUMNS, AGE_LIMITS, DAY, Movements, age_debts, build_report, month_range  # noqa: E402
+
+YEARS = 2
+
+
+def synthetic(customers: int, charges: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    end = int(datetime(2025, 1, 1, tzinfo=timezone.utc).timestamp()) * 1_000_000
+    span = YEARS * 365 * DAY
+
+    def movements(n: int, scale: float) -> Movements:
+        return Movements(rng.integers(0, customers, n), end - rng.integers(1, span, n),
+                         np.round(rng.exponential(scale, n), 2))
+
+    # Payments cover most, not all, of what was charged
+    return movements(charges, 12.0), movements(charges // 4, 40.0), end
+
+
+def reference(charges: Movements, payments: Movements, customers: int, end: int) -> np.ndarray:
+    aged = np.zeros((customers, len(AGE_COLUMNS)))
+    paid = np.bincount(payments.customers, weights=payments.amounts, minlength=customers)
+    by_customer = {}
+    for code, when, amount in zip(charges.customers.tolist(), charges.times.tolist(), charges.amounts.tolist()):
+        by_customer.setdefault(code, []).append((when, amount))
+    for code, rows in by_customer.items():
+        left = paid[code]
+        for when, amount in sorted(rows):
+            settled = min(left, amount)
+            left -= settled
+            if amount - settled > 0:
+                bucket = int(np.searchsorted(AGE_LIMITS, (end - when) // DAY, side="left"))
+                aged[code, bucket] += amount - settled
+    return aged
+
+
+def bench_arrays(customers: int, charges: int) -> None:
+    charge_rows, payment_rows, end = synthetic(customers, charges)
+    start = end - 31 * DAY
+    began = time.perf_counter()
+    columns = age_debts(charge_rows, payment_rows, customers, start, end)
+    vectorized = time.perf_counter() - began
+    print(f"age_debts: {charges} charges, {len(payment_rows.times)} payments, {customers} customers "
+          f"in {vectorized * 1000:.0f}ms")
+
+    began = time.perf_counter()
+    expected = reference(charge_rows, payment_rows, customers, end)
+    looped = time.perf_counter() - began
+    aged = np.column_stack([columns[name] for name in AGE_COLUMNS])
+    worst = np.abs(aged - expected).max()
+    print(f"per-customer loop: {looped * 1000:.0f}ms ({looped / vectorized:.0f}x slower), "
+          f"max difference {worst:.4f}")
+    if worst > 0.01:
+        sys.exit(1)
+
+
+async def bench_db() -> None:
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(Path(__file__).resolve().parents[2] / "backend" / ".env")
+    client = AsyncIOMotorClient(os.environ["MONGO_URL"])
+    db = client[os.environ["DB_NAME"]]
+    try:
+        start, end = month_range()
+        began = time.perf_counter()
+        frame = await build_report(db, start, end)
+        print(f"build_report: {len(frame)} customers in {time.perf_counter() - began:.2f}s")
+    finally:
+        client.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--customers", type=int, default=20000)
+    parser.add_argument("--charges", type=int, default=2000000)
+    parser.add_argument("--db", action="store_true")
+    args = parser.parse_args()
+    if args.db:
+        asyncio.run(bench_db())
+    else:
+        bench_arrays(args.customers, args.charges)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,452 @@
+"""Mixed-workload load test for the API with per-route latency and Mongo op counts.
+
+Starts the app in-process (httpx ASGI transport) against one of:
+
+* ``--mongo mongod``: a throwaway single-node replica set (``mongod`` on PATH)
+  in a temporary directory, removed afterwards;
+* ``--mongo standin``: mongomock-motor in memory (no server needed, but query
+  costs are not representative);
+* ``--mongo-url``: an existing deployment; the run uses a fresh ``bench_*``
+  database and drops it unless ``--keep``.
+
+The default ``--mongo auto`` picks mongod when available, then the stand-in.
+The run seeds users, products, sales and transactions, then runs each phase
+for ``--duration`` seconds with ``--concurrency`` virtual clients. Each client
+picks scenarios by weight: login bursts, POS checkouts, catalog polling,
+admin listings and transaction reviews. For every route the report has
+throughput, p50/p95/p99 latency, status codes and Mongo operations per
+request (commands seen by a pymongo CommandListener, or collection calls on
+the stand-in). Only responses with the expected status are latency samples;
+the rest (429s, 503s from shed admin lists, errors) are counted per status.
+Rate limiting is off unless ``--rate-limit`` is given, so the numbers measure
+the endpoints rather than the limiter. It is JSON, so runs can be diffed:
+
+    python -m tests.benchmarks.load --output run.json
+    python -m tests.benchmarks.load --compare run.json
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import httpx
+from pymongo import MongoClient, monitoring
+
+BACKEND_DIR = Path(__file__).resolve().parents[2] / "backend"
+sys.path.insert(0, str(BACKEND_DIR))
+
+PASSWORD = "bench-password"
+PAYMENT_METHODS = ["cash", "card", "fiado", "credit"]
+
+PHASES = {
+    "login_burst": {"login": 1},
+    "pos": {"checkout": 6, "catalog": 3, "seller_sales": 1},
+    "mixed": {"login": 1, "checkout": 4, "catalog": 8, "admin_list": 2, "review": 1, "customer": 2},
+}
+
+# Mutable counter of the request in flight; Motor copies the context into
+# its executor threads, so command events land on the right request.
+_ops: contextvars.ContextVar[Optional[List[int]]] = contextvars.ContextVar("bench_ops", default=None)
+_depth: contextvars.ContextVar[int] = contextvars.ContextVar("bench_depth", default=0)
+
+
+class CommandCounter(monitoring.CommandListener):
+    def started(self, event):
+        ops = _ops.get()
+        if ops is not None:
+            ops[0] += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def count_standin_calls():
+    # mongomock emits no command events; count top-level collection calls instead
+    from mongomock.collection import Collection
+
+    def counted(method):
+        def wrapper(*args, **kwargs):
+            token = _depth.set(_depth.get() + 1)
+            try:
+                ops = _ops.get()
+                if ops is not None and _depth.get() == 1:
+                    ops[0] += 1
+                return method(*args, **kwargs)
+            finally:
+                _depth.reset(token)
+        return wrapper
+
+    for name in ("find", "find_one", "insert_one", "insert_many", "update_one", "update_many", "replace_one",
+                 "delete_one", "delete_many", "bulk_write", "aggregate", "count_documents", "distinct",
+                 "find_one_and_update", "find_one_and_replace", "find_one_and_delete"):
+        setattr(Collection, name, counted(getattr(Collection, name)))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_mongod() -> tuple:
+    dbpath = tempfile.mkdtemp(prefix="bench-mongod-")
+    port = free_port()
+    proc = subprocess.Popen(
+        ["mongod", "--dbpath", dbpath, "--port", str(port), "--bind_ip", "127.0.0.1", "--replSet", "bench",
+         "--quiet", "--logpath", os.path.join(dbpath, "mongod.log")],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    url = f"mongodb://127.0.0.1:{port}/?directConnection=true"
+    admin = MongoClient(url, serverSelectionTimeoutMS=20000)
+    admin.admin.command("replSetInitiate", {"_id": "bench", "members": [{"_id": 0, "host": f"127.0.0.1:{port}"}]})
+    deadline = time.monotonic() + 30
+    while not admin.admin.command("hello").get("isWritablePrimary"):
+        if time.monotonic() > deadline:
+            raise RuntimeError("mongod did not become primary")
+        time.sleep(0.2)
+    admin.close()
+
+    def cleanup():
+        proc.terminate()
+        proc.wait(timeout=30)
+        shutil.rmtree(dbpath, ignore_errors=True)
+    return url, cleanup
+
+
+def drop_database(url: str, db_name: str) -> None:
+    client = MongoClient(url)
+    client.drop_database(db_name)
+    client.close()
+
+
+def setup_backend(args) -> tuple:
+    """Point MONGO_URL/DB_NAME at the chosen backend; must run before `import server`."""
+    mode = args.mongo
+    if args.mongo_url:
+        mode = "url"
+    elif mode == "auto":
+        mode = "mongod" if shutil.which("mongod") else "standin"
+
+    cleanup = None
+    db_name = f"bench_{os.getpid()}"
+    if mode == "url":
+        url = args.mongo_url
+        if not args.keep:
+            cleanup = partial(drop_database, url, db_name)
+    elif mode == "mongod":
+        url, cleanup = start_mongod()
+    else:
+        import motor.motor_asyncio
+        from mongomock_motor import AsyncMongoMockClient
+        motor.motor_asyncio.AsyncIOMotorClient = AsyncMongoMockClient
+        count_standin_calls()
+        url = "mongodb://standin"
+    if mode != "standin":
+        monitoring.register(CommandCounter())
+
+    os.environ['MONGO_URL'] = url
+    os.environ['DB_NAME'] = db_name
+    os.environ['BCRYPT_ROUNDS'] = str(args.bcrypt_rounds)
+    os.environ['RATE_LIMITING'] = 'true' if args.rate_limit else 'false'
+    os.environ.setdefault('LEDGER_MAINTENANCE_SECONDS', '0')
+    os.environ.setdefault('BLOB_DIR', tempfile.mkdtemp(prefix="bench-blobs-"))
+    return mode, cleanup
+
+
+async def seed(server, args, rng: random.Random) -> dict:
+    db = server.db
+    password_hash = await server.hash_password(PASSWORD)
+    now = datetime.now(timezone.utc)
+
+    def user(name: str, role: str = "customer", **fields) -> dict:
+        doc = server.User(username=name, role=role, **fields).model_dump()
+        doc["password_hash"] = password_hash
+        return doc
+
+    admin = user("bench-admin", "admin")
+    sellers = [user(f"bench-seller-{i}", "seller") for i in range(max(1, args.users // 50))]
+    customers = [user(f"bench-customer-{i}", credit=rng.choice([0, 0, 20, 50]), debt=rng.choice([0, 0, 15]))
+                 for i in range(args.users)]
+    products = [
+        server.Product(name=f"Bench product {i}", price=round(rng.uniform(1, 30), 2), stock=1_000_000,
+                       category=rng.choice(["Bebidas", "Salgados", "Doces", "Refeições"])).model_dump()
+        for i in range(args.products)
+    ]
+
+    def sale() -> dict:
+        items = [
+            server.SaleItem(product_id=p["id"], name=p["name"], quantity=rng.randint(1, 3), unit_price=p["price"])
+            for p in rng.sample(products, min(len(products), rng.randint(1, 4)))
+        ]
+        doc = server.Sale(
+            seller_id=rng.choice(sellers)["id"], customer_id=rng.choice(customers)["id"], items=items,
+            total=round(sum(i.quantity * i.unit_price for i in items), 2),
+            payment_method=rng.choice(PAYMENT_METHODS),
+        ).model_dump()
+        doc["timestamp"] = (now - timedelta(minutes=rng.randint(0, 60 * 24 * 30))).isoformat()
+        return doc
+
+    def transaction() -> dict:
+        doc = server.Transaction(
+            user_id=rng.choice(customers)["id"], type=rng.choice(["credit_add", "debt_payment"]),
+            amount=float(rng.randint(5, 50)), receipt_url="/api/blobs/" + "0" * 64,
+            status=rng.choice(["pending", "pending", "approved", "rejected"]),
+        ).model_dump()
+        doc["timestamp"] = (now - timedelta(minutes=rng.randint(0, 60 * 24 * 30))).isoformat()
+        return doc
+
+    async def insert(collection, make: Callable[[], dict], count: int, chunk: int = 1000):
+        for start in range(0, count, chunk):
+            await collection.insert_many([make() for _ in range(min(chunk, count - start))])
+
+    await db.users.insert_many([admin, *sellers, *customers])
+    await db.products.insert_many(products)
+    await insert(db.sales, sale, args.sales)
+    await insert(db.transactions, transaction, args.transactions)
+    await server.catalog_changed()
+
+    pending = await db.transactions.find({"status": "pending"}, {"_id": 0, "id": 1}).to_list(None)
+    return {
+        "admin": admin,
+        "sellers": sellers,
+        "customers": customers,
+        "products": products,
+        "pending": [t["id"] for t in pending],
+        "tokens": {u["id"]: server.create_access_token({"user_id": u["id"]}) for u in [admin, *sellers, *customers]},
+    }
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.ops: Dict[str, List[int]] = defaultdict(list)
+        self.statuses: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    async def call(self, http: httpx.AsyncClient, label: str, method: str, url: str, expected=(200,), **kwargs):
+        ops = [0]
+        token = _ops.set(ops)
+        start = time.perf_counter()
+        try:
+            response = await http.request(method, url, **kwargs)
+            status = str(response.status_code)
+        except Exception as e:
+            response, status = None, type(e).__name__
+        finally:
+            _ops.reset(token)
+        self.statuses[label][status] += 1
+        if response is None or response.status_code not in expected:
+            self.errors[label] += 1
+            return response
+        self.latencies[label].append((time.perf_counter() - start) * 1000)
+        self.ops[label].append(ops[0])
+        return response
+
+
+def auth(data: dict, user: dict) -> dict:
+    return {"Authorization": f"Bearer {data['tokens'][user['id']]}"}
+
+
+def make_scenarios(data: dict, rec: Recorder, rng: random.Random) -> Dict[str, Callable]:
+    admin_headers = auth(data, data["admin"])
+    etag = {"value": None}
+
+    async def login(http):
+        user = rng.choice(data["customers"])
+        await rec.call(http, "POST /api/auth/login", "POST", "/api/auth/login",
+                       json={"username": user["username"], "password": PASSWORD})
+
+    async def checkout(http):
+        seller = rng.choice(data["sellers"])
+        items = [
+            {"product_id": p["id"], "name": p["name"], "quantity": rng.randint(1, 3), "unit_price": p["price"]}
+            for p in rng.sample(data["products"], min(len(data["products"]), rng.randint(1, 4)))
+        ]
+        sale = {
+            "customer_id": rng.choice(data["customers"])["id"],
+            "items": items,
+            "total": round(sum(i["quantity"] * i["unit_price"] for i in items), 2),
+            "payment_method": rng.choice(PAYMENT_METHODS),
+        }
+        await rec.call(http, "POST /api/sales", "POST", "/api/sales", json=sale, headers=auth(data, seller))
+
+    async def catalog(http):
+        headers = {"Accept-Encoding": "gzip"}
+        if etag["value"]:
+            headers["If-None-Match"] = etag["value"]
+        r = await rec.call(http, "GET /api/products", "GET", "/api/products", expected=(200, 304), headers=headers)
+        if r is not None and r.headers.get("etag"):
+            etag["value"] = r.headers["etag"]
+
+    async def seller_sales(http):
+        await rec.call(http, "GET /api/sales (seller)", "GET", "/api/sales?limit=50",
+                       headers=auth(data, rng.choice(data["sellers"])))
+
+    async def customer(http):
+        user = rng.choice(data["customers"])
+        path = rng.choice(["/api/sales", "/api/transactions", "/api/auth/me"])
+        await rec.call(http, f"GET {path} (customer)", "GET", path, headers=auth(data, user))
+
+    async def admin_list(http):
+        path = rng.choice(["/api/users", "/api/sales", "/api/transactions", "/api/cash-drawer/history"])
+        await rec.call(http, f"GET {path}?limit=100", "GET", f"{path}?limit=100", headers=admin_headers)
+
+    async def review(http):
+        batch = [data["pending"].pop() for _ in range(min(20, len(data["pending"])))]
+        if not batch:
+            return await admin_list(http)
+        reviews = [{"transaction_id": tid, "status": rng.choice(["approved", "rejected"])} for tid in batch]
+        await rec.call(http, "POST /api/transactions/review-batch", "POST", "/api/transactions/review-batch",
+                       json={"reviews": reviews}, headers=admin_headers)
+
+    return {"login": login, "checkout": checkout, "catalog": catalog, "seller_sales": seller_sales,
+            "customer": customer, "admin_list": admin_list, "review": review}
+
+
+def percentile(samples: List[float], q: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 2)
+
+
+async def run_phase(http, name: str, mix: Dict[str, int], data: dict, args, rng: random.Random) -> dict:
+    rec = Recorder()
+    scenarios = make_scenarios(data, rec, rng)
+    names, weights = list(mix), list(mix.values())
+    deadline = time.perf_counter() + args.duration
+
+    async def client_loop():
+        while time.perf_counter() < deadline:
+            await scenarios[rng.choices(names, weights)[0]](http)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client_loop() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start
+
+    routes = {}
+    for label in sorted(rec.statuses):
+        samples = rec.latencies[label]
+        routes[label] = {
+            "requests": len(samples),
+            "rps": round(len(samples) / elapsed, 1),
+            "p50_ms": percentile(samples, 0.50),
+            "p95_ms": percentile(samples, 0.95),
+            "p99_ms": percentile(samples, 0.99),
+            "mean_ms": round(statistics.fmean(samples), 2) if samples else None,
+            "errors": rec.errors[label],
+            "status": dict(rec.statuses[label]),
+            "mongo_ops_per_request": round(statistics.fmean(rec.ops[label]), 2) if samples else None,
+        }
+    total = sum(r["requests"] for r in routes.values())
+    errors = sum(r["errors"] for r in routes.values())
+    return {"phase": name, "mix": mix, "concurrency": args.concurrency, "seconds": round(elapsed, 2),
+            "requests": total, "rps": round(total / elapsed, 1), "errors": errors, "routes": routes}
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous: dict, current: dict) -> List[dict]:
+    before = {(p["phase"], label): r for p in previous["phases"] for label, r in p["routes"].items()}
+    rows = []
+    for phase in current["phases"]:
+        for label, r in phase["routes"].items():
+            old = before.get((phase["phase"], label))
+            if not old:
+                continue
+            rows.append({
+                "phase": phase["phase"],
+                "route": label,
+                "rps": [old["rps"], r["rps"]],
+                "p95_ms": [old["p95_ms"], r["p95_ms"]],
+                "p99_ms": [old["p99_ms"], r["p99_ms"]],
+                "mongo_ops_per_request": [old["mongo_ops_per_request"], r["mongo_ops_per_request"]],
+            })
+    return rows
+
+
+async def main(args) -> dict:
+    started_at = datetime.now(timezone.utc).isoformat()
+    mode, cleanup = setup_backend(args)
+    try:
+        import server
+        rng = random.Random(args.seed)
+        await server.startup_db()
+        data = await seed(server, args, rng)
+        transport = httpx.ASGITransport(app=server.app)
+        phases = []
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as http:
+            for name in args.phases:
+                phases.append(await run_phase(http, name, PHASES[name], data, args, rng))
+        await server.shutdown_db_client()
+    finally:
+        if cleanup:
+            cleanup()
+    return {
+        "meta": {
+            "started_at": started_at,
+            "revision": git_revision(),
+            "backend": mode,
+            "python": platform.python_version(),
+            "seed": args.seed,
+            "volumes": {"users": args.users, "products": args.products, "sales": args.sales,
+                        "transactions": args.transactions},
+            "bcrypt_rounds": args.bcrypt_rounds,
+            "rate_limiting": args.rate_limit,
+            "duration": args.duration,
+        },
+        "phases": phases,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mongo", choices=["auto", "mongod", "standin"], default="auto")
+    parser.add_argument("--mongo-url", help="use an existing deployment instead of a throwaway one")
+    parser.add_argument("--keep", action="store_true", help="keep the bench database with --mongo-url")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--products", type=int, default=200)
+    parser.add_argument("--sales", type=int, default=5000)
+    parser.add_argument("--transactions", type=int, default=1000)
+    parser.add_argument("--phases", nargs="+", choices=list(PHASES), default=list(PHASES))
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per phase")
+    parser.add_argument("--concurrency", type=int, default=32, help="virtual clients per phase")
+    parser.add_argument("--bcrypt-rounds", type=int, default=10)
+    parser.add_argument("--rate-limit", action="store_true", help="keep the per-client rate limits on")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for data and workload")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="previous JSON report to compare against")
+    args = parser.parse_args()
+
+    report = asyncio.run(main(args))
+    if args.compare:
+        report["comparison"] = compare(json.loads(Path(args.compare).read_text()), report)
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    else:
+        print(text)
@@ -0,0 +1,116 @@
+"""p99 latency of GET /api/products while logins hammer bcrypt.
+
+Runs the app in-process (httpx ASGI transport) against the database named by
+MONGO_URL / DB_NAME, once with hashing inline on the event loop
+(PASSWORD_HASH_WORKERS=0, the old behaviour) and once on the worker pool:
+
+    python -m tests.benchmarks.login_contention --logins 16 --duration 10
+
+Rate limiting is turned off (unless RATE_LIMITING is set) so the logins reach
+bcrypt; responses other than 200 are counted apart from the latency samples.
+
+Use a throwaway database: the run seeds `bench-login-*` users.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "backend"))
+os.environ.setdefault("RATE_LIMITING", "false")
+
+import server  # noqa: E402
+from passwords import PasswordHasher  # noqa: E402
+
+PASSWORD = "bench-password"
+
+
+def percentile(samples, q):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def seed_users(count: int, rounds: int):
+    hasher = PasswordHasher(rounds=rounds, workers=0)
+    password_hash = await hasher.hash(PASSWORD)
+    for i in range(count):
+        user = server.User(username=f"bench-login-{i}")
+        doc = user.model_dump()
+        doc["password_hash"] = password_hash
+        await server.db.users.update_one({"username": user.username}, {"$setOnInsert": doc}, upsert=True)
+
+
+async def run_mode(http, workers: int, rounds: int, logins: int, pollers: int, duration: float):
+    server.password_hasher = PasswordHasher(rounds=rounds, workers=workers, max_pending=10 * logins)
+    deadline = time.perf_counter() + duration
+    product_latencies = []
+    login_count = 0
+    # "route status" -> responses that were not a 200
+    rejected = {}
+
+    def reject(route: str, status: int):
+        key = f"{route} {status}"
+        rejected[key] = rejected.get(key, 0) + 1
+
+    async def login_loop(i: int):
+        nonlocal login_count
+        while time.perf_counter() < deadline:
+            r = await http.post("/api/auth/login", json={"username": f"bench-login-{i}", "password": PASSWORD})
+            if r.status_code == 200:
+                login_count += 1
+            else:
+                reject("login", r.status_code)
+
+    async def poll_loop():
+        while True:
+            start = time.perf_counter()
+            r = await http.get("/api/products")
+            if r.status_code == 200:
+                product_latencies.append((time.perf_counter() - start) * 1000)
+            else:
+                reject("products", r.status_code)
+            if start >= deadline:
+                break
+
+    # Pollers are scheduled first so they are measured even when inline
+    # hashing starves the loop.
+    await asyncio.gather(*[poll_loop() for _ in range(pollers)], *[login_loop(i) for i in range(logins)])
+    server.password_hasher.shutdown()
+    return {
+        "mode": "inline" if workers == 0 else f"pool({workers})",
+        "logins_per_s": round(login_count / duration, 1),
+        "products_requests": len(product_latencies),
+        "products_p50_ms": round(percentile(product_latencies, 0.50), 2),
+        "products_p99_ms": round(percentile(product_latencies, 0.99), 2),
+        "products_mean_ms": round(statistics.fmean(product_latencies), 2),
+        "rejected": rejected,
+    }
+
+
+async def main(args):
+    await server.startup_db()
+    await seed_users(args.logins, args.rounds)
+    transport = httpx.ASGITransport(app=server.app)
+    results = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+        for workers in (0, args.workers):
+            results.append(await run_mode(http, workers, args.rounds, args.logins, args.pollers, args.duration))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--logins", type=int, default=16, help="concurrent login loops")
+    parser.add_argument("--pollers", type=int, default=4, help="concurrent /api/products loops")
+    parser.add_argument("--workers", type=int, default=4, help="hash pool size for the 'after' run")
+    parser.add_argument("--rounds", type=int, default=12, help="bcrypt cost")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per mode")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,123 @@
+"""Throughput of the list endpoints with and without the fast serialization path.
+
+Runs the app in-process (httpx ASGI transport) against the database named by
+MONGO_URL / DB_NAME. Each endpoint is requested with a full page
+(limit=1000) for a fixed time, first with a model built and re-validated per
+row (FAST_SERIALIZATION off, the old path) and then with raw documents
+serialized by orjson:
+
+    python -m tests.benchmarks.serialization --rows 5000 --duration 5
+
+Rate limiting is turned off (unless RATE_LIMITING is set); responses other
+than 200 are counted separately and left out of the rates.
+
+Use a throwaway database: the run seeds `bench-ser-*` users and matching
+sales, transactions and cash drawers.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "backend"))
+os.environ.setdefault("RATE_LIMITING", "false")
+
+import server  # noqa: E402
+
+ENDPOINTS = [
+    "/api/users?limit=1000",
+    "/api/products?limit=1000",
+    "/api/sales?limit=1000",
+    "/api/transactions?limit=1000",
+    "/api/cash-drawer/history?limit=1000",
+]
+
+
+async def seed(rows: int) -> str:
+    db = server.db
+    admin = server.User(username="bench-ser-admin", role="admin")
+    await db.users.update_one({"username": admin.username}, {"$setOnInsert": admin.model_dump()}, upsert=True)
+    admin_id = (await db.users.find_one({"username": admin.username}))["id"]
+    if await db.users.count_documents({"username": {"$regex": "^bench-ser-"}}) > rows:
+        return admin_id
+
+    products = [server.Product(name=f"bench-ser-product-{i}", price=1 + i % 20, stock=100,
+                               volume_pricing=[{"min_qty": 10, "price": 0.9 + i % 20}]) for i in range(rows)]
+    users = [server.User(username=f"bench-ser-{i}", credit=i % 7, debt=i % 11) for i in range(rows)]
+    sales = [
+        server.Sale(
+            seller_id=admin_id,
+            customer_id=users[i].id,
+            items=[server.SaleItem(product_id=p.id, name=p.name, quantity=1 + j, unit_price=p.price)
+                   for j, p in enumerate(random.sample(products, 3))],
+            total=10.0,
+            payment_method=random.choice(["cash", "fiado", "credit", "card"]),
+        )
+        for i in range(rows)
+    ]
+    transactions = [
+        server.Transaction(user_id=users[i].id, type="credit_add", amount=5.0, receipt_url="/api/blobs/" + "0" * 64)
+        for i in range(rows)
+    ]
+    drawers = [server.CashDrawer(seller_id=admin_id, opening_balance=100.0, sales_count=40,
+                                 totals={"cash": 250.0, "pix": 90.5}) for _ in range(rows)]
+    await db.products.insert_many([p.model_dump() for p in products])
+    await db.users.insert_many([u.model_dump() for u in users])
+    await db.sales.insert_many([s.model_dump() for s in sales])
+    await db.transactions.insert_many([t.model_dump() for t in transactions])
+    await db.cash_drawers.insert_many([d.model_dump() for d in drawers])
+    return admin_id
+
+
+async def measure(http, path: str, duration: float) -> dict:
+    count = 0
+    busy = 0.0
+    body_bytes = 0
+    rejected = {}
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    while time.perf_counter() < deadline:
+        began = time.perf_counter()
+        r = await http.get(path)
+        if r.status_code != 200:
+            rejected[r.status_code] = rejected.get(r.status_code, 0) + 1
+            continue
+        busy += time.perf_counter() - began
+        body_bytes = len(r.content)
+        count += 1
+    elapsed = time.perf_counter() - start
+    return {"requests_per_s": round(count / elapsed, 1),
+            "ms_per_request": round(1000 * busy / count, 2) if count else None,
+            "body_bytes": body_bytes, "rejected": rejected}
+
+
+async def main(args):
+    await server.startup_db()
+    admin_id = await seed(args.rows)
+    headers = {"Authorization": f"Bearer {server.create_access_token({'user_id': admin_id})}"}
+    transport = httpx.ASGITransport(app=server.app)
+    results = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", headers=headers) as http:
+        for path in ENDPOINTS:
+            row = {"endpoint": path}
+            for label, fast in (("pydantic", False), ("orjson", True)):
+                server.FAST_SERIALIZATION = fast
+                await http.get(path)  # warm the user cache and the connection pool
+                row[label] = await measure(http, path, args.duration)
+            if row["pydantic"]["requests_per_s"]:
+                row["speedup"] = round(row["orjson"]["requests_per_s"] / row["pydantic"]["requests_per_s"], 2)
+            results.append(row)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=5000, help="documents seeded per collection")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per endpoint and mode")
+    asyncio.run(main(parser.parse_args()))
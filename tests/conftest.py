@@ -0,0 +1,51 @@
+import asyncio
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+
+@pytest.fixture(scope="session")
+def server(tmp_path_factory):
+    """The API module, imported against an in-memory mongomock database."""
+    import motor.motor_asyncio
+    from mongomock_motor import AsyncMongoMockClient
+    motor.motor_asyncio.AsyncIOMotorClient = AsyncMongoMockClient
+    os.environ.update({
+        "MONGO_URL": "mongodb://standin",
+        "DB_NAME": "api_test",
+        "RATE_LIMITING": "false",
+        "LEDGER_MAINTENANCE_SECONDS": "0",
+        "BLOB_DIR": str(tmp_path_factory.mktemp("blobs")),
+    })
+    import server
+    return server
+
+
+@pytest.fixture
+def api(server, monkeypatch):
+    """``server`` with every collection emptied and a token for a fresh admin."""
+    from archive import Archive
+    from catalog import CatalogSnapshot
+
+    # In-process state that mirrors the collections starts over with them
+    monkeypatch.setattr(server, "catalog", CatalogSnapshot(server.db, server.load_catalog, check_interval=0))
+    monkeypatch.setattr(server, "archive", Archive(server.db))
+    for tracker in (server.low_stock, server.search_index, server.price_book):
+        monkeypatch.setattr(tracker, "synced_version", None)
+
+    async def reset():
+        for name in await server.db.list_collection_names():
+            await server.db.drop_collection(name)
+        admin = server.User(username="admin", role="admin").model_dump()
+        await server.db.users.insert_one(dict(admin))
+        return admin
+
+    admin = asyncio.run(reset())
+    from fastapi.testclient import TestClient
+    client = TestClient(server.app)
+    client.headers["Authorization"] = "Bearer " + server.create_access_token({"user_id": admin["id"]})
+    return client
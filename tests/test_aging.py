@@ -0,0 +1,118 @@
+"""FIFO debt aging in ``age_debts`` and the month-end report built on it."""
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from mongomock_motor import AsyncMongoMockClient
+
+from aging import DAY, Movements, age_debts, build_report, month_range
+
+END = 1000 * DAY
+START = END - 31 * DAY
+
+
+def days_ago(days: float) -> int:
+    return END - int(days * DAY)
+
+
+def movements(*rows) -> Movements:
+    """(customer code, days before END, amount) rows."""
+    customers, times, amounts = zip(*rows) if rows else ((), (), ())
+    return Movements(np.array(customers, dtype=np.int64), np.array([days_ago(d) for d in times], dtype=np.int64),
+                     np.array(amounts, dtype=np.float64))
+
+
+def aged(columns, customer: int) -> list:
+    return [columns[name][customer] for name in ("aged_0_30", "aged_31_60", "aged_61_90", "aged_over_90")]
+
+
+def test_payments_settle_the_oldest_charges_first():
+    columns = age_debts(movements((0, 100, 10.0), (0, 45, 20.0), (0, 10, 5.0)), movements((0, 5, 15.0)), 1, START, END)
+    assert aged(columns, 0) == [5.0, 15.0, 0.0, 0.0]
+    assert columns["oldest_unpaid"][0] == days_ago(45)
+    assert (columns["opening"][0], columns["charges"][0], columns["payments"][0], columns["closing"][0]) == (
+        30.0, 5.0, 15.0, 20.0)
+
+
+def test_age_bucket_boundaries():
+    charges = movements((0, 30, 1.0), (0, 30.5, 2.0), (0, 31, 4.0), (0, 60, 8.0), (0, 90, 16.0), (0, 91, 32.0))
+    columns = age_debts(charges, movements(), 1, START, END)
+    assert aged(columns, 0) == [3.0, 12.0, 16.0, 32.0]
+
+
+def test_overpayment_leaves_nothing_aged():
+    columns = age_debts(movements((0, 40, 10.0)), movements((0, 20, 25.0)), 1, START, END)
+    assert aged(columns, 0) == [0.0, 0.0, 0.0, 0.0]
+    assert columns["closing"][0] == -15.0
+    assert columns["oldest_unpaid"][0] == -1
+
+
+def test_customers_are_aged_independently():
+    # Interleaved in time; customer 2 only ever paid
+    charges = movements((1, 70, 5.0), (0, 50, 10.0), (1, 20, 5.0), (0, 5, 10.0))
+    payments = movements((1, 1, 7.0), (2, 3, 4.0))
+    columns = age_debts(charges, payments, 3, START, END)
+    assert aged(columns, 0) == [10.0, 10.0, 0.0, 0.0]
+    assert aged(columns, 1) == [3.0, 0.0, 0.0, 0.0]
+    assert aged(columns, 2) == [0.0, 0.0, 0.0, 0.0]
+    assert columns["closing"].tolist() == [20.0, 3.0, -4.0]
+    assert columns["oldest_unpaid"].tolist() == [days_ago(50), days_ago(20), -1]
+
+
+def test_movements_after_the_period_are_ignored_and_cents_round_away():
+    charges = movements((0, 10, 10.0), (0, -1, 50.0))
+    payments = movements((0, 2, 9.999), (0, -2, 10.0))
+    columns = age_debts(charges, payments, 1, START, END)
+    assert columns["charges"][0] == 10.0
+    assert columns["payments"][0] == 10.0
+    assert columns["closing"][0] == 0.0
+    assert columns["oldest_unpaid"][0] == -1
+
+
+def test_no_movements_at_all():
+    columns = age_debts(movements(), movements(), 2, START, END)
+    assert columns["closing"].tolist() == [0.0, 0.0]
+    assert columns["oldest_unpaid"].tolist() == [-1, -1]
+
+
+def test_month_range():
+    assert month_range("2024-12") == (datetime(2024, 12, 1, tzinfo=timezone.utc), datetime(2025, 1, 1, tzinfo=timezone.utc))
+    now = datetime(2025, 3, 15, 12, tzinfo=timezone.utc)
+    assert month_range(now=now) == (datetime(2025, 3, 1, tzinfo=timezone.utc), now)
+
+
+def test_report_lists_debtors_from_sales_and_payments():
+    start, end = month_range("2025-03")
+
+    def at(day: int) -> str:
+        return (start + timedelta(days=day)).isoformat()
+
+    async def scenario():
+        db = AsyncMongoMockClient()["aging_test"]
+        await db.users.insert_many([
+            {"id": "ana", "username": "ana", "debt": 12.0},
+            {"id": "bia", "username": "bia", "debt": 0.0},
+            {"id": "caio", "username": "caio", "debt": 7.5},
+        ])
+        await db.sales.insert_many([
+            {"id": "s1", "customer_id": "ana", "payment_method": "fiado", "status": "completed", "timestamp": at(-40), "total": 8.0},
+            {"id": "s2", "customer_id": "ana", "payment_method": "fiado", "status": "completed", "timestamp": at(10), "total": 9.0},
+            {"id": "s3", "customer_id": "ana", "payment_method": "fiado", "status": "cancelled", "timestamp": at(11), "total": 99.0},
+            {"id": "s4", "customer_id": "bia", "payment_method": "cash", "status": "completed", "timestamp": at(12), "total": 5.0},
+            {"id": "s5", "customer_id": "bia", "payment_method": "fiado", "status": "completed", "timestamp": at(-5), "total": 5.0},
+        ])
+        await db.transactions.insert_many([
+            {"id": "t1", "user_id": "ana", "type": "debt_payment", "status": "approved", "timestamp": at(15), "amount": 5.0},
+            {"id": "t2", "user_id": "bia", "type": "debt_payment", "status": "approved", "timestamp": at(1), "amount": 5.0},
+            {"id": "t3", "user_id": "ana", "type": "debt_payment", "status": "pending", "timestamp": at(16), "amount": 50.0},
+        ])
+        return await build_report(db, start, end)
+
+    frame = asyncio.run(scenario())
+    # bia paid everything off and has no recorded debt; caio only has a recorded one
+    assert frame["customer_id"].tolist() == ["ana", "caio"]
+    ana = frame.iloc[0]
+    assert (ana["opening"], ana["charges"], ana["payments"], ana["closing"]) == (8.0, 9.0, 5.0, 12.0)
+    assert (ana["aged_0_30"], ana["aged_31_60"], ana["aged_61_90"]) == (9.0, 0.0, 3.0)
+    assert ana["oldest_unpaid"] == "2025-01-20"
+    assert frame.iloc[1]["closing"] == 0.0 and frame.iloc[1]["debt"] == 7.5
@@ -0,0 +1,144 @@
+"""Monthly archives: moving finished documents and reading live and archived months as one."""
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from mongomock_motor import AsyncMongoMockClient
+
+from archive import Archive, archive_name, merge_sorted
+
+KEYS = ["timestamp", "id"]
+
+
+class Rows:
+    """Stands in for a sorted cursor."""
+
+    def __init__(self, *rows):
+        self.rows = [{"timestamp": t, "id": i, **(extra[0] if extra else {})} for t, i, *extra in rows]
+
+    async def __aiter__(self):
+        for row in self.rows:
+            yield row
+
+
+def merged(*cursors) -> list:
+    async def collect():
+        return [doc async for doc in merge_sorted(list(cursors), KEYS)]
+    return asyncio.run(collect())
+
+
+def test_merge_sorted_interleaves_and_drops_duplicates():
+    live = Rows(("2024-03", "c", {"copy": "live"}), ("2024-01", "a", {"copy": "live"}))
+    archived = Rows(("2024-02", "b"), ("2024-01", "a", {"copy": "archive"}), ("2023-12", "z"))
+    docs = merged(live, archived)
+    assert [d["id"] for d in docs] == ["c", "b", "a", "z"]
+    # Ties go to the first cursor
+    assert docs[2]["copy"] == "live"
+
+
+def test_merge_sorted_with_empty_cursors():
+    assert merged(Rows(), Rows()) == []
+    assert [d["id"] for d in merged(Rows(), Rows(("2024-01", "a")))] == ["a"]
+
+
+def sale(i: int, month: int, status: str = "completed") -> dict:
+    timestamp = datetime(2025, month, 1, tzinfo=timezone.utc) + timedelta(days=i % 27, hours=i)
+    return {"id": f"sale-{i:03d}", "timestamp": timestamp.isoformat(), "status": status, "total": float(i)}
+
+
+def newest_first(docs) -> list:
+    return [d["id"] for d in sorted(docs, key=lambda d: (d["timestamp"], d["id"]), reverse=True)]
+
+
+async def archived_db(docs):
+    db = AsyncMongoMockClient()["archive_test"]
+    await db.sales.insert_many([dict(d) for d in docs])
+    return db, Archive(db, grace=0, state_ttl=0)
+
+
+def test_months_move_in_two_passes_and_read_back_unchanged():
+    docs = ([sale(i, 1) for i in range(10)] + [sale(i, 2) for i in range(10, 20)]
+            + [sale(20, 2, status="pending")])
+
+    async def scenario():
+        db, archive = await archived_db(docs)
+        first = await archive.run_once(after_days=0)
+        copied = await db[archive_name("sales", "2025-01")].count_documents({})
+        live_after_copy = await db.sales.count_documents({})
+        second = await archive.run_once(after_days=0)
+        live = [d["id"] async for d in db.sales.find({}, {"_id": 0, "id": 1})]
+        found = [d["id"] async for d in archive.find("sales", {}, {"_id": 0}, KEYS)]
+        page = [d["id"] async for d in archive.find("sales", {}, {"_id": 0}, KEYS, limit=12)]
+        # As in paginate: the query holds the range, since/until only skip months outside it
+        window = [d["id"] async for d in archive.find("sales", {"timestamp": {"$gte": "2025-01-05", "$lt": "2025-02-04"}},
+                                                     {"_id": 0}, KEYS, since="2025-01-05", until="2025-02-04")]
+        return first, copied, live_after_copy, second, live, found, page, window
+
+    first, copied, live_after_copy, second, live, found, page, window = asyncio.run(scenario())
+    assert first["sales"] == {"copied": 20, "moved": 0}
+    assert (copied, live_after_copy) == (10, 21)
+    assert second["sales"] == {"copied": 0, "moved": 20}
+    # The pending sale of an archived month stays live and is still listed
+    assert live == ["sale-020"]
+    assert found == newest_first(docs)
+    assert page == newest_first(docs)[:12]
+    assert window == newest_first(d for d in docs if "2025-01-05" <= d["timestamp"] < "2025-02-04")
+
+
+def test_changes_between_passes_are_copied_again():
+    docs = [sale(i, 3) for i in range(5)]
+
+    async def scenario():
+        db, archive = await archived_db(docs)
+        await archive.run_once(after_days=0)
+        await db.sales.update_one({"id": "sale-002"}, {"$set": {"status": "cancelled"}})
+        # Listed once while it is in both collections, as the live copy
+        between = [d async for d in archive.find("sales", {}, {"_id": 0}, KEYS)]
+        await archive.run_once(after_days=0)
+        live = await db.sales.count_documents({})
+        after = [d async for d in archive.find("sales", {}, {"_id": 0}, KEYS)]
+        return between, live, after
+
+    between, live, after = asyncio.run(scenario())
+    assert live == 0
+    for found in (between, after):
+        assert [d["id"] for d in found] == newest_first(docs)
+        assert next(d["status"] for d in found if d["id"] == "sale-002") == "cancelled"
+
+
+def test_api_pages_through_archived_months(api, server, monkeypatch):
+    docs = []
+    for i in range(30):
+        doc = server.Sale(id=f"sale-{i:03d}", seller_id="seller", customer_id="customer", items=[], total=float(i),
+                          payment_method="cash").model_dump()
+        doc["timestamp"] = sale(i, 4 + i % 3)["timestamp"]
+        docs.append(doc)
+    asyncio.run(server.db.sales.insert_many([dict(d) for d in docs]))
+    monkeypatch.setattr(server.archive, "grace", 0)
+    monkeypatch.setattr(server.archive, "state_ttl", 0)
+    asyncio.run(server.archive.run_once(after_days=0))
+    asyncio.run(server.archive.run_once(after_days=0))
+    assert asyncio.run(server.db.sales.count_documents({})) == 0
+
+    ids, params = [], {"limit": 7}
+    while True:
+        response = api.get("/api/sales", params=params)
+        ids += [row["id"] for row in response.json()]
+        if "X-Next-Cursor" not in response.headers:
+            break
+        params["cursor"] = response.headers["X-Next-Cursor"]
+    assert ids == newest_first(docs)
+
+
+def test_archived_sales_cannot_be_cancelled(api, server, monkeypatch):
+    doc = server.Sale(seller_id="seller", customer_id="customer", items=[], total=1.0, payment_method="cash").model_dump()
+    doc["timestamp"] = sale(0, 1)["timestamp"]
+    asyncio.run(server.db.sales.insert_one(dict(doc)))
+    monkeypatch.setattr(server.archive, "grace", 0)
+    monkeypatch.setattr(server.archive, "state_ttl", 0)
+    asyncio.run(server.archive.run_once(after_days=0))
+    asyncio.run(server.archive.run_once(after_days=0))
+
+    response = api.post(f"/api/sales/{doc['id']}/cancel", json={"reason": "wrong item"})
+    assert response.status_code == 409
+    assert response.json()["detail"] == "Sale archived, cannot cancel"
+    assert api.post("/api/sales/unknown/cancel", json={"reason": "wrong item"}).status_code == 404
@@ -0,0 +1,84 @@
+"""Blob uploads and GET /blobs/<hash>: catalog images are public, receipts are not."""
+import asyncio
+import base64
+import io
+
+from PIL import Image
+
+
+def png_data_url(color=(200, 30, 30)) -> str:
+    buffer = io.BytesIO()
+    Image.new("RGB", (600, 400), color).save(buffer, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+def digest(url: str) -> str:
+    return url.rsplit("/", 1)[1]
+
+
+def customer(server, user_id: str) -> dict:
+    asyncio.run(server.db.users.insert_one(server.User(id=user_id, username=user_id).model_dump()))
+    return {"Authorization": "Bearer " + server.create_access_token({"user_id": user_id})}
+
+
+def test_product_images_are_stored_once_and_served_to_anyone(api, server):
+    image = png_data_url()
+    first = api.post("/api/products", json={"name": "Café", "price": 3.0, "stock": 5, "image_url": image}).json()
+    second = api.post("/api/products", json={"name": "Chá", "price": 2.0, "stock": 5, "image_url": image}).json()
+    assert first["image_url"] == second["image_url"] == f"/api/blobs/{digest(first['image_url'])}"
+    assert first["thumbnail_url"].startswith("/api/blobs/")
+
+    anonymous = {"Authorization": ""}
+    response = api.get(first["image_url"], headers=anonymous)
+    assert response.status_code == 200
+    assert response.content == base64.b64decode(image.split(",", 1)[1])
+    assert response.headers["content-type"] == "image/png"
+    assert response.headers["cache-control"] == "public, max-age=31536000, immutable"
+    assert api.get(first["thumbnail_url"], headers=anonymous).status_code == 200
+
+    etag = response.headers["etag"]
+    assert api.get(first["image_url"], headers={**anonymous, "If-None-Match": etag}).status_code == 304
+    part = api.get(first["image_url"], headers={**anonymous, "Range": "bytes=0-9"})
+    assert part.status_code == 206 and part.content == response.content[:10]
+    assert api.get("/api/blobs/" + "0" * 64).status_code == 404
+
+
+def test_receipts_are_only_served_to_their_customer_and_admins(api, server):
+    ana, bia = customer(server, "ana"), customer(server, "bia")
+    created = api.post("/api/transactions", headers=ana,
+                       json={"type": "credit_add", "amount": 10.0, "receipt_data": png_data_url((0, 90, 0))})
+    assert created.status_code == 200
+    url = created.json()["receipt_url"]
+    assert url == f"/api/blobs/{digest(url)}"
+
+    assert api.get(url, headers={"Authorization": ""}).status_code == 401
+    assert api.get(url, headers=bia).status_code == 403
+    own = api.get(url, headers=ana)
+    assert own.status_code == 200
+    assert own.headers["cache-control"].startswith("private")
+    assert api.get(url).status_code == 200
+    # <img> tags send the token in the query string
+    token = ana["Authorization"].split()[1]
+    assert api.get(url, params={"token": token}, headers={"Authorization": ""}).status_code == 200
+
+
+def test_a_receipt_reused_as_a_product_image_becomes_public(api, server):
+    ana = customer(server, "ana")
+    image = png_data_url((0, 0, 200))
+    url = api.post("/api/transactions", headers=ana,
+                   json={"type": "credit_add", "amount": 5.0, "receipt_data": image}).json()["receipt_url"]
+    api.post("/api/products", json={"name": "Suco", "price": 4.0, "stock": 1, "image_url": image})
+    assert api.get(url, headers={"Authorization": ""}).status_code == 200
+
+
+def test_migration_marks_product_images_stored_before_the_flag_public(api, server):
+    from blobs import migrate_inline_images
+
+    product = api.post("/api/products", json={"name": "Café", "price": 3.0, "stock": 5,
+                                              "image_url": png_data_url()}).json()
+    asyncio.run(server.db.blobs.update_many({}, {"$unset": {"public": ""}}))
+    assert api.get(product["image_url"], headers={"Authorization": ""}).status_code == 401
+    counts = asyncio.run(migrate_inline_images(server.db, server.blob_store))
+    assert counts["public"] == 1
+    assert api.get(product["image_url"], headers={"Authorization": ""}).status_code == 200
+    assert api.get(product["thumbnail_url"], headers={"Authorization": ""}).status_code == 200
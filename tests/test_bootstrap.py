@@ -0,0 +1,56 @@
+"""First-run setup that several workers can run at once, and the readiness probe."""
+import asyncio
+
+from mongomock_motor import AsyncMongoMockClient
+
+from bootstrap import Bootstrap, ensure_user, sample_product_id, seed_products
+from indexes import ensure_indexes
+
+
+def test_workers_racing_create_one_admin_and_one_catalog():
+    docs = [{"id": sample_product_id(name), "name": name} for name in ("Café", "Bolo", "Suco")]
+
+    async def scenario():
+        db = AsyncMongoMockClient()["bootstrap_test"]
+        await ensure_indexes(db)
+        admins = await asyncio.gather(*(ensure_user(db, "admin", make_admin) for _ in range(3)))
+        inserted = await asyncio.gather(*(seed_products(db, [dict(d) for d in docs]) for _ in range(3)))
+        again = await seed_products(db, [dict(d) for d in docs])
+        return admins, inserted, again, await db.users.count_documents({}), await db.products.count_documents({})
+
+    async def make_admin() -> dict:
+        return {"id": "admin-id", "username": "admin"}
+
+    admins, inserted, again, users, products = asyncio.run(scenario())
+    assert admins.count(True) == 1 and users == 1
+    assert sorted(d["name"] for batch in inserted for d in batch) == ["Bolo", "Café", "Suco"]
+    assert (again, products) == ([], 3)
+    assert sample_product_id("Café") == docs[0]["id"]
+
+
+def test_a_failed_step_is_reported_instead_of_raised():
+    async def admin():
+        return True
+
+    async def products():
+        raise RuntimeError("no space left")
+
+    bootstrap = Bootstrap()
+    asyncio.run(bootstrap.run({"admin": admin, "sample_products": products, "never": admin}))
+    status = bootstrap.status()
+    assert not bootstrap.ready
+    assert (status["state"], status["steps"], status["error"]) == (
+        "failed", {"admin": True}, "RuntimeError: no space left")
+
+
+def test_readiness_waits_for_the_bootstrap(api, server, monkeypatch):
+    monkeypatch.setattr(server, "bootstrap", Bootstrap())
+    pending = api.get("/api/health/ready")
+    assert (pending.status_code, pending.json()["bootstrap"]["state"]) == (503, "pending")
+
+    async def nothing():
+        return 0
+
+    asyncio.run(server.bootstrap.run({"admin": nothing}))
+    ready = api.get("/api/health/ready")
+    assert ready.status_code == 200 and ready.json()["ready"]
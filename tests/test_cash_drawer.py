@@ -0,0 +1,62 @@
+"""Cash drawer totals kept by sales and cancellations, and the closing count."""
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def shop(api, server):
+    async def seed():
+        await server.db.products.insert_one(server.Product(id="coffee", name="Café", price=3.0, stock=10).model_dump())
+        await server.db.users.insert_one(server.User(id="ana", username="ana").model_dump())
+    asyncio.run(seed())
+    return api
+
+
+def sell(api, quantity: int = 2) -> dict:
+    response = api.post("/api/sales", json={
+        "customer_id": "ana", "payment_method": "cash", "total": 3.0 * quantity,
+        "items": [{"product_id": "coffee", "name": "Café", "quantity": quantity, "unit_price": 3.0}],
+    })
+    assert response.status_code == 200
+    return response.json()
+
+
+def drawer(server, drawer_id: str) -> dict:
+    return asyncio.run(server.db.cash_drawers.find_one({"id": drawer_id}, {"_id": 0}))
+
+
+def test_cancelling_in_an_open_drawer_takes_the_sale_back_out(shop, server):
+    opened = shop.post("/api/cash-drawer", json={"opening_balance": 50.0}).json()
+    kept, cancelled = sell(shop), sell(shop, 1)
+    assert shop.post(f"/api/sales/{cancelled['id']}/cancel", json={"reason": "wrong item"}).status_code == 200
+
+    closed = shop.post(f"/api/cash-drawer/{opened['id']}/close", json={"closing_balance": 56.0}).json()
+    assert kept["drawer_id"] == opened["id"]
+    assert (closed["sales_count"], closed["totals"], closed["cancelled_count"]) == (1, {"cash": 6.0}, 1)
+    assert (closed["expected_balance"], closed["difference"]) == (56.0, 0.0)
+
+
+def test_cancelling_after_the_close_leaves_the_closed_drawer_alone(shop, server):
+    first = shop.post("/api/cash-drawer", json={"opening_balance": 50.0}).json()
+    sale = sell(shop)
+    shop.post(f"/api/cash-drawer/{first['id']}/close", json={"closing_balance": 56.0})
+    before = drawer(server, first["id"])
+    second = shop.post("/api/cash-drawer", json={"opening_balance": 20.0}).json()
+
+    assert shop.post(f"/api/sales/{sale['id']}/cancel", json={"reason": "returned"}).status_code == 200
+    assert drawer(server, first["id"]) == before
+    # The refund is paid from the drawer that is open now
+    current = drawer(server, second["id"])
+    assert (current["sales_count"], current["totals"], current["cancelled_count"]) == (0, {"cash": -6.0}, 1)
+    closed = shop.post(f"/api/cash-drawer/{second['id']}/close", json={"closing_balance": 14.0}).json()
+    assert (closed["expected_balance"], closed["difference"]) == (14.0, 0.0)
+
+
+def test_cancelling_with_no_drawer_open_changes_no_drawer(shop, server):
+    first = shop.post("/api/cash-drawer", json={"opening_balance": 50.0}).json()
+    sale = sell(shop)
+    shop.post(f"/api/cash-drawer/{first['id']}/close", json={"closing_balance": 56.0})
+    before = drawer(server, first["id"])
+    assert shop.post(f"/api/sales/{sale['id']}/cancel", json={"reason": "returned"}).status_code == 200
+    assert drawer(server, first["id"]) == before
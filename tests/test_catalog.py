@@ -0,0 +1,54 @@
+"""The versioned catalog snapshot behind GET /products."""
+import asyncio
+import gzip
+import json
+
+from mongomock_motor import AsyncMongoMockClient
+
+from catalog import CatalogSnapshot, etag_matches
+
+
+def test_etag_matching():
+    assert etag_matches('"a", W/"b"', '"b"')
+    assert etag_matches("*", '"a"')
+    assert not etag_matches('"a"', '"b"')
+    assert not etag_matches(None, '"a"')
+
+
+def test_snapshot_is_built_once_per_version():
+    loads = []
+
+    async def load() -> bytes:
+        loads.append(1)
+        return json.dumps({"load": len(loads)}).encode()
+
+    async def scenario():
+        snapshot = CatalogSnapshot(AsyncMongoMockClient()["catalog_test"], load, check_interval=0)
+        first, again = await snapshot.get(), await snapshot.get()
+        await snapshot.bump()
+        return first, again, await snapshot.get(), snapshot.builds
+
+    first, again, bumped, builds = asyncio.run(scenario())
+    assert again is first
+    assert (bumped.version, builds) == (first.version + 1, 2)
+    assert gzip.decompress(bumped.gzip_body) == bumped.body
+    assert bumped.etag != first.etag
+
+
+def test_products_answer_304_until_the_catalog_changes(api, server):
+    api.post("/api/products", json={"name": "Café", "price": 3.0, "stock": 5})
+    first = api.get("/api/products", headers={"Accept-Encoding": "identity"})
+    assert [p["name"] for p in first.json()] == ["Café"]
+    etag = first.headers["etag"]
+    assert api.get("/api/products", headers={"If-None-Match": etag}).status_code == 304
+
+    zipped = api.get("/api/products", headers={"Accept-Encoding": "gzip"})
+    assert zipped.headers["content-encoding"] == "gzip" and zipped.headers["etag"] != etag
+    assert zipped.json() == first.json()
+
+    product_id = first.json()[0]["id"]
+    api.put(f"/api/products/{product_id}", json={"name": "Café", "price": 3.5, "stock": 5})
+    changed = api.get("/api/products", headers={"If-None-Match": etag, "Accept-Encoding": "identity"})
+    assert changed.status_code == 200
+    assert changed.json()[0]["price"] == 3.5
+    assert int(changed.headers["x-catalog-version"]) > int(first.headers["x-catalog-version"])
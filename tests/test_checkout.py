@@ -0,0 +1,61 @@
+"""POST /sales: stock, balance, ledger and drawer move together or not at all."""
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def shop(api, server):
+    async def seed():
+        await server.db.products.insert_many([
+            server.Product(id="coffee", name="Café", price=3.0, stock=5).model_dump(),
+            server.Product(id="cake", name="Bolo", price=6.0, stock=1).model_dump(),
+        ])
+        await server.db.users.insert_one(server.User(id="ana", username="ana").model_dump())
+    asyncio.run(seed())
+    api.post("/api/cash-drawer", json={"opening_balance": 0.0})
+    return api
+
+
+def sale(*lines, payment_method: str = "fiado") -> dict:
+    prices = {"coffee": 3.0, "cake": 6.0}
+    return {
+        "customer_id": "ana", "payment_method": payment_method,
+        "items": [{"product_id": pid, "name": pid, "quantity": qty, "unit_price": prices[pid]} for pid, qty in lines],
+        "total": sum(prices[pid] * qty for pid, qty in lines),
+    }
+
+
+def state(server) -> tuple:
+    async def read():
+        stock = {doc["id"]: doc["stock"] async for doc in server.db.products.find({}, {"_id": 0})}
+        ana = await server.db.users.find_one({"id": "ana"})
+        drawer = await server.db.cash_drawers.find_one({})
+        return (stock, ana["debt"], await server.db.balance_ledger.count_documents({}),
+                drawer["sales_count"], await server.db.sales.count_documents({}))
+    return asyncio.run(read())
+
+
+def test_a_sale_moves_everything_at_once(shop, server):
+    response = shop.post("/api/sales", json=sale(("coffee", 2), ("cake", 1)))
+    assert response.status_code == 200
+    assert state(server) == ({"coffee": 3, "cake": 0}, 12.0, 1, 1, 1)
+
+
+def test_one_short_item_fails_the_whole_sale(shop, server):
+    before = state(server)
+    response = shop.post("/api/sales", json=sale(("coffee", 2), ("cake", 2)))
+    assert response.status_code == 409
+    assert response.json()["detail"]["items"] == [
+        {"product_id": "cake", "name": "Bolo", "requested": 2, "available": 1}]
+    assert state(server) == before
+
+
+def test_client_prices_that_differ_get_the_current_quote(shop, server):
+    before = state(server)
+    stale = sale(("coffee", 1))
+    stale["items"][0]["unit_price"], stale["total"] = 2.5, 2.5
+    response = shop.post("/api/sales", json=stale)
+    assert response.status_code == 409
+    assert response.json()["detail"]["quote"]["total"] == 3.0
+    assert state(server) == before
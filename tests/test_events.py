@@ -0,0 +1,75 @@
+"""The SSE change feed: topic filtering, resuming from Last-Event-ID, broadcast ordering."""
+import asyncio
+
+from events import EventBus
+
+
+def drain(subscription) -> list:
+    frames = []
+    while not subscription.queue.empty():
+        frames.append(subscription.queue.get_nowait().decode())
+    return frames
+
+
+def event_types(subscription) -> list:
+    return [frame.split("\n")[1].removeprefix("event: ") for frame in drain(subscription)]
+
+
+def test_subscribers_only_get_their_topics():
+    bus = EventBus(db=None)
+    everything, catalog = bus.subscribe(None), bus.subscribe({"catalog"})
+    bus.publish("catalog.changed", {"products": []}, ["catalog"])
+    bus.publish("sale.created", {"id": "s1"}, ["sales", "user:ana"])
+    assert event_types(everything) == ["catalog.changed", "sale.created"]
+    assert event_types(catalog) == ["catalog.changed"]
+    assert drain(bus.subscribe({"user:bia"})) == []
+
+
+def test_reconnecting_clients_get_what_they_missed_or_a_reset():
+    bus = EventBus(db=None, buffer_size=3)
+    for i in range(5):
+        bus.publish("sale.created", {"id": i}, ["sales"])
+    resumed = drain(bus.subscribe({"sales"}, since=3))
+    assert [frame.split("\n")[0] for frame in resumed] == ["id: 4", "id: 5"]
+    assert drain(bus.subscribe({"sales"}, since=5)) == []
+    # Event 2 fell out of the buffer, and 9 comes from before a restart
+    for since in (1, 9):
+        assert event_types(bus.subscribe({"sales"}, since=since)) == ["reset"]
+
+
+def test_a_slow_client_is_cut_off_instead_of_buffered():
+    bus = EventBus(db=None, client_queue=2)
+    slow = bus.subscribe(None)
+    for i in range(3):
+        bus.publish("sale.created", {"id": i}, ["sales"])
+    assert slow.overflowed
+
+
+def test_broadcast_events_are_delivered_in_sequence_order():
+    bus = EventBus(db=None, broadcast=True)
+    subscription = bus.subscribe(None)
+    for seq in (2, 3):
+        bus._receive({"seq": seq, "type": "sale.created", "topics": ["sales"], "data": {"id": seq}})
+    assert drain(subscription) == []
+    bus._receive({"seq": 1, "type": "sale.created", "topics": ["sales"], "data": {"id": 1}})
+    assert [frame.split("\n")[0] for frame in drain(subscription)] == ["id: 1", "id: 2", "id: 3"]
+    # A gap that never fills is skipped
+    bus._receive({"seq": 5, "type": "sale.created", "topics": ["sales"], "data": {"id": 5}})
+    bus._flush(skip_gap=True)
+    assert [frame.split("\n")[0] for frame in drain(subscription)] == ["id: 5"]
+
+
+def test_write_paths_publish_their_changes(api, server):
+    asyncio.run(server.db.users.insert_one(server.User(id="ana", username="ana").model_dump()))
+    subscription = server.event_bus.subscribe({"catalog", "user:ana"})
+    try:
+        product = api.post("/api/products", json={"name": "Café", "price": 3.0, "stock": 5}).json()
+        api.post("/api/sales", json={"customer_id": "ana", "payment_method": "cash", "total": 3.0, "items": [
+            {"product_id": product["id"], "name": "Café", "quantity": 1, "unit_price": 3.0}]})
+        frames = drain(subscription)
+    finally:
+        server.event_bus.unsubscribe(subscription)
+    types = [frame.split("\n")[1].removeprefix("event: ") for frame in frames]
+    assert types == ["catalog.changed", "catalog.changed", "sale.created"]
+    # The stock change carries the whole product, as screens patch it in place
+    assert '"stock":4' in frames[1] and '"name":"Caf' in frames[1]
@@ -0,0 +1,54 @@
+"""The index registry and the query-plan check."""
+import asyncio
+
+from mongomock_motor import AsyncMongoMockClient
+
+from indexes import CANONICAL_QUERIES, INDEXES, check_query_plans, ensure_indexes
+
+
+def test_the_registry_applies_idempotently():
+    async def scenario():
+        db = AsyncMongoMockClient()["indexes_test"]
+        # Same name, other keys: that collection is logged and skipped, the rest still applied
+        await db.users.create_index("email", name="username_unique")
+        await ensure_indexes(db)
+        await ensure_indexes(db)
+        return {name: await db[name].index_information() for name in INDEXES}
+
+    applied = asyncio.run(scenario())
+    for collection, models in INDEXES.items():
+        if collection != "users":
+            assert set(applied[collection]) == {"_id_"} | {m.document["name"] for m in models}
+    assert applied["users"]["username_unique"]["key"] == [("email", 1)]
+
+
+class Plans:
+    """Answers explain() with a collection scan for the collections listed."""
+
+    def __init__(self, scanned):
+        self.scanned = scanned
+
+    def __getitem__(self, collection):
+        return self.Cursor(collection in self.scanned)
+
+    class Cursor:
+        def __init__(self, scan):
+            self.scan = scan
+
+        def find(self, query):
+            return self
+
+        def sort(self, keys):
+            return self
+
+        async def explain(self):
+            inner = {"stage": "COLLSCAN"} if self.scan else {"stage": "IXSCAN", "indexName": "id_unique"}
+            return {"queryPlanner": {"winningPlan": {"stage": "FETCH", "inputStage": inner}}}
+
+
+def test_collection_scans_are_reported_per_route():
+    assert asyncio.run(check_query_plans(Plans(set()))) == []
+    failures = asyncio.run(check_query_plans(Plans({"push_subscriptions"})))
+    assert failures == ["subscribe_push: push_subscriptions.find({'user_id': ''}) -> FETCH <- COLLSCAN"]
+    assert len(asyncio.run(check_query_plans(Plans({"sales"})))) == sum(
+        collection == "sales" for _, collection, _, _ in CANONICAL_QUERIES)
@@ -0,0 +1,94 @@
+"""The balance ledger: opening balances, and ledger sums that follow the cached balances."""
+import asyncio
+from datetime import datetime, timezone
+
+from mongomock_motor import AsyncMongoMockClient
+
+from ledger import (balance_as_of, ensure_opening_balances, find_drift, ledger_entry, post_opening_balances,
+                    take_snapshots)
+
+LATER = datetime(2030, 1, 1, tzinfo=timezone.utc)
+
+
+def test_opening_balances_leave_out_movements_already_in_the_ledger():
+    async def scenario():
+        db = AsyncMongoMockClient()["ledger_test"]
+        # ana owed 20 before the ledger; a 5.0 sale on credit since then is in both places
+        await db.users.insert_many([
+            {"id": "ana", "username": "ana", "credit": 0.0, "debt": 25.0},
+            {"id": "bia", "username": "bia", "credit": 3.0, "debt": 0.0},
+            {"id": "caio", "username": "caio", "credit": 0.0, "debt": 4.0},
+        ])
+        await db.balance_ledger.insert_many([
+            ledger_entry("ana", {"debt": 5.0}, "sale", "s1", "2025-03-02T10:00:00+00:00"),
+            ledger_entry("caio", {"debt": 4.0}, "sale", "s2", "2025-03-02T11:00:00+00:00"),
+        ])
+        drift_before = [row["user_id"] for row in await find_drift(db)]
+        await take_snapshots(db, until=datetime(2025, 3, 5, tzinfo=timezone.utc))
+        posted = await post_opening_balances(db)
+        again = await post_opening_balances(db)
+        opening = await db.balance_ledger.find_one({"reason": "opening_balance", "user_id": "ana"}, {"_id": 0})
+        balances = {user: await balance_as_of(db, user, LATER) for user in ("ana", "bia", "caio")}
+        return drift_before, posted, again, opening, balances, await find_drift(db)
+
+    drift_before, posted, again, opening, balances, drift_after = asyncio.run(scenario())
+    assert drift_before == ["ana", "bia"]
+    assert (posted, again) == (2, 0)
+    assert opening["debt"] == 20.0
+    assert opening["timestamp"] < "2025-03-02T10:00:00+00:00"
+    assert balances == {"ana": {"credit": 0.0, "debt": 25.0}, "bia": {"credit": 3.0, "debt": 0.0},
+                        "caio": {"credit": 0.0, "debt": 4.0}}
+    assert drift_after == []
+
+
+def test_opening_balances_run_once_per_database():
+    async def scenario():
+        db = AsyncMongoMockClient()["ledger_once_test"]
+        await db.users.insert_one({"id": "ana", "username": "ana", "credit": 0.0, "debt": 7.0})
+        first = await ensure_opening_balances(db)
+        await db.users.insert_one({"id": "bia", "username": "bia", "credit": 0.0, "debt": 1.0})
+        return first, await ensure_opening_balances(db)
+
+    assert asyncio.run(scenario()) == (1, None)
+
+
+def test_every_balance_change_through_the_api_is_in_the_ledger(api, server):
+    from indexes import ensure_indexes
+
+    async def seed():
+        await ensure_indexes(server.db)
+        await server.db.products.insert_one(server.Product(id="coffee", name="Café", price=3.0, stock=50).model_dump())
+        await server.db.users.insert_one(server.User(id="ana", username="ana").model_dump())
+    asyncio.run(seed())
+    ana = {"Authorization": "Bearer " + server.create_access_token({"user_id": "ana"})}
+
+    def sell(payment_method: str, quantity: int) -> dict:
+        return api.post("/api/sales", json={
+            "customer_id": "ana", "payment_method": payment_method, "total": 3.0 * quantity,
+            "items": [{"product_id": "coffee", "name": "Café", "quantity": quantity, "unit_price": 3.0}],
+        }).json()
+
+    def transaction(kind: str, amount: float) -> str:
+        return api.post("/api/transactions", headers=ana,
+                        json={"type": kind, "amount": amount, "receipt_data": ""}).json()["id"]
+
+    credit = transaction("credit_add", 20.0)
+    api.patch(f"/api/transactions/{credit}/review", json={"status": "approved"})
+    # A second approval is refused rather than crediting twice
+    assert api.patch(f"/api/transactions/{credit}/review", json={"status": "approved"}).status_code == 400
+    sell("fiado", 4)
+    cancelled = sell("fiado", 2)
+    api.post(f"/api/sales/{cancelled['id']}/cancel", json={"reason": "wrong customer"})
+    sell("credit", 1)
+    payment, rejected = transaction("debt_payment", 5.0), transaction("debt_payment", 7.0)
+    review = api.post("/api/transactions/review-batch", json={"reviews": [
+        {"transaction_id": payment, "status": "approved"}, {"transaction_id": rejected, "status": "rejected"}]})
+    assert review.json()["applied"] == 2
+
+    user = asyncio.run(server.db.users.find_one({"id": "ana"}))
+    assert (user["credit"], user["debt"]) == (17.0, 7.0)
+    reasons = sorted(e["reason"] for e in asyncio.run(server.db.balance_ledger.find({"user_id": "ana"}).to_list(None)))
+    assert reasons == ["credit_add", "debt_payment", "sale", "sale", "sale", "sale_cancelled"]
+    balance = api.get("/api/users/ana/balance", headers=ana).json()
+    assert (balance["credit"], balance["debt"]) == (17.0, 7.0)
+    assert asyncio.run(find_drift(server.db)) == []
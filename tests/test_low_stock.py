@@ -0,0 +1,51 @@
+"""The incrementally kept low-stock set behind /stats/low-stock."""
+import asyncio
+
+from low_stock import LowStockTracker
+
+
+def low(api) -> list:
+    response = api.get("/api/stats/low-stock")
+    assert response.status_code == 200
+    return [(row["name"], row["stock"]) for row in response.json()]
+
+
+def product(api, name: str, stock: int, threshold: int = 10) -> str:
+    return api.post("/api/products", json={"name": name, "price": 2.0, "stock": stock,
+                                           "low_stock_threshold": threshold}).json()["id"]
+
+
+def test_writes_move_products_in_and_out_of_the_set(api, server):
+    asyncio.run(server.db.users.insert_one(server.User(id="ana", username="ana").model_dump()))
+    coffee = product(api, "Café", 12)
+    cake = product(api, "Bolo", 3, threshold=5)
+    product(api, "Água", 50)
+    assert low(api) == [("Bolo", 3)]
+
+    api.post("/api/sales", json={"customer_id": "ana", "payment_method": "cash", "total": 6.0, "items": [
+        {"product_id": coffee, "name": "Café", "quantity": 3, "unit_price": 2.0}]})
+    # Furthest below its threshold first
+    assert low(api) == [("Bolo", 3), ("Café", 9)]
+
+    api.put(f"/api/products/{cake}", json={"name": "Bolo", "price": 2.0, "stock": 30, "low_stock_threshold": 5})
+    api.delete(f"/api/products/{coffee}")
+    assert low(api) == []
+
+
+def test_a_change_from_another_worker_reloads_the_set(api, server):
+    product(api, "Café", 12)
+    assert low(api) == []
+    # Written elsewhere: only the catalog version tells this worker
+    asyncio.run(server.db.products.update_one({"name": "Café"}, {"$set": {"stock": 1}}))
+    asyncio.run(server.catalog.bump())
+    assert low(api) == [("Café", 1)]
+
+
+def test_only_consecutive_versions_keep_the_set_synced():
+    tracker = LowStockTracker(db=None)
+    tracker.synced_version = 4
+    tracker.advance(5)
+    assert tracker.synced_version == 5
+    # Version 6 was another worker's
+    tracker.advance(7)
+    assert tracker.synced_version is None
@@ -0,0 +1,40 @@
+"""Per-route request metrics and the /metrics endpoint."""
+from metrics import Histogram, MetricsRegistry, RequestStats
+
+
+def test_histograms_render_cumulative_buckets():
+    histogram = Histogram((0.1, 1.0))
+    for value in (0.05, 0.5, 0.7, 3.0):
+        histogram.observe(value)
+    assert (histogram.counts, histogram.count) == ([1, 2], 4)
+
+    registry = MetricsRegistry()
+    stats = RequestStats("GET", '/api/odd"route')
+    stats.commands.append(("find", "products", 0.002, 3, True))
+    registry.request_started(stats)
+    registry.request_finished(stats, 200, 0.02)
+    registry.command('/api/odd"route', "find", "products", 0.002, 3, False)
+    text = registry.render()
+    labels = 'method="GET",route="/api/odd\\"route"'
+    assert f"http_requests_in_flight{{{labels}}} 0" in text
+    assert f'http_requests_total{{{labels},status="200"}} 1' in text
+    assert f'http_request_duration_seconds_bucket{{{labels},le="0.01"}} 0' in text
+    assert f'http_request_duration_seconds_bucket{{{labels},le="0.025"}} 1' in text
+    assert f'http_request_mongo_commands_bucket{{{labels},le="1"}} 1' in text
+    assert 'mongo_command_failures_total{route="/api/odd\\"route",command="find",collection="products"} 1' in text
+
+
+def test_requests_are_filed_under_their_route_template(api, server):
+    def count(method: str, route: str, status: int) -> int:
+        return server.metrics.requests.get((method, route, status), 0)
+
+    before = [count("DELETE", "/api/products/{product_id}", 404), count("GET", "/api/products/{product_id}", 405),
+              count("GET", "unmatched", 404)]
+    api.delete("/api/products/no-such-product")
+    api.delete("/api/products/another-one")
+    # Only PUT and DELETE exist there: a partial match keeps the template
+    api.get("/api/products/no-such-product")
+    api.get("/no/such/path")
+    assert [count("DELETE", "/api/products/{product_id}", 404), count("GET", "/api/products/{product_id}", 405),
+            count("GET", "unmatched", 404)] == [before[0] + 2, before[1] + 1, before[2] + 1]
+    assert 'route="/api/products/{product_id}",status="404"}' in api.get("/metrics").text
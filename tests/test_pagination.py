@@ -0,0 +1,86 @@
+"""Keyset pagination of the list endpoints: following X-Next-Cursor to the end."""
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone
+
+START = datetime(2025, 5, 1, tzinfo=timezone.utc)
+
+
+def insert_sales(server, count: int) -> list:
+    # Every third sale shares its timestamp with the one before, so ties are broken by id
+    sales = []
+    for i in range(count):
+        sale = server.Sale(
+            id=f"sale-{i:03d}", seller_id="seller", customer_id=f"customer-{i % 3}", total=float(i),
+            items=[server.SaleItem(product_id="p", name="p", quantity=1, unit_price=float(i))], payment_method="cash",
+        ).model_dump()
+        sale["timestamp"] = (START + timedelta(minutes=i - (i % 3 == 2))).isoformat()
+        sales.append(sale)
+    asyncio.run(server.db.sales.insert_many([dict(s) for s in sales]))
+    return sorted(sales, key=lambda s: (s["timestamp"], s["id"]), reverse=True)
+
+
+def follow(api, path: str, headers=None, **params) -> list:
+    pages = []
+    while True:
+        response = api.get(path, params=params, headers=headers)
+        assert response.status_code == 200
+        pages.append([row["id"] for row in response.json()])
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            return pages
+        params["cursor"] = cursor
+
+
+def test_pages_cover_every_row_once_in_order(api, server):
+    expected = [s["id"] for s in insert_sales(server, 25)]
+    pages = follow(api, "/api/sales", limit=10)
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert sum(pages, []) == expected
+
+
+def test_exact_multiple_of_the_page_size_ends_without_a_cursor(api, server):
+    expected = [s["id"] for s in insert_sales(server, 20)]
+    pages = follow(api, "/api/sales", limit=10)
+    assert sum(pages, []) == expected
+    assert [len(page) for page in pages] == [10, 10]
+
+
+def test_rows_inserted_between_pages_do_not_shift_them(api, server):
+    expected = [s["id"] for s in insert_sales(server, 12)]
+    first = api.get("/api/sales", params={"limit": 5})
+    newer = server.Sale(seller_id="seller", customer_id="customer-0", items=[], total=0.0, payment_method="cash")
+    asyncio.run(server.db.sales.insert_one(newer.model_dump()))
+    rest = follow(api, "/api/sales", limit=5, cursor=first.headers["X-Next-Cursor"])
+    assert [row["id"] for row in first.json()] + sum(rest, []) == expected
+
+
+def test_time_window_with_cursor(api, server):
+    sales = insert_sales(server, 30)
+    since, until = START + timedelta(minutes=5), START + timedelta(minutes=20)
+    expected = [s["id"] for s in sales if since.isoformat() <= s["timestamp"] < until.isoformat()]
+    pages = follow(api, "/api/sales", limit=4, since=since.isoformat(), until=until.isoformat())
+    assert sum(pages, []) == expected
+
+
+def test_customers_only_page_through_their_own_sales(api, server):
+    sales = insert_sales(server, 15)
+    customer = server.User(id="customer-1", username="customer-1").model_dump()
+    asyncio.run(server.db.users.insert_one(dict(customer)))
+    token = server.create_access_token({"user_id": "customer-1"})
+    pages = follow(api, "/api/sales", headers={"Authorization": f"Bearer {token}"}, limit=2)
+    assert sum(pages, []) == [s["id"] for s in sales if s["customer_id"] == "customer-1"]
+
+
+def test_invalid_cursors_are_rejected(api, server):
+    insert_sales(server, 3)
+    for cursor in ("not-base64!", server.encode_cursor(["only one key"]), server.encode_cursor({"a": 1})):
+        assert api.get("/api/sales", params={"cursor": cursor}).status_code == 400
+
+
+def test_ndjson_streams_every_row(api, server):
+    expected = [s["id"] for s in insert_sales(server, 7)]
+    response = api.get("/api/sales", params={"format": "ndjson"})
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert [json.loads(line)["id"] for line in response.text.splitlines()] == expected
+    assert server.admin_lists.active == 0
@@ -0,0 +1,56 @@
+"""bcrypt on a bounded worker pool: verification, cost migration, load shedding."""
+import asyncio
+
+import pytest
+
+from passwords import PasswordHasher, PasswordHasherBusy
+
+
+def test_verify_and_rehash_on_a_cost_change():
+    async def scenario():
+        old = PasswordHasher(rounds=4, workers=1)
+        new = PasswordHasher(rounds=5, workers=1)
+        try:
+            hashed = await old.hash("segredo")
+            return (await old.verify("segredo", hashed), await old.verify("errado", hashed),
+                    await new.verify("segredo", hashed), new.stats())
+        finally:
+            old.shutdown()
+            new.shutdown()
+
+    same_cost, wrong, migrated, stats = asyncio.run(scenario())
+    assert same_cost == (True, None)
+    assert wrong == (False, None)
+    assert migrated[0] and migrated[1].startswith("$2b$05$")
+    assert (stats["rehashed"], stats["completed"]) == (1, 1)
+
+
+def test_calls_beyond_max_pending_are_shed():
+    async def scenario():
+        hasher = PasswordHasher(rounds=4, workers=1, max_pending=1)
+        try:
+            # One hashes, one waits for the worker, the third is turned away
+            return await asyncio.gather(*(hasher.hash("x") for _ in range(3)), return_exceptions=True), hasher
+        finally:
+            hasher.shutdown()
+
+    results, hasher = asyncio.run(scenario())
+    assert [type(r) for r in results].count(PasswordHasherBusy) == 1
+    assert (hasher.rejected, hasher.completed, hasher.pending, hasher.active) == (1, 2, 0, 0)
+
+
+def test_no_workers_hashes_inline():
+    async def scenario():
+        hasher = PasswordHasher(rounds=4, workers=0, max_pending=0)
+        return await hasher.verify("x", await hasher.hash("x"))
+
+    assert asyncio.run(scenario()) == (True, None)
+
+
+def test_a_busy_hasher_answers_503(api, server, monkeypatch):
+    async def busy(*args):
+        raise PasswordHasherBusy()
+
+    monkeypatch.setattr(server.password_hasher, "_run", busy)
+    response = api.post("/api/auth/register", json={"username": "ana", "password": "x"})
+    assert (response.status_code, response.headers["retry-after"]) == (503, "1")
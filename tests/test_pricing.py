@@ -0,0 +1,83 @@
+"""Volume pricing tiers and cart quotes from ``PriceBook``."""
+import asyncio
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+from pricing import PriceBook, UnknownProducts, compile_product, normalize_tiers
+
+COFFEE = {"id": "coffee", "name": "Café", "price": 3.0, "stock": 30,
+          "volume_pricing": [{"min_qty": 10, "price": 2.5}, {"min_qty": 5, "price": 2.8}]}
+WATER = {"id": "water", "name": "Água", "price": 2.5, "stock": 2}
+
+
+def test_tiers_are_sorted_and_validated():
+    assert normalize_tiers([{"min_qty": 10, "price": 2}, {"min_qty": 5.0, "price": 3}]) == [
+        {"min_qty": 5, "price": 3.0}, {"min_qty": 10, "price": 2.0},
+    ]
+    for tiers in ([{"min_qty": 0, "price": 1}], [{"min_qty": 1.5, "price": 1}], [{"min_qty": True, "price": 1}],
+                  [{"min_qty": 2, "price": -1}], [{"price": 1}], [{"min_qty": 2, "price": 1}, {"min_qty": 2, "price": 2}]):
+        with pytest.raises(ValueError):
+            normalize_tiers(tiers)
+
+
+def test_unit_price_at_tier_boundaries():
+    table = compile_product(COFFEE)
+    assert table.unit_price(1) == (3.0, None)
+    assert table.unit_price(4) == (3.0, None)
+    assert table.unit_price(5) == (2.8, 5)
+    assert table.unit_price(9) == (2.8, 5)
+    assert table.unit_price(10) == (2.5, 10)
+    assert table.unit_price(500) == (2.5, 10)
+
+
+def test_invalid_stored_tiers_fall_back_to_the_base_price():
+    table = compile_product({**COFFEE, "volume_pricing": [{"min_qty": 0, "price": 1}]})
+    assert table.min_qtys == ()
+    assert table.unit_price(100) == (3.0, None)
+
+
+def price_book_with(*products) -> PriceBook:
+    db = AsyncMongoMockClient()["pricing_test"]
+    asyncio.run(db.products.insert_many([dict(p) for p in products]))
+    return PriceBook(db)
+
+
+def test_quote_counts_lines_of_a_product_together():
+    book = price_book_with(COFFEE, WATER)
+    quote = asyncio.run(book.quote(1, [("coffee", 3), ("water", 1), ("coffee", 2)]))
+    assert quote.catalog_version == 1
+    assert [(line["unit_price"], line["tier_min_qty"], line["line_total"]) for line in quote.lines] == [
+        (2.8, 5, 8.4), (2.5, None, 2.5), (2.8, 5, 5.6),
+    ]
+    assert quote.total == 16.5
+    assert all(line["in_stock"] for line in quote.lines)
+
+
+def test_quote_flags_stock_and_unknown_products():
+    book = price_book_with(COFFEE, WATER)
+    quote = asyncio.run(book.quote(1, [("water", 3)]))
+    assert quote.lines[0]["in_stock"] is False
+    with pytest.raises(UnknownProducts) as e:
+        asyncio.run(book.quote(1, [("ghost", 1), ("coffee", 1), ("ghost", 2)]))
+    assert e.value.product_ids == ["ghost"]
+
+
+def test_price_book_follows_the_catalog_version():
+    book = price_book_with(COFFEE)
+
+    async def scenario():
+        await book.tables(1)
+        # A local write: applied in place, no reload
+        book.apply([{**COFFEE, "price": 3.5, "volume_pricing": []}])
+        book.advance(2)
+        local = await book.quote(2, [("coffee", 10)])
+        # A version this worker did not write reloads from Mongo
+        book.advance(4)
+        reloaded = await book.quote(4, [("coffee", 10)])
+        return local, reloaded
+
+    local, reloaded = asyncio.run(scenario())
+    assert local.lines[0]["unit_price"] == 3.5
+    assert reloaded.lines[0]["unit_price"] == 2.5
+    assert book.reloads == 2
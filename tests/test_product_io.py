@@ -0,0 +1,76 @@
+"""POST /products/import and GET /products/export."""
+import asyncio
+import json
+
+import pytest
+
+
+@pytest.fixture
+def catalog(api, server):
+    asyncio.run(server.db.products.insert_many([
+        server.Product(id="coffee", name="Café", price=3.0, stock=30, category="Bebidas").model_dump(),
+        server.Product(id="cake", name="Bolo", price=6.0, stock=20, category="Doces").model_dump(),
+    ]))
+    return api
+
+
+def products(server) -> dict:
+    docs = asyncio.run(server.db.products.find({}, {"_id": 0}).to_list(None))
+    return {doc["id"]: doc for doc in docs}
+
+
+def import_file(api, body: str, content_type: str = "text/csv", **params) -> dict:
+    response = api.post("/api/products/import", content=body.encode(), params=params,
+                        headers={"Content-Type": content_type})
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_csv_rows_insert_update_leave_unchanged_or_fail(catalog, server):
+    report = import_file(catalog, "\n".join([
+        "id,name,price,stock",
+        "coffee,Café,3.5,30",
+        "cake,Bolo,6.0,20",
+        "juice,Suco,5.5,3",
+        "tea,Chá,cheap,4",
+        ",,1.0,1",
+    ]))
+    assert {k: report[k] for k in ("processed", "inserted", "updated", "unchanged", "error_count")} == {
+        "processed": 5, "inserted": 1, "updated": 1, "unchanged": 1, "error_count": 2}
+    # Rows are numbered from the first one after the header
+    assert [error["row"] for error in report["errors"]] == [4, 5]
+    assert report["errors"][0]["errors"][0].startswith("price:")
+
+    stored = products(server)
+    assert set(stored) == {"coffee", "cake", "juice"}
+    # Columns the file does not have are left alone on updates and defaulted on inserts
+    assert (stored["coffee"]["price"], stored["coffee"]["category"]) == (3.5, "Bebidas")
+    assert (stored["juice"]["category"], stored["juice"]["low_stock_threshold"]) == ("general", 10)
+
+
+def test_imported_rows_reach_the_catalog_trackers(catalog, server):
+    import_file(catalog, "id,name,price,stock\njuice,Suco,5.5,3\n")
+    assert [row["id"] for row in catalog.get("/api/stats/low-stock").json()] == ["juice"]
+    assert [row["id"] for row in catalog.get("/api/products/search", params={"q": "suco"}).json()["items"]] == ["juice"]
+
+
+def test_ndjson_matched_by_name(catalog, server):
+    body = "\n".join([
+        json.dumps({"name": "Bolo", "price": 6.5, "stock": 20}),
+        "{not json",
+        json.dumps({"name": "Pão", "price": 1.0, "stock": 40, "volume_pricing": [{"min_qty": 10, "price": 0.8}]}),
+    ])
+    report = import_file(catalog, body, "application/x-ndjson", key="name")
+    assert (report["inserted"], report["updated"], report["error_count"]) == (1, 1, 1)
+    assert report["errors"][0]["row"] == 2
+    by_name = {doc["name"]: doc for doc in products(server).values()}
+    assert by_name["Bolo"]["id"] == "cake" and by_name["Bolo"]["price"] == 6.5
+    assert by_name["Pão"]["volume_pricing"] == [{"min_qty": 10, "price": 0.8}]
+
+
+def test_an_export_imports_back_unchanged(catalog, server):
+    for fmt, content_type in (("csv", "text/csv"), ("ndjson", "application/x-ndjson")):
+        exported = catalog.get("/api/products/export", params={"format": fmt})
+        assert exported.status_code == 200
+        report = import_file(catalog, exported.text, content_type)
+        assert (report["processed"], report["unchanged"], report["error_count"]) == (2, 2, 0)
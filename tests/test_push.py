@@ -0,0 +1,133 @@
+"""PushDeliveryEngine against a local stand-in push service.
+
+The stand-in answers by path: ``/ok/*`` accepts, ``/gone/*`` is an expired
+subscription (410) and ``/busy/*`` asks for a retry (429, Retry-After: 1) on
+its first request.
+"""
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+from push import LeaseLost, PushDeliveryEngine
+
+
+class StandInPushService(BaseHTTPRequestHandler):
+    hits = []
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.hits.append(self.path)
+        if self.path.startswith("/gone/"):
+            self.send_response(410)
+        elif self.path.startswith("/busy/") and self.hits.count(self.path) == 1:
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+        else:
+            self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def push_service():
+    StandInPushService.hits = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInPushService)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+async def seed(db, base_url: str, paths):
+    for i, path in enumerate(paths):
+        await db.users.insert_one({"id": f"user-{i:03d}", "role": "customer", "notifications_enabled": True})
+        await db.push_subscriptions.insert_one({
+            "id": f"sub-{i:03d}", "user_id": f"user-{i:03d}", "subscription_data": {"endpoint": base_url + path},
+        })
+
+
+def engine_for(db, **options) -> PushDeliveryEngine:
+    return PushDeliveryEngine(db, workers=0, batch_size=2, backoff=0.01, **options)
+
+
+def test_delivers_retries_and_prunes(push_service):
+    async def scenario():
+        db = AsyncMongoMockClient()["push_test"]
+        await seed(db, push_service, ["/ok/1", "/gone/2", "/busy/3", "/ok/4", "/ok/5"])
+        engine = PushDeliveryEngine(db, workers=1, batch_size=2, backoff=0.01)
+        await engine.start()
+        try:
+            job = await engine.enqueue("hello", "all_users", None, None, "admin")
+            for _ in range(200):
+                doc = await db.push_jobs.find_one({"id": job["id"]})
+                if doc["status"] == "done":
+                    break
+                await asyncio.sleep(0.05)
+        finally:
+            await engine.stop()
+        return doc, await db.push_subscriptions.count_documents({})
+
+    doc, subscriptions = asyncio.run(scenario())
+    assert doc["status"] == "done"
+    assert (doc["users"], doc["sent"], doc["pruned"], doc["failed"], doc["retries"]) == (5, 4, 1, 0, 1)
+    assert doc["last_user_id"] == "user-004"
+    assert doc["lease_owner"] is None
+    assert subscriptions == 4
+    assert StandInPushService.hits.count("/busy/3") == 2
+
+
+def test_lease_is_renewed_during_retry_after(push_service):
+    async def scenario():
+        db = AsyncMongoMockClient()["push_test"]
+        await seed(db, push_service, ["/busy/1"])
+        engine = engine_for(db, lease_seconds=0.3)
+        other = engine_for(db, lease_seconds=0.3)
+        await engine.start()
+        try:
+            await engine.enqueue("hello", "all_users", None, None, "admin")
+            job = await engine._claim()
+            run = asyncio.create_task(engine._run(job))
+            # The Retry-After wait outlasts the lease several times over
+            await asyncio.sleep(0.7)
+            stolen = await other._claim()
+            await run
+        finally:
+            await engine.stop()
+        return stolen, await db.push_jobs.find_one({"id": job["id"]})
+
+    stolen, doc = asyncio.run(scenario())
+    assert stolen is None
+    assert doc["status"] == "done"
+    assert doc["sent"] == 1
+
+
+def test_worker_that_lost_its_lease_stops(push_service):
+    async def scenario():
+        db = AsyncMongoMockClient()["push_test"]
+        await seed(db, push_service, ["/busy/1", "/ok/2", "/ok/3"])
+        engine = engine_for(db, lease_seconds=0.3)
+        await engine.start()
+        try:
+            await engine.enqueue("hello", "all_users", None, None, "admin")
+            job = await engine._claim()
+            run = asyncio.create_task(engine._run(job))
+            await asyncio.sleep(0.2)
+            # Another worker took the job over, e.g. after a long pause here
+            await db.push_jobs.update_one({"id": job["id"]}, {"$set": {"lease_owner": "someone-else"}})
+            with pytest.raises(LeaseLost):
+                await run
+        finally:
+            await engine.stop()
+        return await db.push_jobs.find_one({"id": job["id"]})
+
+    doc = asyncio.run(scenario())
+    assert doc["status"] == "running"
+    assert doc["lease_owner"] == "someone-else"
+    assert doc["sent"] == 0
@@ -0,0 +1,93 @@
+"""Token buckets, their refill and the 429 answered once one is empty."""
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from ratelimit import (ConcurrencyLimit, Limit, RateLimiter, RateLimitMiddleware, TokenBuckets, parse_limit,
+                       parse_limits)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_parse_limits():
+    assert parse_limit("10/s") == Limit(10.0, 10.0)
+    assert parse_limit("30/m:60") == Limit(0.5, 60.0)
+    assert parse_limit("off") is None
+    assert parse_limits("post /api/sales=5/s:20; GET /api/users=off") == {
+        "POST /api/sales": Limit(5.0, 20.0), "GET /api/users": None,
+    }
+    for text in ("10/d", "0/s", "10/s:0.5"):
+        with pytest.raises(ValueError):
+            parse_limit(text)
+    with pytest.raises(ValueError):
+        parse_limits("/api/sales=5/s")
+
+
+def test_bucket_bursts_then_refills_at_the_rate():
+    clock = Clock()
+    buckets = TokenBuckets(clock=clock)
+    limit = Limit(rate=2.0, burst=3.0)
+    assert [buckets.take(("r", "c"), limit) for _ in range(3)] == [0, 0, 0]
+    assert buckets.take(("r", "c"), limit) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert buckets.take(("r", "c"), limit) == 0
+    assert buckets.take(("r", "c"), limit) == pytest.approx(0.5)
+    # Refill stops at the burst
+    clock.now += 60
+    assert [buckets.take(("r", "c"), limit) for _ in range(4)][-1] == pytest.approx(0.5)
+    # Clients have their own buckets
+    assert buckets.take(("r", "other"), limit) == 0
+
+
+def test_full_buckets_are_evicted():
+    clock = Clock()
+    buckets = TokenBuckets(max_keys=2, clock=clock)
+    limit = Limit(rate=1.0, burst=1.0)
+    buckets.take(("r", "a"), limit)
+    buckets.take(("r", "b"), limit)
+    buckets.take(("r", "c"), limit)
+    assert len(buckets) == 2 and buckets.evicted == 1
+    clock.now += 2
+    buckets.take(("r", "d"), limit)
+    assert len(buckets) == 1 and buckets.evicted == 3
+
+
+def limited_app(limiter: RateLimiter) -> TestClient:
+    app = Starlette(routes=[Route("/ping", lambda request: PlainTextResponse("pong"))])
+    app.add_middleware(RateLimitMiddleware, limiter=limiter, identify=lambda scope: "client")
+    return TestClient(app)
+
+
+def test_empty_bucket_answers_429_with_retry_after():
+    limiter = RateLimiter({"GET /ping": Limit(rate=0.1, burst=2.0)}, default=None)
+    client = limited_app(limiter)
+    assert [client.get("/ping").status_code for _ in range(2)] == [200, 200]
+    response = client.get("/ping")
+    assert response.status_code == 429
+    assert response.json() == {"detail": "Too many requests"}
+    assert response.headers["retry-after"] == "10"
+    assert limiter.stats()["limited"] == {"GET /ping": 1}
+
+
+def test_routes_without_a_limit_are_not_counted():
+    limiter = RateLimiter({}, default=None)
+    client = limited_app(limiter)
+    assert all(client.get("/ping").status_code == 200 for _ in range(20))
+    assert limiter.stats()["buckets"] == 0
+
+
+def test_concurrency_limit_sheds_above_the_limit():
+    limit = ConcurrencyLimit(1)
+    slot = limit.acquire()
+    assert limit.acquire() is None
+    slot.release()
+    slot.release()
+    assert limit.stats() == {"limit": 1, "active": 0, "shed": 1}
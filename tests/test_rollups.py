@@ -0,0 +1,87 @@
+"""Sales rollups: applied after commit, once per sale, and equal to summing ``sales``."""
+import asyncio
+
+import pytest
+
+from rollups import CANCEL, PENDING_FIELD, SALE, RollupCatchUp, apply_pending
+
+
+@pytest.fixture
+def shop(api, server):
+    async def seed():
+        await server.db.products.insert_many([
+            server.Product(id="coffee", name="Café", price=3.0, stock=50).model_dump(),
+            server.Product(id="water", name="Água", price=2.5, stock=50).model_dump(),
+        ])
+        await server.db.users.insert_one(server.User(id="ana", username="ana").model_dump())
+    asyncio.run(seed())
+    return api
+
+
+def sell(api, payment_method: str, *lines) -> dict:
+    prices = {"coffee": 3.0, "water": 2.5}
+    items = [{"product_id": pid, "name": pid, "quantity": qty, "unit_price": prices[pid]} for pid, qty in lines]
+    response = api.post("/api/sales", json={"customer_id": "ana", "payment_method": payment_method, "items": items,
+                                            "total": sum(qty * prices[pid] for pid, qty in lines)})
+    assert response.status_code == 200
+    return response.json()
+
+
+def summary(api, group_by: str) -> dict:
+    response = api.get("/api/stats/sales-summary", params={"from": "2000-01-01T00:00:00Z", "group_by": group_by})
+    assert response.status_code == 200
+    return {row["key"]: (row["sales"], row["revenue"], row["cancelled"]) for row in response.json()["rows"]}
+
+
+def from_sales(server, group_by: str) -> dict:
+    totals = {}
+    for sale in asyncio.run(server.db.sales.find({}, {"_id": 0}).to_list(None)):
+        completed = sale["status"] == "completed"
+        if group_by == "product":
+            rows = [(item["product_id"], item["quantity"] * item["unit_price"]) for item in sale["items"]]
+        else:
+            rows = [(sale["seller_id" if group_by == "seller" else group_by], sale["total"])]
+        for key, revenue in rows:
+            sales, total, cancelled = totals.get(key, (0, 0.0, 0))
+            totals[key] = (sales + completed, round(total + revenue * completed, 2), cancelled + (not completed))
+    return totals
+
+
+def test_rollups_match_the_sales_after_sales_and_cancellations(shop, server):
+    sell(shop, "cash", ("coffee", 2))
+    fiado = sell(shop, "fiado", ("coffee", 1), ("water", 4))
+    sell(shop, "card", ("water", 1))
+    batch = shop.post("/api/sales/batch", json={"sales": [{
+        "idempotency_key": "offline-1", "customer_id": "ana", "payment_method": "cash",
+        "items": [{"product_id": "water", "name": "water", "quantity": 2, "unit_price": 2.5}], "total": 5.0,
+    }]})
+    assert batch.json()["applied"] == 1
+    assert shop.post(f"/api/sales/{fiado['id']}/cancel", json={"reason": "wrong customer"}).status_code == 200
+
+    for group_by in ("payment_method", "product", "seller"):
+        assert summary(shop, group_by) == from_sales(server, group_by)
+    assert summary(shop, "payment_method")["fiado"] == (0, 0.0, 1)
+    assert asyncio.run(server.db.sales.count_documents({PENDING_FIELD: {"$ne": []}})) == 0
+
+
+def test_a_step_is_applied_once_however_often_it_is_claimed(shop, server):
+    sale = sell(shop, "cash", ("coffee", 1))
+    before = summary(shop, "payment_method")
+    asyncio.run(apply_pending(server.db, [sale], SALE))
+    asyncio.run(apply_pending(server.db, [sale], CANCEL))
+    assert summary(shop, "payment_method") == before
+
+
+def test_catch_up_applies_steps_a_worker_left_pending(shop, server):
+    # As if the worker died between the commit and applying the rollups
+    sale = server.Sale(seller_id="seller", customer_id="ana", total=6.0, payment_method="cash",
+                       items=[server.SaleItem(product_id="coffee", name="Café", quantity=2, unit_price=3.0)])
+    asyncio.run(server.db.sales.insert_one({**sale.model_dump(), PENDING_FIELD: [SALE]}))
+    catch_up = RollupCatchUp(server.db, interval=0)
+
+    # The first pass leaves it to the worker that committed it
+    assert asyncio.run(catch_up.run_once()) == 0
+    assert summary(shop, "payment_method") == {}
+    assert asyncio.run(catch_up.run_once()) == 1
+    assert asyncio.run(catch_up.run_once()) == 0
+    assert summary(shop, "payment_method") == {"cash": (1, 6.0, 0)}
@@ -0,0 +1,99 @@
+"""Offline sale uploads (POST /sales/batch): a key is applied once, however often it is sent."""
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def shop(api, server):
+    async def seed():
+        await server.db.products.insert_many([
+            server.Product(id="coffee", name="Café", price=3.0, stock=5).model_dump(),
+            server.Product(id="water", name="Água", price=2.5, stock=100).model_dump(),
+        ])
+        await server.db.users.insert_one(server.User(id="ana", username="ana").model_dump())
+    asyncio.run(seed())
+    return api
+
+
+def offline_sale(key: str, quantity: int = 1, product_id: str = "coffee", price: float = 3.0,
+                 payment_method: str = "fiado") -> dict:
+    return {
+        "idempotency_key": key, "customer_id": "ana", "payment_method": payment_method,
+        "items": [{"product_id": product_id, "name": product_id, "quantity": quantity, "unit_price": price}],
+        "total": round(quantity * price, 2), "timestamp": "2025-06-01T12:00:00+00:00",
+    }
+
+
+def outcomes(response) -> list:
+    assert response.status_code == 200
+    return [r["outcome"] for r in response.json()["results"]]
+
+
+def state(server) -> tuple:
+    async def read():
+        coffee = await server.db.products.find_one({"id": "coffee"})
+        ana = await server.db.users.find_one({"id": "ana"})
+        return coffee["stock"], ana["debt"], await server.db.sales.count_documents({})
+    return asyncio.run(read())
+
+
+def test_retried_upload_is_applied_once(shop, server):
+    batch = {"sales": [offline_sale("t1-1", 2), offline_sale("t1-2", 1, "water", 2.5, "cash")]}
+    first = shop.post("/api/sales/batch", json=batch)
+    assert outcomes(first) == ["applied", "applied"]
+    retry = shop.post("/api/sales/batch", json=batch)
+    assert outcomes(retry) == ["already_applied", "already_applied"]
+    assert [r["sale_id"] for r in retry.json()["results"]] == [r["sale_id"] for r in first.json()["results"]]
+    assert retry.json()["applied"] == 0
+    assert state(server) == (3, 6.0, 2)
+
+
+def test_repeated_key_in_one_batch(shop, server):
+    response = shop.post("/api/sales/batch", json={"sales": [offline_sale("k"), offline_sale("k", 3)]})
+    assert outcomes(response) == ["applied", "duplicate"]
+    assert state(server) == (4, 3.0, 1)
+
+
+def test_stock_goes_to_sales_in_queue_order(shop, server):
+    batch = {"sales": [offline_sale("a", 4), offline_sale("b", 2), offline_sale("c", 1)]}
+    assert outcomes(shop.post("/api/sales/batch", json=batch)) == ["applied", "out_of_stock", "applied"]
+    asyncio.run(server.db.products.update_one({"id": "coffee"}, {"$inc": {"stock": 10}}))
+    # Resending the whole queue applies only the sale that was turned away
+    assert outcomes(shop.post("/api/sales/batch", json=batch)) == ["already_applied", "applied", "already_applied"]
+    assert state(server) == (8, 21.0, 3)
+
+
+def test_keys_outlive_archived_sales(shop, server, monkeypatch):
+    assert outcomes(shop.post("/api/sales/batch", json={"sales": [offline_sale("old")]})) == ["applied"]
+    monkeypatch.setattr(server.archive, "grace", 0)
+    monkeypatch.setattr(server.archive, "state_ttl", 0)
+    asyncio.run(server.archive.run_once(after_days=0))
+    asyncio.run(server.archive.run_once(after_days=0))
+    assert asyncio.run(server.db.sales.count_documents({})) == 0
+    assert outcomes(shop.post("/api/sales/batch", json={"sales": [offline_sale("old")]})) == ["already_applied"]
+    assert state(server)[:2] == (4, 3.0)
+
+
+def test_keys_of_sales_from_before_sale_keys_are_found(shop, server):
+    legacy = server.Sale(seller_id="seller", customer_id="ana", items=[], total=0.0, payment_method="cash",
+                         idempotency_key="legacy").model_dump()
+    asyncio.run(server.db.sales.insert_one(dict(legacy)))
+    response = shop.post("/api/sales/batch", json={"sales": [offline_sale("legacy")]})
+    assert outcomes(response) == ["already_applied"]
+    assert response.json()["results"][0]["sale_id"] == legacy["id"]
+
+
+def test_rejected_sales_do_not_claim_their_key(shop, server):
+    batch = {"sales": [offline_sale("p", price=2.0), offline_sale("q", 0), offline_sale("r", product_id="ghost")]}
+    assert outcomes(shop.post("/api/sales/batch", json=batch)) == ["prices_changed", "invalid", "invalid"]
+    assert outcomes(shop.post("/api/sales/batch", json={"sales": [offline_sale("p")]})) == ["applied"]
+    assert state(server) == (4, 3.0, 1)
+
+
+def test_sales_without_a_key_do_not_store_one(shop, server):
+    response = shop.post("/api/sales", json={k: v for k, v in offline_sale("unused").items()
+                                             if k not in ("idempotency_key", "timestamp")})
+    assert response.status_code == 200
+    doc = asyncio.run(server.db.sales.find_one({"id": response.json()["id"]}))
+    assert "idempotency_key" not in doc
@@ -0,0 +1,77 @@
+"""Accent folding, prefix and typo matching, and ranking of ``ProductSearchIndex``."""
+import pytest
+
+from search import ProductSearchIndex, fold, prefix_distance, words
+
+PRODUCTS = [
+    {"id": "1", "name": "Café", "category": "Bebidas", "stock": 30},
+    {"id": "2", "name": "Cafezinho", "category": "Bebidas", "stock": 0},
+    {"id": "3", "name": "Água Mineral", "category": "Bebidas", "stock": 100},
+    {"id": "4", "name": "Pão de Queijo", "category": "Salgados", "stock": 10},
+]
+
+
+@pytest.fixture
+def index() -> ProductSearchIndex:
+    index = ProductSearchIndex(None, {})
+    index.apply([dict(p) for p in PRODUCTS])
+    return index
+
+
+def ids(result: dict) -> list:
+    return [p["id"] for p in result["items"]]
+
+
+def test_folding():
+    assert fold("Açaí ÉCLAIR") == "acai eclair"
+    assert words("Pão-de-Queijo (100g)") == ["pao", "de", "queijo", "100g"]
+
+
+def test_prefix_distance():
+    assert prefix_distance("cafe", "cafezinho", 1) == 0
+    assert prefix_distance("cafw", "cafezinho", 1) == 1
+    assert prefix_distance("mineal", "mineral", 1) == 1
+    assert prefix_distance("xyz", "cafe", 1) == 2
+
+
+def test_accents_and_case_are_ignored(index):
+    assert ids(index.search("CAFÉ")) == ids(index.search("cafe")) == ["1", "2"]
+    assert ids(index.search("agua")) == ["3"]
+
+
+def test_exact_words_rank_above_prefixes_and_typos(index):
+    assert ids(index.search("caf")) == ["1", "2"]
+    assert ids(index.search("mineal")) == ["3"]
+    assert ids(index.search("cafw")) == ["1", "2"]
+
+
+def test_typos_need_the_right_first_letter_and_length(index):
+    assert index.search("gua")["total"] == 0
+    # Words under four letters must match exactly or as a prefix
+    assert index.search("pax")["total"] == 0
+
+
+def test_every_query_word_must_match(index):
+    assert ids(index.search("pao queijo")) == ["4"]
+    assert index.search("pao cafe")["total"] == 0
+
+
+def test_name_matches_rank_above_category_matches(index):
+    index.apply([{"id": "5", "name": "Bebidas Mix", "category": "Combos", "stock": 5}])
+    assert ids(index.search("bebidas")) == ["5", "3", "1", "2"]
+
+
+def test_filters_and_facets(index):
+    assert ids(index.search("cafe", in_stock=True)) == ["1"]
+    result = index.search("", category="BEBIDAS")
+    assert result["total"] == 3
+    assert result["facets"]["category"] == [{"value": "Bebidas", "count": 3}, {"value": "Salgados", "count": 1}]
+    assert ids(index.search("", limit=2, offset=1)) == ["1", "2"]
+
+
+def test_renamed_and_removed_products_are_reindexed(index):
+    index.apply([{"id": "4", "name": "Pastel"}])
+    assert index.search("queijo")["total"] == 0
+    assert index.search("pastel")["items"] == [{"id": "4", "name": "Pastel", "category": "Salgados", "stock": 10}]
+    index.remove("1")
+    assert ids(index.search("cafe")) == ["2"]
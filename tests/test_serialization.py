@@ -0,0 +1,29 @@
+"""The fast read path: projected Mongo documents straight to orjson."""
+import asyncio
+import json
+
+from serialization import fill_defaults, model_projection
+
+
+def test_projection_and_defaults_follow_the_model(server):
+    assert model_projection(server.Product) == {
+        "_id": 0, "id": 1, "name": 1, "price": 1, "stock": 1, "low_stock_threshold": 1,
+        "category": 1, "image_url": 1, "thumbnail_url": 1, "volume_pricing": 1}
+    # Fields a document already has are kept; factory fields are never invented
+    doc, = fill_defaults([{"name": "Café", "price": 3.0, "stock": 5, "category": "bebidas"}], server.Product)
+    assert doc["category"] == "bebidas" and doc["low_stock_threshold"] == 10 and "id" not in doc
+
+
+def test_legacy_documents_read_the_same_on_both_paths(api, server, monkeypatch):
+    # Written before thumbnails and volume pricing existed, with a since-removed field
+    asyncio.run(server.db.products.insert_one({"id": "p1", "name": "Café", "price": 3.0, "stock": 5,
+                                               "image_url": "", "barcode": "789"}))
+    pages = {}
+    for fast in (True, False):
+        monkeypatch.setattr(server, "FAST_SERIALIZATION", fast)
+        page = api.get("/api/products", params={"limit": 10})
+        stream = api.get("/api/products", params={"format": "ndjson"})
+        pages[fast] = page.json(), [json.loads(line) for line in stream.text.splitlines()]
+    assert pages[True] == pages[False]
+    page, stream = pages[True]
+    assert page == stream == [server.Product(id="p1", name="Café", price=3.0, stock=5).model_dump()]
@@ -0,0 +1,53 @@
+"""Bulk review of pending transactions (POST /transactions/review-batch)."""
+import asyncio
+
+
+def pending(server, *rows) -> list:
+    docs = [server.Transaction(id=tid, user_id="ana", type=kind, amount=amount).model_dump()
+            for tid, kind, amount in rows]
+    asyncio.run(server.db.transactions.insert_many([dict(d) for d in docs]))
+    return docs
+
+
+def test_every_review_gets_an_outcome(api, server):
+    asyncio.run(server.db.users.insert_one(server.User(id="ana", username="ana", debt=30.0).model_dump()))
+    pending(server, ("t1", "credit_add", 10.0), ("t2", "debt_payment", 8.0), ("t3", "credit_add", 99.0))
+    asyncio.run(server.db.transactions.update_one({"id": "t3"}, {"$set": {"status": "rejected"}}))
+
+    response = api.post("/api/transactions/review-batch", json={"reviews": [
+        {"transaction_id": "t1", "status": "approved"},
+        {"transaction_id": "t2", "status": "approved", "admin_note": "pix"},
+        {"transaction_id": "t1", "status": "rejected"},
+        {"transaction_id": "t3", "status": "approved"},
+        {"transaction_id": "ghost", "status": "approved"},
+    ]})
+    assert response.status_code == 200
+    body = response.json()
+    assert (body["applied"], body["skipped"]) == (2, 3)
+    assert [r["outcome"] for r in body["results"]] == ["approved", "approved", "duplicate", "not_pending", "not_found"]
+    assert body["results"][3]["status"] == "rejected"
+
+    ana = asyncio.run(server.db.users.find_one({"id": "ana"}))
+    assert (ana["credit"], ana["debt"]) == (10.0, 22.0)
+    t2 = asyncio.run(server.db.transactions.find_one({"id": "t2"}))
+    assert (t2["status"], t2["admin_note"]) == ("approved", "pix")
+
+
+def test_replaying_a_batch_changes_nothing(api, server):
+    asyncio.run(server.db.users.insert_one(server.User(id="ana", username="ana").model_dump()))
+    pending(server, ("t1", "credit_add", 10.0))
+    batch = {"reviews": [{"transaction_id": "t1", "status": "approved"}]}
+    assert api.post("/api/transactions/review-batch", json=batch).json()["applied"] == 1
+    replay = api.post("/api/transactions/review-batch", json=batch).json()
+    assert replay["applied"] == 0
+    assert replay["results"] == [{"transaction_id": "t1", "outcome": "not_pending", "status": "approved"}]
+    assert asyncio.run(server.db.users.find_one({"id": "ana"}))["credit"] == 10.0
+    assert asyncio.run(server.db.balance_ledger.count_documents({})) == 1
+
+
+def test_invalid_statuses_reject_the_whole_batch(api, server):
+    pending(server, ("t1", "credit_add", 10.0))
+    response = api.post("/api/transactions/review-batch", json={"reviews": [
+        {"transaction_id": "t1", "status": "approved"}, {"transaction_id": "t1", "status": "maybe"}]})
+    assert response.status_code == 400
+    assert asyncio.run(server.db.transactions.find_one({"id": "t1"}))["status"] == "pending"
@@ -0,0 +1,59 @@
+"""The authenticated-user cache behind get_current_user."""
+import asyncio
+
+from user_cache import UserCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr("user_cache.time.monotonic", clock)
+    cache = UserCache(ttl=5.0)
+    cache.put("ana", "user", cache.generation)
+    clock.now += 4.9
+    assert cache.get("ana") == "user"
+    clock.now += 0.2
+    assert cache.get("ana") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = UserCache(maxsize=2)
+    for key in ("a", "b"):
+        cache.put(key, key, cache.generation)
+    cache.get("a")
+    cache.put("c", "c", cache.generation)
+    assert [cache.get(key) for key in ("a", "b", "c")] == ["a", None, "c"]
+    assert cache.evictions == 1
+
+
+def test_a_read_from_before_an_invalidation_is_not_cached():
+    cache = UserCache()
+    generation = cache.generation
+    cache.invalidate("ana")
+    cache.put("ana", "stale", generation)
+    assert cache.get("ana") is None
+
+
+def test_a_zero_ttl_disables_caching():
+    cache = UserCache(ttl=0)
+    cache.put("ana", "user", cache.generation)
+    assert cache.get("ana") is None
+
+
+def test_role_changes_apply_on_the_next_request(api, server):
+    asyncio.run(server.db.users.insert_one(server.User(id="sam", username="sam", role="seller").model_dump()))
+    sam = {"Authorization": "Bearer " + server.create_access_token({"user_id": "sam"})}
+    # A seller without an open drawer: past the role check, nothing to show
+    assert api.get("/api/cash-drawer/current", headers=sam).status_code == 404
+    assert api.get("/api/cash-drawer/current", headers=sam).status_code == 404
+
+    assert api.patch("/api/users/sam/role", json={"role": "customer"}).status_code == 200
+    assert api.get("/api/cash-drawer/current", headers=sam).status_code == 403